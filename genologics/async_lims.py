@@ -0,0 +1,362 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Asynchronous LIMS interface, on asyncio and aiohttp.
+
+aiohttp is an optional dependency (pip install genologics[async]), and this
+module requires Python 3.6 or later.
+
+An AsyncLims wraps a Lims and shares its cache, so the instances are those
+of the entity classes, with the same descriptors: an instance retrieved
+through AsyncLims behaves exactly as one retrieved through the Lims. Only
+the requests are asynchronous; reading an attribute of an instance which
+has not been retrieved still does a blocking GET through the Lims.
+
+Usage:
+async with AsyncLims(lims) as alims:
+    processes = await alims.get_processes(type='Library Prep', resolve=True)
+    async for sample in alims.iter_samples(projectlimsid=project.id):
+        ...
+"""
+
+import asyncio
+import base64
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+from genologics import protocol
+from genologics.entities import Artifact, Container, Containertype, File, Lab, Process, Processtype, \
+    Project, Protocol, ReagentKit, ReagentLot, ReagentType, Researcher, Sample, Udfconfig, Workflow
+from genologics.lims import MAX_WORKERS
+from genologics.protocol import TIMEOUT
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Entity classes having a batch/retrieve endpoint
+BATCH_CLASSES = (Artifact, Container, File, Sample)
+
+
+def _query(params):
+    "Convert a params dictionary to a list of pairs, repeating list values."
+    result = []
+    for key, value in (params or dict()).items():
+        if not isinstance(value, (list, tuple, set)):
+            value = [value]
+        result.extend((key, str(v)) for v in value)
+    return result
+
+
+class AsyncLims(object):
+    """Asynchronous interface to the LIMS of a Lims, sharing its cache.
+
+    limit: maximum number of concurrent connections.
+    timeout: in seconds, of the requests without a timeout of their own.
+
+    As with Lims.http_transport, the requests are authenticated by the
+    session cookie of the Lims once one is held, starting with the one of
+    the Lims, and with Basic auth otherwise or once the session expires.
+    The transports stacked on the Lims (retries, rate limits) do not apply.
+    """
+
+    def __init__(self, lims, limit=MAX_WORKERS, timeout=TIMEOUT):
+        if aiohttp is None:
+            raise ImportError("AsyncLims requires aiohttp")
+        self.lims = lims
+        self.limit = limit
+        self.timeout = timeout
+        self._session = None
+
+    @property
+    def session(self):
+        "The aiohttp session, created on first use in the running event loop."
+        if self._session is None or self._session.closed:
+            # unsafe: the server may be given by its IP address
+            cookie_jar = aiohttp.CookieJar(unsafe=True)
+            cookie = self.lims.get_session_cookie()
+            if cookie is not None:
+                cookie_jar.update_cookies({self.lims.session_cookie: cookie},
+                                          response_url=yarl.URL(self.lims.baseuri))
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                cookie_jar=cookie_jar,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def get_session_cookie(self):
+        "Return the value of the session cookie held, or None."
+        if self.lims.session_cookie is None:
+            return None
+        for cookie in self.session.cookie_jar:
+            if cookie.key == self.lims.session_cookie:
+                return cookie.value
+        return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def send(self, request):
+        """Exchange the request with the LIMS, and return the parsed response.
+        See genologics.protocol."""
+        credentials = '{0}:{1}'.format(self.lims.username, self.lims.password).encode('utf-8')
+        auth = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        if self.get_session_cookie() is None:
+            response = await self._send(request, auth)
+        else:
+            response = await self._send(request, None)
+            if response.status_code == 401:
+                logger.debug("LIMS session expired, authenticating again")
+                name = self.lims.session_cookie
+                self.session.cookie_jar.clear(lambda cookie: cookie.key == name)
+                if hasattr(request.data, 'seek'):
+                    # The body, such as an upload, was read by the first send
+                    request.data.seek(0)
+                response = await self._send(request, auth)
+        return request.parse(response)
+
+    async def _send(self, request, auth):
+        "Send the request, with the Authorization header auth if not None."
+        headers = dict(request.headers)
+        if auth is not None:
+            headers['authorization'] = auth
+        timeout = request.timeout if request.timeout is not None else self.timeout
+        async with self.session.request(request.method, request.uri, params=_query(request.params),
+                                        data=request.data, headers=headers,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            return protocol.Response(r.status, await r.read(), r.headers)
+
+    async def get(self, uri, params=dict()):
+        "GET data from the URI. Return the response XML as an ElementTree."
+        return await self.send(protocol.get(uri, params=params))
+
+    async def put(self, uri, data, params=dict()):
+        "PUT the serialized XML to the given URI."
+        await self.send(protocol.put(uri, data, params=params))
+
+    async def post(self, uri, data, params=dict()):
+        """POST the serialized XML to the given URI.
+        Return the response XML as an ElementTree.
+        """
+        return await self.send(protocol.post(uri, data, params=params))
+
+    async def delete(self, uri):
+        "Issue a HTTP DELETE request."
+        await self.send(protocol.delete(uri))
+
+    async def resolve_many(self, instances, force=False):
+        """Get the content of the instances with concurrent GETs, see
+        Lims.resolve_many. Returns the list of instances, in the given order.
+        """
+        instances = list(instances)
+        todo = []
+        seen = set()
+        for instance in instances:
+            if (force or instance.root is None) and instance.uri not in seen:
+                seen.add(instance.uri)
+                todo.append(instance)
+        roots = await asyncio.gather(*[self.get(instance.uri) for instance in todo])
+        for instance, root in zip(todo, roots):
+            instance.root = root
+        return instances
+
+    async def get_batch(self, instances, force=False):
+        """Get the content of a set of instances using the batch call, see
+        Lims.get_batch. Returns the list of instances, duplicates removed."""
+        instances = list(instances)
+        if not instances:
+            return []
+        request = protocol.batch_retrieve(self.lims.get_uri(instances[0].__class__._URI, 'batch/retrieve'),
+                                          instances, force=force)
+        if request is None:
+            return list(dict((instance.id, instance) for instance in instances).values())
+        return await self.send(request)
+
+    async def put_batch(self, instances):
+        "Update multiple instances using a single batch request."
+        instances = list(instances)
+        if not instances:
+            return
+        uri = self.lims.get_uri(instances[0].__class__._URI, 'batch/update')
+        await self.send(protocol.batch_update(uri, instances))
+
+    def _get_params(self, udf=dict(), udtname=None, udt=dict(), **kwargs):
+        params = self.lims._get_params(**kwargs)
+        params.update(self.lims._get_params_udf(udf=udf, udtname=udtname, udt=udt))
+        return params
+
+    async def _pages(self, klass, params):
+        """Yield the list nodes of the instances of klass, over all pages, or
+        the given start_index page only."""
+        tag = klass._TAG
+        if tag is None:
+            tag = klass.__name__.lower()
+        root = await self.get(self.lims.get_uri(klass._URI), params=params)
+        while True:
+            for node in root.findall(tag):
+                yield node
+            node = root.find('next-page')
+            if node is None or params.get('start-index') is not None:
+                break
+            root = await self.get(node.attrib['uri'])
+
+    async def iter_instances(self, klass, **kwargs):
+        """Yield the instances of klass matching the keyword arguments of the
+        corresponding Lims.get_* method, page by page."""
+        async for node in self._pages(klass, self._get_params(**kwargs)):
+            yield klass(self.lims, uri=node.attrib['uri'])
+
+    async def get_instances(self, klass, add_info=False, resolve=False, **kwargs):
+        """Get the list of instances of klass matching the keyword arguments of
+        the corresponding Lims.get_* method.
+        add_info: also return the list of the attributes of the list nodes.
+        resolve: retrieve the instances, with a batch request if klass has a
+                 batch endpoint, else with concurrent requests.
+        """
+        results = []
+        info_dicts = []
+        async for node in self._pages(klass, self._get_params(**kwargs)):
+            results.append(klass(self.lims, uri=node.attrib['uri']))
+            info_dict = dict(node.attrib)
+            for subnode in node:
+                info_dict[subnode.tag] = subnode.text
+            info_dicts.append(info_dict)
+        if resolve:
+            if issubclass(klass, BATCH_CLASSES):
+                await self.get_batch(results)
+            else:
+                await self.resolve_many(results)
+        if add_info:
+            return results, info_dicts
+        return results
+
+    async def get_artifacts(self, **kwargs):
+        "Get the list of artifacts, see Lims.get_artifacts and get_instances."
+        return await self.get_instances(Artifact, **kwargs)
+
+    def iter_artifacts(self, **kwargs):
+        "Iterate over the artifacts, see Lims.get_artifacts and iter_instances."
+        return self.iter_instances(Artifact, **kwargs)
+
+    async def get_containers(self, **kwargs):
+        "Get the list of containers, see Lims.get_containers and get_instances."
+        return await self.get_instances(Container, **kwargs)
+
+    def iter_containers(self, **kwargs):
+        "Iterate over the containers, see Lims.get_containers and iter_instances."
+        return self.iter_instances(Container, **kwargs)
+
+    async def get_container_types(self, **kwargs):
+        "Get the list of container types, see Lims.get_container_types and get_instances."
+        return await self.get_instances(Containertype, **kwargs)
+
+    def iter_container_types(self, **kwargs):
+        "Iterate over the container types, see Lims.get_container_types and iter_instances."
+        return self.iter_instances(Containertype, **kwargs)
+
+    async def get_labs(self, **kwargs):
+        "Get the list of labs, see Lims.get_labs and get_instances."
+        return await self.get_instances(Lab, **kwargs)
+
+    def iter_labs(self, **kwargs):
+        "Iterate over the labs, see Lims.get_labs and iter_instances."
+        return self.iter_instances(Lab, **kwargs)
+
+    async def get_processes(self, **kwargs):
+        "Get the list of processes, see Lims.get_processes and get_instances."
+        return await self.get_instances(Process, **kwargs)
+
+    def iter_processes(self, **kwargs):
+        "Iterate over the processes, see Lims.get_processes and iter_instances."
+        return self.iter_instances(Process, **kwargs)
+
+    async def get_process_types(self, **kwargs):
+        "Get the list of process types, see Lims.get_process_types and get_instances."
+        return await self.get_instances(Processtype, **kwargs)
+
+    def iter_process_types(self, **kwargs):
+        "Iterate over the process types, see Lims.get_process_types and iter_instances."
+        return self.iter_instances(Processtype, **kwargs)
+
+    async def get_projects(self, **kwargs):
+        "Get the list of projects, see Lims.get_projects and get_instances."
+        return await self.get_instances(Project, **kwargs)
+
+    def iter_projects(self, **kwargs):
+        "Iterate over the projects, see Lims.get_projects and iter_instances."
+        return self.iter_instances(Project, **kwargs)
+
+    async def get_protocols(self, **kwargs):
+        "Get the list of protocols, see Lims.get_protocols and get_instances."
+        return await self.get_instances(Protocol, **kwargs)
+
+    def iter_protocols(self, **kwargs):
+        "Iterate over the protocols, see Lims.get_protocols and iter_instances."
+        return self.iter_instances(Protocol, **kwargs)
+
+    async def get_reagent_kits(self, **kwargs):
+        "Get the list of reagent kits, see Lims.get_reagent_kits and get_instances."
+        return await self.get_instances(ReagentKit, **kwargs)
+
+    def iter_reagent_kits(self, **kwargs):
+        "Iterate over the reagent kits, see Lims.get_reagent_kits and iter_instances."
+        return self.iter_instances(ReagentKit, **kwargs)
+
+    async def get_reagent_lots(self, **kwargs):
+        "Get the list of reagent lots, see Lims.get_reagent_lots and get_instances."
+        return await self.get_instances(ReagentLot, **kwargs)
+
+    def iter_reagent_lots(self, **kwargs):
+        "Iterate over the reagent lots, see Lims.get_reagent_lots and iter_instances."
+        return self.iter_instances(ReagentLot, **kwargs)
+
+    async def get_reagent_types(self, **kwargs):
+        "Get the list of reagent types, see Lims.get_reagent_types and get_instances."
+        return await self.get_instances(ReagentType, **kwargs)
+
+    def iter_reagent_types(self, **kwargs):
+        "Iterate over the reagent types, see Lims.get_reagent_types and iter_instances."
+        return self.iter_instances(ReagentType, **kwargs)
+
+    async def get_researchers(self, **kwargs):
+        "Get the list of researchers, see Lims.get_researchers and get_instances."
+        return await self.get_instances(Researcher, **kwargs)
+
+    def iter_researchers(self, **kwargs):
+        "Iterate over the researchers, see Lims.get_researchers and iter_instances."
+        return self.iter_instances(Researcher, **kwargs)
+
+    async def get_samples(self, **kwargs):
+        "Get the list of samples, see Lims.get_samples and get_instances."
+        return await self.get_instances(Sample, **kwargs)
+
+    def iter_samples(self, **kwargs):
+        "Iterate over the samples, see Lims.get_samples and iter_instances."
+        return self.iter_instances(Sample, **kwargs)
+
+    async def get_udfs(self, **kwargs):
+        "Get the list of udfs, see Lims.get_udfs and get_instances."
+        return await self.get_instances(Udfconfig, **kwargs)
+
+    def iter_udfs(self, **kwargs):
+        "Iterate over the udfs, see Lims.get_udfs and iter_instances."
+        return self.iter_instances(Udfconfig, **kwargs)
+
+    async def get_workflows(self, **kwargs):
+        "Get the list of workflows, see Lims.get_workflows and get_instances."
+        return await self.get_instances(Workflow, **kwargs)
+
+    def iter_workflows(self, **kwargs):
+        "Iterate over the workflows, see Lims.get_workflows and iter_instances."
+        return self.iter_instances(Workflow, **kwargs)
@@ -1,6 +1,5 @@
 import os
 import sys
-import warnings
 
 try:
     import configparser
@@ -14,10 +13,43 @@ from genologics.config import BASEURI, USERNAME, PASSWORD
 Alternate Usage: 
 from genologics import config
 BASEURI, USERNAME, PASSWORD, VERSION, MAIN_LOG = config.load_config(specified_config = <path to config file>) 
+
+The optional mounts section maps the content locations of the files in the
+LIMS to local directories, see genologics.epp.PathResolver:
+[mounts]
+glsftp = sftp://lims.example.com/opt/gls/clarity/users/glsftp /mnt/glsftp
+
+The config file is read on the first access to one of its settings, not on
+import, so that importing the package stays cheap (Python 3.7+). Before
+Python 3.7, it is read on import if there is one. On all versions, get
+reads it on the first call, and importing the module never exits:
+from genologics import config
+MAIN_LOG = config.get('MAIN_LOG')
+
+Without a config file, load_config, get and the access to the settings
+raise a ConfigError; scripts may exit with its message:
+try:
+    from genologics.config import BASEURI, USERNAME, PASSWORD
+except config.ConfigError as e:
+    sys.exit(e)
 '''
 
 spec_config = None
 
+CONFIG_FILES = [os.path.expanduser('~/.genologicsrc'), '.genologicsrc',
+                'genologics.conf', 'genologics.cfg', '/etc/genologics.conf',
+                '/opt/gls/clarity/customextensions/genologics/genologics.conf']
+
+class ConfigError(IOError):
+    "No configuration file was found."
+
+def find_config_file():
+    "Return the first existing of the default config files, or None."
+    for config_file in CONFIG_FILES:
+        if os.path.isfile(config_file):
+            return config_file
+    return None
+
 def get_config_info(config_file):
     config = configparser.SafeConfigParser()
     config.readfp(open(config_file))
@@ -38,26 +70,60 @@ def get_config_info(config_file):
         MAIN_LOG = None
     return BASEURI, USERNAME, PASSWORD, VERSION, MAIN_LOG
         
+def get_mounts(config_file):
+    """Return the list of the (content location prefix, local directory) of
+    the mounts section of the config file."""
+    config = configparser.SafeConfigParser()
+    config.read([config_file])
+    if not config.has_section('mounts'):
+        return []
+    mounts = []
+    for name, value in config.items('mounts', raw=True):
+        prefix, directory = value.rsplit(None, 1)
+        mounts.append((prefix, directory))
+    return mounts
 
 def load_config(specified_config = None):
     if specified_config != None:
         config_file = specified_config
     else:
-        config = configparser.SafeConfigParser()
-        try:
-            conf_file = config.read([os.path.expanduser('~/.genologicsrc'), '.genologicsrc',
-                        'genologics.conf', 'genologics.cfg', '/etc/genologics.conf', '/opt/gls/clarity/customextensions/genologics/genologics.conf'])
-
-            # First config file found wins
-            config_file = conf_file[0]
-
-        except:
-            warnings.warn("Please make sure you've created or indicated your own Genologics configuration file (i.e: ~/.genologicsrc) as stated in README.md")
-            sys.exit(-1)
+        # First config file found wins
+        config_file = find_config_file()
+        if config_file is None:
+            raise ConfigError("Please make sure you've created or indicated your own Genologics configuration file (i.e: ~/.genologicsrc) as stated in README.md")
 
     BASEURI, USERNAME, PASSWORD, VERSION, MAIN_LOG = get_config_info(config_file)
 
     return BASEURI, USERNAME, PASSWORD, VERSION, MAIN_LOG   
     
 
-BASEURI, USERNAME, PASSWORD, VERSION, MAIN_LOG = load_config(specified_config = spec_config)
+SETTINGS = ('BASEURI', 'USERNAME', 'PASSWORD', 'VERSION', 'MAIN_LOG', 'MOUNTS')
+_settings = {}
+
+def load_settings():
+    "Read the config file, once, and return its settings as a dictionary."
+    if not _settings:
+        settings = dict(zip(SETTINGS[:5], load_config(specified_config = spec_config)))
+        settings['MOUNTS'] = get_mounts(spec_config or find_config_file())
+        _settings.update(settings)
+    return dict(_settings)
+
+def get(name):
+    """Return the setting name, one of SETTINGS, reading the config file on
+    the first call; the module attribute if it is set."""
+    if name not in SETTINGS:
+        raise KeyError(name)
+    if name not in globals():
+        globals()[name] = load_settings()[name]
+    return globals()[name]
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # PEP 562: called for a setting until it is a module attribute
+        if name in SETTINGS:
+            return get(name)
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+elif find_config_file():
+    # For from genologics.config import BASEURI; without a config file the
+    # settings are missing until get is called
+    globals().update(load_settings())
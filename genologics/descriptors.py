@@ -363,8 +363,7 @@ class UdfDictionaryDescriptor(BaseDescriptor):
 
     def __get__(self, instance, cls):
         instance.get()
-        self.value = UdfDictionary(instance, *self.rootkeys, udt=self._UDT)
-        return self.value
+        return UdfDictionary(instance, *self.rootkeys, udt=self._UDT)
 
     def __set__(self, instance, dict_value):
         instance.get()
@@ -390,11 +389,11 @@ class PlacementDictionaryDescriptor(TagDescriptor):
     def __get__(self, instance, cls):
         from genologics.entities import Artifact
         instance.get()
-        self.value = dict()
+        result = dict()
         for node in instance.root.findall(self.tag):
             key = node.find('value').text
-            self.value[key] = Artifact(instance.lims, uri=node.attrib['uri'])
-        return self.value
+            result[key] = Artifact(instance.lims, uri=node.attrib['uri'])
+        return result
 
 
 class ExternalidListDescriptor(BaseDescriptor):
@@ -734,15 +733,15 @@ class InputOutputMapList(BaseDescriptor):
 
     def __get__(self, instance, cls):
         instance.get()
-        self.value = []
+        result = []
         rootnode = instance.root
         for rootkey in self.rootkeys:
             rootnode = rootnode.find(rootkey)
         for node in rootnode.findall('input-output-map'):
             input = self.get_dict(instance.lims, node.find('input'))
             output = self.get_dict(instance.lims, node.find('output'))
-            self.value.append((input, output))
-        return self.value
+            result.append((input, output))
+        return result
 
     def get_dict(self, lims, node):
         from genologics.entities import Artifact, Process
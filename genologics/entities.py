@@ -6,6 +6,7 @@ Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
 Copyright (C) 2012 Per Kraulis
 """
 
+from genologics import protocol
 from genologics.constants import nsmap
 from genologics.descriptors import StringDescriptor, StringDictionaryDescriptor, UdfDictionaryDescriptor, \
     UdtDictionaryDescriptor, ExternalidListDescriptor, EntityDescriptor, BooleanDescriptor, EntityListDescriptor, \
@@ -34,8 +35,11 @@ class SampleHistory:
     AFAIK the only fields of the history that are read are proc.type and outart"""
 
     def __init__(self, sample_name=None, output_artifact=None, input_artifact=None, lims=None, pro_per_art=None,
-                 test=False):
+                 test=False, genealogy=None):
+        """pro_per_art and genealogy may be shared between the histories of many
+        samples, see genologics.genealogy.sample_histories."""
         self.processes_per_artifact = pro_per_art
+        self.genealogy = genealogy
         if lims:
             self.lims = lims
             if not (test):
@@ -72,6 +76,38 @@ class SampleHistory:
         for art in self.history_list:
             logger.info(art)
 
+    def _genealogy(self):
+        """Build the genealogy of the analytes of the sample: all of them are
+        retrieved with one batch request, and their parent processes
+        concurrently. Return the Genealogy and the set of analyte ids."""
+        from genologics.genealogy import Genealogy
+        if self.genealogy is not None and self.sample_name in self.genealogy.sample_analytes:
+            return self.genealogy, self.genealogy.sample_analytes[self.sample_name]
+        artifacts = self.lims.get_artifacts(sample_name=self.sample_name, type='Analyte', resolve=False)
+        analytes = set(a.id for a in artifacts)
+        genealogy = Genealogy(self.lims)
+        genealogy.expand_ancestors(analytes, follow=analytes.__contains__)
+        return genealogy, analytes
+
+    def _processes_using(self, genealogy, art_ids):
+        """Dictionary of artifact id -> processes using it as input, from the
+        local map if there is one, else from the LIMS, with concurrent
+        requests."""
+        result = {}
+        missing = []
+        for art_id in art_ids:
+            if self.processes_per_artifact and art_id in self.processes_per_artifact:
+                result[art_id] = self.processes_per_artifact[art_id]
+                for process in result[art_id]:
+                    genealogy.processes.setdefault(process.id, process)
+            else:
+                missing.append(art_id)
+        genealogy.expand_consumers(missing)
+        for art_id in missing:
+            result[art_id] = genealogy.processes_using(art_id)
+        genealogy.resolve_processes(sorted(set(p.id for ps in result.values() for p in ps)))
+        return result
+
     def make_sample_artifact_map(self):
         """samp_art_map: connects each output artifact for a specific sample to its
         corresponding process and input artifact assuming, for a given sample,
@@ -80,13 +116,25 @@ class SampleHistory:
         and creates an entry like this : output -> (process, input)"""
         samp_art_map = {}
         if self.sample_name:
-            artifacts = self.lims.get_artifacts(sample_name=self.sample_name, type='Analyte', resolve=False)
-            for one_art in artifacts:
-                input_arts = one_art.input_artifact_list()
-                for input_art in input_arts:
-                    for samp in input_art.samples:
-                        if samp.name == self.sample_name:
-                            samp_art_map[one_art.id] = (one_art.parent_process, input_art.id)
+            genealogy, analytes = self._genealogy()
+            pairs = []
+            for art_id in sorted(analytes):
+                process_id = genealogy.parent.get(art_id)
+                if process_id is None:
+                    continue
+                for input_id, output_id in genealogy.io_map[process_id]:
+                    if output_id == art_id:
+                        pairs.append((art_id, process_id, input_id))
+            inputs = [genealogy.artifact(input_id) for art_id, process_id, input_id in pairs]
+            self.lims.get_batch([a for a in inputs if a.root is None])
+            samples = set()
+            for input_art in inputs:
+                samples.update(input_art.samples)
+            self.lims.get_batch([s for s in samples if s.root is None])
+            for art_id, process_id, input_id in pairs:
+                for samp in genealogy.artifact(input_id).samples:
+                    if samp.name == self.sample_name:
+                        samp_art_map[art_id] = (genealogy.processes[process_id], input_id)
 
         self.art_map = samp_art_map
 
@@ -95,72 +143,42 @@ class SampleHistory:
         This one iterates over Artifact.parent_process and Process.all_inputs()
         Then, it takes all the child processes for each input (because we want
         qc processes too) and puts everything in a dictionnary.
+        The analytes of the sample and their processes are indexed in a
+        Genealogy first, so that the walk itself does not make any request.
         """
         history = {}
-        hist_list = []
-        # getting the list of all expected analytes.
-        artifacts = self.lims.get_artifacts(sample_name=self.sample_name, type='Analyte', resolve=False)
-        processes = []
-        inputs = []
+        genealogy, analytes = self._genealogy()
         if in_art:
             # If theres an input artifact given, I need to make a loop for this one, before treating it as an output
             starting_art = in_art
-            inputs.append(in_art)
-            history[in_art] = {}
-            # If there is a loacl map, use it. else, query the lims.
-            if self.processes_per_artifact and in_art in self.processes_per_artifact:
-                valid_pcs = self.processes_per_artifact[in_art]
-            else:
-                valid_pcs = self.lims.get_processes(inputartifactlimsid=in_art)
-
-            for tempProcess in valid_pcs:
-                history[in_art][tempProcess.id] = {'date': tempProcess.date_run,
-                                                   'id': tempProcess.id,
-                                                   'outart': (out_art if out_art in [out.id for out in tempProcess.all_outputs()] else None),
-                                                   'inart': in_art,
-                                                   'type': tempProcess.type.id,
-                                                   'name': tempProcess.type.name}
+            inputs = [in_art]
         else:
             starting_art = out_art
-        # main iteration
-        # it is quite heavy on logger at info level
-        not_done = True
-        while not_done:
-            logger.info("looking for " + (starting_art))
-            not_done = False
-            for o in artifacts:
-                logger.info(o.id)
-                if o.id == starting_art:
-                    if o.parent_process is None:
-                        # flow control : if there is no parent process, we can stop iterating, we're done.
-                        not_done = False
-                        break  # breaks the for artifacts, we are done anyway.
-                    else:
-                        not_done = True  # keep the loop running
-                    logger.info("found it")
-                    processes.append(o.parent_process)
-                    logger.info("looking for inputs of " + o.parent_process.id)
-                    for i in o.parent_process.all_inputs():
-                        logger.info(i.id)
-                        if i in artifacts:
-                            history[i.id] = {}
-                            for tempProcess in (self.processes_per_artifact[i.id] if self.processes_per_artifact else self.lims.get_processes(inputartifactlimsid=i.id)):  # If there is a loacl map, use it. else, query the lims.
-                                history[i.id][tempProcess.id] = {'date': tempProcess.date_run,
-                                                                 'id': tempProcess.id,
-                                                                 'outart': (
-                                                                 o.id if tempProcess.id == o.parent_process.id else None),
-                                                                 'inart': i.id,
-                                                                 'type': tempProcess.type.id,
-                                                                 'name': tempProcess.type.name}
-
-                            logger.info("found input " + i.id)
-                            inputs.append(
-                                i.id)  # this will be the sorted list of artifacts used to rebuild the history in order
-                            # while increment
-                            starting_art = i.id
-
-                            break  # break the for allinputs, if we found the right one
-                    break  # breaks the for artifacts if we matched the current one
+            inputs = []
+        # main iteration: list of (output, process, input) up to the root analyte
+        lineage = genealogy.lineage(starting_art, analytes)
+        inputs.extend(input_id for output_id, process_id, input_id in lineage)
+        processes_using = self._processes_using(genealogy, inputs)
+
+        def step_info(process, art_id, outart):
+            return {'date': process.date_run,
+                    'id': process.id,
+                    'outart': outart,
+                    'inart': art_id,
+                    'type': process.type.id,
+                    'name': process.type_name}
+
+        if in_art:
+            history[in_art] = {}
+            for process in processes_using[in_art]:
+                outputs = genealogy.outputs(process.id)
+                history[in_art][process.id] = step_info(process, in_art, out_art if out_art in outputs else None)
+        for output_id, parent_id, input_id in lineage:
+            logger.info("found input " + input_id)
+            history[input_id] = {}
+            for process in processes_using[input_id]:
+                history[input_id][process.id] = step_info(
+                    process, input_id, output_id if process.id == parent_id else None)
         self.history = history
         self.history_list = inputs
 
@@ -215,7 +233,7 @@ class SampleHistory:
         processes that the input artifact has been involved in, but that are not
         part of the historychain get the outart set to None. This is very important."""
         # Use the local process map if we have one, else, query the lims
-        for process in self.processes_per_artifact[input_art] if self.processes_per_artifact else lims.get_processes(
+        for process in self.processes_per_artifact[input_art] if self.processes_per_artifact else self.lims.get_processes(
                 inputartifactlimsid=input_art):
             # outputs = map(lambda a: (a.id), process.all_outputs())
             outputs = [a.id for a in process.all_outputs()]
@@ -233,6 +251,20 @@ class SampleHistory:
         return history, input_art
 
 
+def _restore_entity(cls, lims, uri, data):
+    """Return the instance pickled by Entity.__reduce__. It is created by
+    Entity.__new__, without calling the __new__ and __init__ of the class,
+    which may take other arguments."""
+    instance = Entity.__new__(cls, lims, uri=uri, _create_new=not uri)
+    if not uri:
+        instance.lims = lims
+        instance._uri = None
+        instance.root = None
+    if data is not None:
+        instance.root = ElementTree.fromstring(data)
+    return instance
+
+
 class Entity(object):
     "Base class for the entities in the LIMS database."
 
@@ -246,28 +278,40 @@ class Entity(object):
                 uri = lims.get_uri(cls._URI, id)
             elif _create_new:
                 # create the Object without id or uri
-                pass
+                return object.__new__(cls)
             else:
                 raise ValueError("Entity uri and id can't be both None")
-        try:
-            return lims.cache[uri]
-        except KeyError:
+        elif _create_new:
             return object.__new__(cls)
+        # Lookup and insertion are done under the lock, so that concurrent
+        # threads always get the same instance for a uri
+        with lims.cache_lock:
+            try:
+                return lims.cache[uri]
+            except KeyError:
+                instance = object.__new__(cls)
+                instance.lims = lims
+                instance._uri = uri
+                instance.root = None
+                lims.cache[uri] = instance
+                if len(lims.cache) > CACHE_N_ENTRIES:
+                    lims.cache.popitem(last=False)
+                return instance
 
     def __init__(self, lims, uri=None, id=None, _create_new=False):
         assert uri or id or _create_new
-        if not _create_new:
-            if hasattr(self, 'lims'): return
-            if not uri:
-                uri = lims.get_uri(self._URI, id)
-            lims.cache[uri] = self
-            lims.cache_list.append(uri)
-            if len(lims.cache_list) > CACHE_N_ENTRIES:
-                del lims.cache[lims.cache_list.pop(0)]
+        if hasattr(self, 'lims'): return  # initialised by __new__
         self.lims = lims
         self._uri = uri
         self.root = None
 
+    def __reduce__(self):
+        """Pickle as the class, Lims, uri and raw XML, if retrieved. On
+        unpickling the instance is looked up in the cache of the receiving
+        Lims, and its XML replaced by the one transferred."""
+        data = None if self.root is None else ElementTree.tostring(self.root)
+        return (_restore_entity, (self.__class__, self.lims, self._uri, data))
+
     def __str__(self):
         return "%s(%s)" % (self.__class__.__name__, self.id)
 
@@ -303,8 +347,8 @@ class Entity(object):
         self.lims.post(self.uri, data)
 
     def delete(self):
-        del self.lims.cache[self.uri]
-        self.lims.cache_list.remove(self.uri)
+        with self.lims.cache_lock:
+            del self.lims.cache[self.uri]
         self.lims.delete(self.uri)
 
     @classmethod
@@ -430,24 +474,24 @@ class File(Entity):
     is_published      = BooleanDescriptor('is-published')
 
     def download(self):
-        url = "{0}/download".format(self.uri)
-        response = self.lims.request_session.get(url,
-                auth=(self.lims.username, self.lims.password))
-        if response.status_code != 200:
-            raise requests.exceptions.HTTPError("Failed to upload file, status code " +
-                    str(response.status_code))
-        else:
-            return response.content
+        """Return the contents of the file, through the file cache of the
+        Lims if it has one. See download_to for large files."""
+        if self.lims.file_cache is not None:
+            return self.lims.file_cache.read(self)
+        return b''.join(self.lims.iter_download(self.uri))
 
-    def upload(self, data):
-        url = "{0}/upload".format(self.uri)
-        response = self.lims.request_session.post(
-                url, auth=(self.lims.username, self.lims.password),
-                files=dict(file=data))
+    def iter_download(self, **kwargs):
+        "Yield the contents of the file in chunks, see Lims.iter_download."
+        return self.lims.iter_download(self.uri, **kwargs)
+
+    def download_to(self, path, **kwargs):
+        "Download the file to the path, see Lims.download_to."
+        return self.lims.download_to(self.uri, path, **kwargs)
 
-        if response.status_code != 200:
-            raise requests.exceptions.HTTPError("Failed to upload file, status code " +
-                    str(response.status_code))
+    def upload(self, data):
+        """Upload the data, bytes, text or an open file, as the contents of
+        the file. See Lims.upload_files for files on disk."""
+        self.lims.send(protocol.upload_data("{0}/upload".format(self.uri), data))
 
 
 class Project(Entity):
@@ -615,6 +659,8 @@ class Process(Entity):
     def all_inputs(self, unique=True, resolve=False):
         """Retrieving all input artifacts from input_output_maps
         if unique is true, no duplicates are returned.
+        The artifacts are in input-output map order; if resolve is true,
+        they are retrieved with one batch request.
         """
         # if the process has no input, that is not standard and we want to know about it
         try:
@@ -622,34 +668,35 @@ class Process(Entity):
         except TypeError:
             logger.error("Process ", self, " has no input artifacts")
             raise TypeError
-        if unique:
-            ids = list(frozenset(ids))
-        if resolve:
-            return self.lims.get_batch([Artifact(self.lims, id=id) for id in ids if id is not None])
-        else:
-            return [Artifact(self.lims, id=id) for id in ids if id is not None]
+        return self._artifacts(ids, unique, resolve)
 
     def all_outputs(self, unique=True, resolve=False):
         """Retrieving all output artifacts from input_output_maps
         if unique is true, no duplicates are returned.
+        The artifacts are in input-output map order; if resolve is true,
+        they are retrieved with one batch request.
         """
         # Given how ids is structured, io[1] might be None : some process don't have an output.
         ids = [io[1]['limsid'] for io in self.input_output_maps if io[1] is not None]
+        return self._artifacts(ids, unique, resolve)
+
+    def _artifacts(self, ids, unique, resolve):
         if unique:
-            ids = list(frozenset(ids))
+            seen = set()
+            ids = [id for id in ids if not (id in seen or seen.add(id))]
+        artifacts = [Artifact(self.lims, id=id) for id in ids if id is not None]
         if resolve:
-            return self.lims.get_batch([Artifact(self.lims, id=id) for id in ids if id is not None])
-        else:
-            return [Artifact(self.lims, id=id) for id in ids if id is not None]
+            self.lims.get_batch(artifacts)
+        return artifacts
 
     def shared_result_files(self):
         """Retreve all resultfiles of output-generation-type PerAllInputs."""
-        artifacts = self.all_outputs(unique=True)
+        artifacts = self.all_outputs(unique=True, resolve=True)
         return [a for a in artifacts if a.output_type == 'SharedResultFile']
 
     def result_files(self):
         """Retreve all resultfiles of output-generation-type perInput."""
-        artifacts = self.all_outputs(unique=True)
+        artifacts = self.all_outputs(unique=True, resolve=True)
         return [a for a in artifacts if a.output_type == 'ResultFile']
 
     def analytes(self):
@@ -658,25 +705,25 @@ class Process(Entity):
         analytes are returned. Input/Output is returned as a information string.
         Makes aggregate processes and normal processes look the same."""
         info = 'Output'
-        artifacts = self.all_outputs(unique=True)
+        artifacts = self.all_outputs(unique=True, resolve=True)
         analytes = [a for a in artifacts if a.type == 'Analyte']
         if len(analytes) == 0:
-            artifacts = self.all_inputs(unique=True)
+            artifacts = self.all_inputs(unique=True, resolve=True)
             analytes = [a for a in artifacts if a.type == 'Analyte']
             info = 'Input'
         return analytes, info
 
     def parent_processes(self):
         """Retrieving all parent processes through the input artifacts"""
-        return [i_a.parent_process for i_a in self.all_inputs(unique=True)]
+        return [i_a.parent_process for i_a in self.all_inputs(unique=True, resolve=True)]
 
     def output_containers(self):
-        """Retrieve all unique output containers"""
+        """Retrieve all unique output containers, in output order"""
         cs = []
-        for o_a in self.all_outputs(unique=True):
-            if o_a.container:
+        for o_a in self.all_outputs(unique=True, resolve=True):
+            if o_a.container and o_a.container not in cs:
                 cs.append(o_a.container)
-        return list(frozenset(cs))
+        return cs
 
     @property
     def step(self):
@@ -10,15 +10,35 @@ Copyright (C) 2013 Johannes Alneberg
 import logging
 import sys
 import os
-import pkg_resources
-from pkg_resources import DistributionNotFound
-from shutil import copy
+from shutil import copy, rmtree
 from requests import HTTPError
-from genologics.entities import Artifact
-from genologics.config import MAIN_LOG
+from genologics.entities import Artifact, Container, Process, Sample, Step
+from genologics import config
+from genologics.version import __version__
 from logging.handlers import RotatingFileHandler
+try:
+    from logging.handlers import QueueHandler, QueueListener
+    from queue import Queue
+except ImportError: # Python 2
+    QueueHandler = QueueListener = None
 from time import strftime, localtime
+from array import array
+from collections import OrderedDict
 import csv
+import re
+import tempfile
+from xml.etree import ElementTree
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# python 2.7, 3+ compatibility
+if sys.version_info[0] == 2:
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
 
 def attach_file(src,resource):
     """Attach file at src to given resource
@@ -47,6 +67,86 @@ def unique_check(l,msg):
     elif len(l)!=1:
         raise NotUniqueError("Multiple items found for {0}".format(msg))
 
+class PathResolver(object):
+    """Resolve the content locations of the files in the LIMS, such as
+    sftp://lims.example.com/opt/gls/clarity/users/glsftp/..., to local paths.
+
+    mounts: list of (content location prefix, local directory), by default
+            those of the mounts section of the config file, if there is
+            one. Without a matching mount, the path of the content
+            location is tried, as on the LIMS server itself.
+    lims:   Lims through which the files not found locally are downloaded.
+
+    The existence of the local paths is checked once per resolver. Close
+    the resolver, or use it as a context manager, to remove the downloaded
+    files."""
+
+    def __init__(self, mounts=None, lims=None):
+        if mounts is None:
+            if 'MOUNTS' in vars(config) or config.spec_config or config.find_config_file():
+                mounts = config.get('MOUNTS')
+            else:
+                # No config file to read: no mounts
+                mounts = []
+        # Longest prefix first
+        self.mounts = sorted(((prefix.rstrip('/'), directory) for prefix, directory in mounts),
+                             key=lambda mount: -len(mount[0]))
+        self.lims = lims
+        self._exists = {}
+        self._download_dir = None
+
+    def exists(self, path):
+        if path not in self._exists:
+            self._exists[path] = os.path.isfile(path)
+        return self._exists[path]
+
+    def local_path(self, content_location):
+        "Return the local path of the content location, or None."
+        for prefix, directory in self.mounts:
+            if content_location == prefix or content_location.startswith(prefix + '/'):
+                path = os.path.join(directory, content_location[len(prefix):].lstrip('/'))
+                if self.exists(path):
+                    return path
+        path = urlparse(content_location).path
+        if path and self.exists(path):
+            return path
+        return None
+
+    def path(self, file):
+        """Return the local path of the contents of the File, downloading them
+        to a temporary directory if they are not found locally."""
+        path = self.local_path(file.content_location)
+        if path is not None:
+            return path
+        if self.lims is None:
+            raise IOError("{0} not found locally".format(file.content_location))
+        if self._download_dir is None:
+            self._download_dir = tempfile.mkdtemp(prefix='genologics-')
+        path = os.path.join(self._download_dir, '{0}_{1}'.format(
+            file.id, re.sub(r'[^\w.-]', '_', file.content_location.split('/')[-1])))
+        if not self.exists(path):
+            file.download_to(path)
+            self._exists[path] = True
+        return path
+
+    def open(self, file, mode='r'):
+        "Open the contents of the File, see path."
+        return open(self.path(file), mode)
+
+    def close(self):
+        "Remove the files downloaded by path."
+        if self._download_dir is not None:
+            rmtree(self._download_dir, ignore_errors=True)
+            self._download_dir = None
+            self._exists.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
 def set_field(element):    
     try:
         element.put()
@@ -66,6 +166,12 @@ class EppLogger(object):
     of the same process from the genologics LIMS GUI, the previous log 
     files can be prepended. Also a main log file can be used that is
     supposed to be common for all scripts executed on the server.
+
+    With asynchronous logging, the records are written to the log files by
+    a background thread, so that chatty scripts do not wait on the files.
+    The stdout and stderr lines are logged once complete. Leaving the CM,
+    also on an exception, flushes all the records and restores stdout and
+    stderr.
     
     """
 
@@ -73,26 +179,34 @@ class EppLogger(object):
     def __enter__(self):
         logging.info('Executing file: {0}'.format(sys.argv[0]))
         logging.info('with parameters: {0}'.format(sys.argv[1:]))
-        try:
-            logging.info('Version of {0}: '.format(self.PACKAGE) + 
-                         pkg_resources.require(self.PACKAGE)[0].version)
-        except DistributionNotFound as e:
-            logging.error(e)
-            logging.error(('Make sure you have the {0} '
-                           'package installed').format(self.PACKAGE))
-            sys.exit(-1)
+        logging.info('Version of {0}: {1}'.format(self.PACKAGE, __version__))
         return self
 
     def __exit__(self,exc_type,exc_val,exc_tb):
-        # If no exception has occured in block, turn off logging.
-        if not exc_type:
-            logging.shutdown()
+        try:
+            self.slo.flush()
+            self.sle.flush()
+        finally:
             sys.stderr = self.saved_stderr
             sys.stdout = self.saved_stdout
+            if self.listener is not None:
+                # Write the queued records, and log synchronously from now on
+                self.listener.stop()
+                self.listener = None
+                self.logger.removeHandler(self.queue_handler)
+                for handler in self.handlers:
+                    self.logger.addHandler(handler)
+            # If no exception has occured in block, turn off logging.
+            if not exc_type:
+                logging.shutdown()
+            else:
+                for handler in self.handlers:
+                    handler.flush()
         # Do not repress possible exception
         return False
 
-    def __init__(self,log_file=None,level=logging.INFO,lims=None,prepend=False):
+    def __init__(self,log_file=None,level=logging.INFO,lims=None,prepend=False,
+                 asynchronous=False):
         """ Initialize the logger with custom settings.
 
         Arguments:
@@ -102,6 +216,8 @@ class EppLogger(object):
         level   -- Logging level, default logging.INFO
         lims    -- Lims instance, needed for prepend to work
         prepend -- If True, prepend old log file to new, requires lims
+        asynchronous -- If True, write the log files in a background thread
+                        (Python 3)
         """
         self.lims = lims
         self.log_file = log_file
@@ -129,19 +245,33 @@ class EppLogger(object):
         self.logger.setLevel(self.level)
         formatter = logging.Formatter(
             '%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+        self.handlers = []
         if self.log_file:
             individual_fh = logging.FileHandler(self.log_file,mode='a')
             individual_fh.setFormatter(formatter)
-            self.logger.addHandler(individual_fh)
+            self.handlers.append(individual_fh)
 
-        if MAIN_LOG:
+        main_log = config.get('MAIN_LOG')
+        if main_log:
             # Rotating file handler, that will create up to 10 backup logs,
             # each no bigger than 100MB.
-            main_fh = RotatingFileHandler(MAIN_LOG,mode='a',
+            main_fh = RotatingFileHandler(main_log,mode='a',
                                           maxBytes=1e8,backupCount=10)
             main_fh.setFormatter(formatter)
-            self.logger.addHandler(main_fh)
+            self.handlers.append(main_fh)
+
+        self.listener = None
+        if asynchronous and QueueHandler is not None and self.handlers:
+            log_queue = Queue()
+            self.queue_handler = QueueHandler(log_queue)
+            self.logger.addHandler(self.queue_handler)
+            self.listener = QueueListener(log_queue, *self.handlers,
+                                          respect_handler_level=True)
+            self.listener.start()
         else:
+            for handler in self.handlers:
+                self.logger.addHandler(handler)
+        if not main_log:
             self.logger.warning('No main log file found.')
 
     def prepend_old_log(self, external_log_file = None):
@@ -165,9 +295,11 @@ class EppLogger(object):
                 log_artifact = Artifact(self.lims,id = log_file_name)
                 log_artifact.get()
                 if log_artifact.files:
-                    log_path = log_artifact.files[0].content_location.split(
-                        self.lims.baseuri.split(':')[1])[1]
-                    copy(log_path, local_log_path)
+                    # Reported if it cannot be resolved
+                    log_path = log_artifact.files[0].content_location
+                    with PathResolver(lims=self.lims) as resolver:
+                        log_path = resolver.path(log_artifact.files[0])
+                        copy(log_path, local_log_path)
                     with open(local_log_path,'a') as f:
                         f.write('='*80+'\n')
             except HTTPError: # Probably no artifact found, skip prepending
@@ -197,109 +329,441 @@ class EppLogger(object):
         def write(self, buf):
             if self.stream:
                 self.stream.write(buf)
-            for line in buf.rstrip().splitlines():
-                self.logger.log(self.log_level, line.rstrip())
+            # Log the complete lines only, keeping the last one if partial
+            lines = (self.linebuf + buf).split('\n')
+            self.linebuf = lines.pop()
+            if lines and self.logger.isEnabledFor(self.log_level):
+                for line in lines:
+                    line = line.rstrip()
+                    if line:
+                        self.logger.log(self.log_level, line)
+
+        def flush(self):
+            "Log the partial line, and flush the duplicated stream."
+            if self.linebuf.rstrip():
+                self.logger.log(self.log_level, self.linebuf.rstrip())
+            self.linebuf = ''
+            if self.stream:
+                self.stream.flush()
+
+def iter_rows(file_path):
+    """Yield the rows of a csv, or tab separated txt, file as lists of
+    strings, reading the file line by line."""
+    with open(file_path, 'r') as of:
+        if file_path.split('.')[-1] == 'csv':
+            for row in csv.reader(of):
+                yield row
+        else:
+            for line in of:
+                yield line.strip().strip('\\').split('\t')
+
+def _column_names(keys):
+    """Return the unique column names of the header keys. As in format_table,
+    an unnamed column belongs to the named one before it: the second column
+    of a name, or an unnamed one following it, is name.1, then name.2..."""
+    names = []
+    counts = {}
+    base = ''
+    for key in keys:
+        if key != '' or not names:
+            base = key
+        n = counts.get(base, 0)
+        name = base if n == 0 else '{0}.{1}'.format(base, n)
+        while name in names:
+            n += 1
+            name = '{0}.{1}'.format(base, n)
+        counts[base] = n + 1
+        names.append(name)
+    return names
+
+def read_columns(rows, header_row=0, types=None, int_fill=None):
+    """Read the rows below the header row as columns.
+
+    Arguments and Output:
+        rows        Iterable of rows, such as iter_rows(file_path).
+        header_row  Number of the row with the column names.
+        types       Dict of column name to type, int, float or a function of
+                    the string value. The int and float columns are arrays,
+                    the other columns lists of strings. The type of a
+                    repeated name applies to all its columns.
+        int_fill    Value of the empty cells of the int columns. By default
+                    they raise a ValueError; in the float columns they are
+                    NaN.
+        columns     OrderedDict of column name to column, see _column_names
+                    for the repeated and unnamed columns. Rows shorter than
+                    the header are padded with empty values."""
+    types = types or {}
+    columns = OrderedDict()
+    converters = []
+    for row, line in enumerate(rows):
+        if row < header_row:
+            continue
+        if row == header_row:
+            for key, name in zip(line, _column_names(line)):
+                kind = types.get(name, types.get(key) if key != '' else None)
+                if kind is float:
+                    columns[name] = array('d')
+                elif kind is int:
+                    columns[name] = array('l')
+                else:
+                    columns[name] = []
+                converters.append((name, columns[name], kind))
+            continue
+        for col, (name, column, kind) in enumerate(converters):
+            value = line[col] if col < len(line) else ''
+            if kind is None:
+                column.append(value)
+            elif value == '' and kind is float:
+                column.append(float('nan'))
+            elif value == '' and kind is int and int_fill is not None:
+                column.append(int_fill)
+            else:
+                try:
+                    column.append(kind(value))
+                except ValueError as e:
+                    raise ValueError("Row {0}, column {1!r}: {2}".format(row, name, e))
+    return columns
+
+class ParsedFiles(Mapping):
+    """Lazy dict of output artifact name to the parsed result file of the
+    output, as lists of lists. A file is parsed when first accessed."""
+
+    def __init__(self, result_files, output_type):
+        self.result_files = result_files
+        self.output_type = output_type
+        self._parsed = {}
+
+    def __getitem__(self, name):
+        if name not in self._parsed:
+            file = self.result_files.files(self.output_type)[name]
+            self._parsed[name] = list(iter_rows(self.result_files.resolver.path(file)))
+        return self._parsed[name]
+
+    def __iter__(self):
+        return iter(self.result_files.files(self.output_type))
+
+    def __len__(self):
+        return len(self.result_files.files(self.output_type))
 
 class ReadResultFiles():
     """Class to read pars different kinds of result files from a process.
-    The class stores the parsed content of all shared result files in a 
-    dictionary 'shared_files'. The data is parsed as lists of lists. """
-
-    def __init__(self, process):
+    The class gives the parsed content of all shared result files in a 
+    dictionary 'shared_files', and of the per input result files in
+    'perinput_files'. The data is parsed as lists of lists, when first
+    accessed. For large files, iter_rows and columns read a file row by
+    row instead. Close it, or use it as a context manager, to remove the
+    files it downloaded, see PathResolver. """
+
+    def __init__(self, process, resolver=None):
         self.process = process
-        self.shared_files = self._pars_file('SharedResultFile')
-        self.perinput_files = self._pars_file('ResultFile')
+        # The resolver given is closed by its owner
+        self._own_resolver = resolver is None
+        self.resolver = resolver or PathResolver(lims=process.lims)
+        self._outputs = None
+        self._files = {}
+        self.shared_files = ParsedFiles(self, 'SharedResultFile')
+        self.perinput_files = ParsedFiles(self, 'ResultFile')
+
+    def close(self):
+        if self._own_resolver:
+            self.resolver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
 
     def get_file_path(self, artifact):
+        """Return the local path of the file of the artifact, or else the
+        path of its content location, if it has an extension; None
+        otherwise. The file is not downloaded."""
         if len(artifact.files) > 0:
             file = artifact.files[0]
-            file_path = file.content_location.split('scilifelab.se')[1]
-            if len(file_path.split('.')) > 1:
-                return file_path
+            file_path = urlparse(file.content_location).path
+            if len(os.path.basename(file_path).split('.')) > 1:
+                return self.resolver.local_path(file.content_location) or file_path
         return None
 
-    def _pars_file(self, output_type):
-        """Reads a csv or txt into a list of lists, where sub lists are lines 
-        of the csv."""
-        outs = self.process.all_outputs()
-        outarts = [a for a in outs if a.output_type == output_type]
-        parsed_files = {}
-        for outart in outarts:
-            file_path = self.get_file_path(outart)
-            if file_path:
-                of = open(file_path ,'r')
-                file_ext = file_path.split('.')[-1]
-                if file_ext == 'csv':
-                    pf = [row for row in csv.reader(of.read().splitlines())]
-                    parsed_files[outart.name] = pf
-                elif file_ext == 'txt':
-                    pf = [row.strip().strip('\\').split('\t') for row in of.readlines()]
-                    parsed_files[outart.name] = pf
-                of.close()
-        return parsed_files
+    def outputs(self):
+        """Output artifacts of the process, and their files, retrieved with
+        one batch request each."""
+        if self._outputs is None:
+            outputs = self.process.all_outputs(resolve=True)
+            files = [f for a in outputs for f in a.files[:1]]
+            if files:
+                self.process.lims.get_batch(files)
+            self._outputs = outputs
+        return self._outputs
+
+    def files(self, output_type):
+        """OrderedDict of output artifact name to its csv or txt result File,
+        for the outputs of the output type."""
+        if output_type not in self._files:
+            files = OrderedDict()
+            for outart in self.outputs():
+                if outart.output_type == output_type and outart.files:
+                    file = outart.files[0]
+                    if file.content_location.split('.')[-1] in ('csv', 'txt'):
+                        files[outart.name] = file
+            self._files[output_type] = files
+        return self._files[output_type]
+
+    def _file_path(self, name):
+        for output_type in ('SharedResultFile', 'ResultFile'):
+            files = self.files(output_type)
+            if name in files:
+                return self.resolver.path(files[name])
+        raise KeyError(name)
+
+    def iter_rows(self, name):
+        """Yield the rows of the result file of the output named name, as
+        lists of strings."""
+        return iter_rows(self._file_path(name))
+
+    def columns(self, name, header_row=0, types=None, int_fill=None):
+        """Read the result file of the output named name as columns, see
+        read_columns."""
+        return read_columns(self.iter_rows(name), header_row=header_row, types=types,
+                            int_fill=int_fill)
 
     def format_file(self, parsed_file, name = '', first_header = None, 
-                    header_row = None, root_key_col = 0, find_keys = []):
-        """Function to format a parsed csv or txt file.
-
-        Arguments and Output:
-            parsed_file     A list of lists where sublists are rows of the csv.
-            name            Name of parsed file. 
-            first_header    First column of the heather section in the file. 
-                            default value is 'None'
-            root_key_col    If you want the root keys to be given by some other 
-                            column than the first one, set root_key_col to the 
-                            column number.
-            header_row      Instead of specifying first_header you can choose 
-                            from what line to reed by setting header_row to the 
-                            row number where you want to start reading.
-            find_keys       List of row names to look for. Will exclude all 
-                            others.
-            file_info       Dict of dicts. Keys of root dict are the first 
-                            column in the csv starting from the line after the 
-                            heather line. Keys of sub dicts are the columns of 
-                            the heather line."""
-        file_info = {}
-        keys = []
-        error_message = ''
-        duplicated_lines = []
-        exeptions = ['Sample','Fail', '']
-        if type(first_header) is not list:
-            if first_header:
-                first_header=[first_header]
+                    header_row = None, root_key_col = 0, find_keys = [],
+                    types = None):
+        """Function to format a parsed csv or txt file, see format_table.
+        Raises a FormatError if the file cannot be formatted."""
+        return format_table(parsed_file, name=name, first_header=first_header,
+                            header_row=header_row, root_key_col=root_key_col,
+                            find_keys=find_keys, types=types)
+
+
+def _unique(entities):
+    "The entities without duplicates, in order."
+    seen = set()
+    return [e for e in entities if not (e.uri in seen or seen.add(e.uri))]
+
+
+class EppContext(object):
+    """Context manager loading the working set of an EPP script: the
+    process of the given id and its step (None if the process was not run
+    in a step), the input and output artifacts, and their samples,
+    containers and projects. They are retrieved with batch and concurrent
+    requests, instead of one GET each, and are the usual entity instances
+    of the lims, available as attributes.
+
+    On leaving the CM without an exception, the entities modified in the
+    block are written back: the artifacts, samples and containers with one
+    batch update per kind, the process and the projects with a PUT each.
+    The step is not written back.
+
+    with EppContext(lims, process_id) as context:
+        for artifact in context.outputs:
+            artifact.udf['Conc'] = ...
+    """
+
+    # Entities updated through their batch/update endpoint
+    BATCH_CLASSES = (Artifact, Sample, Container)
+
+    def __init__(self, lims, process_id):
+        self.lims = lims
+        self.process = Process(lims, id=process_id)
+        self.step = Step(lims, id=process_id)
+        self.inputs = []
+        self.outputs = []
+        self.samples = []
+        self.containers = []
+        self.projects = []
+        self._snapshots = {}
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not exc_type:
+            self.save()
+        # Do not repress possible exception
+        return False
+
+    @property
+    def artifacts(self):
+        "The input and output artifacts, without duplicates."
+        return _unique(self.inputs + self.outputs)
+
+    def entities(self):
+        "The entities written back by save when modified."
+        return ([self.process] + self.artifacts + self.samples +
+                self.containers + self.projects)
+
+    def load(self):
+        """Retrieve the working set, in as many requests as there are
+        projects plus five, and record its state for save."""
+        self.process.get()
+        self.step = Step(self.lims, id=self.process.id)
+        try:
+            self.step.get()
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            self.step = None
+        self.inputs = self.process.all_inputs(unique=True)
+        self.outputs = self.process.all_outputs(unique=True)
+        self.lims.get_batch(self.artifacts)
+        self.samples = _unique(s for a in self.artifacts for s in a.samples)
+        self.containers = _unique(a.container for a in self.artifacts
+                                  if a.container is not None)
+        self.lims.get_batch(self.samples)
+        self.lims.get_batch(self.containers)
+        self.projects = _unique(s.project for s in self.samples
+                                if s.project is not None)
+        self.lims.resolve_many(self.projects)
+        self._snapshots = dict((e.uri, ElementTree.tostring(e.root))
+                               for e in self.entities())
+        return self
+
+    def modified(self):
+        "The entities modified since they were loaded, or last saved."
+        return [e for e in self.entities()
+                if ElementTree.tostring(e.root) != self._snapshots.get(e.uri)]
+
+    def save(self):
+        "Write back the modified entities, and return them."
+        modified = self.modified()
+        by_class = OrderedDict()
+        for entity in modified:
+            by_class.setdefault(entity.__class__, []).append(entity)
+        for klass, entities in by_class.items():
+            if klass in self.BATCH_CLASSES:
+                self.lims.put_batch(entities)
             else:
-                first_header=[]
-        for row, line in enumerate(parsed_file):
-            if keys and len(line)==len(keys):
-                root_key = line[root_key_col]
-                cond1 = find_keys == [] and root_key not in exeptions
-                cond2 = root_key in find_keys
-                if root_key in file_info:
-                    duplicated_lines.append(root_key)
-                elif (cond1 or cond2): 
-                    file_info[root_key] = {}
-                    if not duplicated_lines:
-                        for col in range(len(keys)):
-                            if keys[col] != '':
-                                file_info[root_key][keys[col]] = line[col]
-                            elif keys[col-1] != '':
-                                tupl = (file_info[root_key][keys[col-1]], line[col])
-                                file_info[root_key][keys[col-1]] = tupl
-        
-            head = line[root_key_col] if len(line) > root_key_col else None
-            if first_header and head in first_header:
-                keys = line
-            elif header_row and row == header_row:
-                keys = line
-        if duplicated_lines:
-            error_message = ("Row names {0} occurs more than once in file {1}. "
-                "Fix the file to continue. ").format(','.join(duplicated_lines), name)
-        if not file_info:
-            error_message = error_message + "Could not format parsed file {0}.".format(name)
-        if error_message:
-            print(error_message, file=sys.stderr)
-            sys.exit(-1)    
-        return file_info
+                for entity in entities:
+                    entity.put()
+        for entity in modified:
+            self._snapshots[entity.uri] = ElementTree.tostring(entity.root)
+        return modified
+
+
+class FormatError(ValueError):
+    """Raised if a parsed file cannot be formatted: duplicates is the list of
+    the row names occurring more than once, empty is true if no row was
+    found."""
+
+    def __init__(self, message, name='', duplicates=(), empty=False):
+        super(FormatError, self).__init__(message)
+        self.name = name
+        self.duplicates = list(duplicates)
+        self.empty = empty
+
+def _column_plan(keys, types):
+    """Return the list of (column, key, merge, convert) of the header keys:
+    an unnamed column following a named one is merged with it as a tuple,
+    its values unconverted."""
+    plan = []
+    for col, key in enumerate(keys):
+        if key != '':
+            plan.append((col, key, False, types.get(key)))
+        elif keys[col-1] != '':
+            plan.append((col, keys[col-1], True, None))
+    return plan
+
+def format_table(rows, name = '', first_header = None, header_row = None,
+                 root_key_col = 0, find_keys = (), types = None,
+                 exceptions = ('Sample', 'Fail', '')):
+    """Format the rows of a parsed csv or txt file as a table keyed by row
+    name, in a single pass.
+
+    Arguments and Output:
+        rows            Iterable of rows, lists of strings, such as a parsed
+                        file or iter_rows(file_path).
+        name            Name of parsed file, used in the error messages.
+        first_header    Value, or list of values, of the root key column of
+                        the header line(s) of the file.
+        header_row      Instead of specifying first_header you can choose 
+                        from what line to reed by setting header_row to the 
+                        row number of the header line.
+        root_key_col    If you want the root keys to be given by some other 
+                        column than the first one, set root_key_col to the 
+                        column number.
+        find_keys       Row names to look for. Will exclude all others.
+        types           Dict of column name to a function of the string value,
+                        such as float, applied to the values of the column.
+        exceptions      Row names excluded when find_keys is empty.
+        table           Dict of dicts. Keys of root dict are the root key
+                        column of the rows following the header line, with
+                        as many columns. Keys of sub dicts are the columns of 
+                        the header line.
+
+    Raises a FormatError if a row name occurs more than once, if no row was
+    found, or if a value cannot be converted to the type of its column."""
+    if isinstance(first_header, (list, tuple, set, frozenset)):
+        first_header = frozenset(first_header)
+    elif first_header:
+        first_header = frozenset([first_header])
+    else:
+        first_header = frozenset()
+    find_keys = frozenset(find_keys)
+    exceptions = frozenset(exceptions)
+    types = types or {}
+    table = {}
+    duplicated_lines = []
+    n_keys = 0
+    plan = None
+    for row, line in enumerate(rows):
+        if n_keys and len(line) == n_keys:
+            root_key = line[root_key_col]
+            if root_key in table:
+                duplicated_lines.append(root_key)
+            elif root_key in find_keys if find_keys else root_key not in exceptions:
+                values = {}
+                for col, key, merge, convert in plan:
+                    value = line[col]
+                    if convert is not None:
+                        try:
+                            value = convert(value)
+                        except ValueError as e:
+                            raise FormatError("Could not convert {0} of row {1}, column {2} in file {3}: {4}".format(
+                                repr(value), root_key, key, name, e), name=name)
+                    if merge:
+                        values[key] = (values[key], value)
+                    else:
+                        values[key] = value
+                table[root_key] = values
+
+        if (first_header and len(line) > root_key_col and line[root_key_col] in first_header) \
+                or (header_row is not None and row == header_row):
+            n_keys = len(line)
+            plan = _column_plan(line, types)
+    error_message = ''
+    if duplicated_lines:
+        error_message = ("Row names {0} occurs more than once in file {1}. "
+            "Fix the file to continue. ").format(','.join(duplicated_lines), name)
+    if not table:
+        error_message = error_message + "Could not format parsed file {0}.".format(name)
+    if error_message:
+        raise FormatError(error_message, name=name, duplicates=duplicated_lines,
+                          empty=not table)
+    return table
+
+def table_to_array(table, columns=None, key_name='key'):
+    """Return the table of format_table as a NumPy structured array, with a
+    record per row: the row name as the key_name field, then the columns,
+    by default those of the first row. The columns of float or int values
+    get a numeric type. Requires numpy."""
+    import numpy
+    keys = sorted(table)
+    if columns is None:
+        columns = list(table[keys[0]]) if keys else []
+    dtype = [(key_name, 'U{0}'.format(max([len(k) for k in keys] or [1])))]
+    for column in columns:
+        values = [table[k].get(column) for k in keys]
+        if values and all(isinstance(v, float) for v in values):
+            dtype.append((column, 'f8'))
+        elif values and all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            dtype.append((column, 'i8'))
+        else:
+            dtype.append((column, 'O'))
+    return numpy.array([tuple([k] + [table[k].get(c) for c in columns]) for k in keys], dtype=dtype)
 
 
 class CopyField(object):
@@ -0,0 +1,254 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Local cache of the contents of the files attached in the LIMS.
+
+The contents are stored by their SHA-256 digest, and found by the limsid of
+the File and a validator of its contents: the ETag, Last-Modified or
+Content-Length header of the download, obtained with a HEAD request. A file
+is thus downloaded again only when it has changed, and identical files are
+stored once. The validator of a file is reused for max_age seconds, so that
+repeated reads of a file do not each cost a HEAD request. The cache is
+bounded in size, the least recently used contents being evicted first,
+along with the keys leading to them.
+
+Several processes may share the cache directory: the contents are written
+to a temporary file and renamed into place, and on POSIX systems file
+locks keep one process from downloading a file another one is
+downloading, and from evicting a file another one is opening.
+
+Usage:
+lims.file_cache = FileCache(lims, '/scratch/lims-files', max_size=10 * 2**30)
+data = File(lims, id='40-1234').download()      # through the cache
+with lims.file_cache.open(file) as f:
+    ...
+"""
+
+import errno
+import hashlib
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from genologics import protocol
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default maximum size of the cache, in bytes
+MAX_SIZE = 2 ** 30
+
+# Default time during which the validator of a file is reused, in seconds
+MAX_AGE = 60
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _replace(source, destination):
+    "Rename atomically, replacing the destination."
+    getattr(os, 'replace', os.rename)(source, destination)
+
+
+class FileCache(object):
+    """Content-addressed cache of the downloads of the files of the lims,
+    in the directory, of at most max_size bytes. A file modified in the LIMS
+    may be read from the cache up to max_age seconds after its previous
+    read; 0 checks its validator at each read."""
+
+    def __init__(self, lims, directory, max_size=MAX_SIZE, max_age=MAX_AGE, clock=time.time):
+        self.lims = lims
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.clock = clock
+        # File id -> (validator, time it was obtained)
+        self._validators = dict()
+        for name in ('keys', 'objects', 'tmp'):
+            _makedirs(os.path.join(directory, name))
+
+    @contextmanager
+    def _lock(self, name, shared=False):
+        "Hold the file lock of the name; a no-op without fcntl."
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, name + '.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    def validator(self, file):
+        """Return the validator of the current contents of the File: its
+        ETag, Last-Modified or Content-Length, else its content location.
+        It is obtained with a HEAD request, unless one was made less than
+        max_age seconds ago."""
+        now = self.clock()
+        validator, obtained = self._validators.get(file.id, (None, None))
+        if validator is not None and now - obtained < self.max_age:
+            return validator
+        validator = self._head_validator(file)
+        self._validators[file.id] = (validator, now)
+        return validator
+
+    def _head_validator(self, file):
+        headers = self.lims.send(protocol.download_validators(file.uri))
+        for key in ('etag', 'last-modified', 'content-length'):
+            if headers.get(key):
+                return '{0}: {1}'.format(key, headers[key])
+        return 'content-location: {0}'.format(file.content_location)
+
+    def _key_path(self, file, validator):
+        return os.path.join(self.directory, 'keys', '{0}.{1}'.format(
+            file.id, hashlib.sha1(validator.encode('utf-8')).hexdigest()))
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def _lookup(self, key_path):
+        "Return the path of the contents of the key, or None."
+        try:
+            with open(key_path) as keyfile:
+                path = self._object_path(keyfile.read().strip())
+        except (IOError, OSError):
+            return None
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def _write(self, path, data):
+        tmp = os.path.join(self.directory, 'tmp', uuid.uuid4().hex)
+        with open(tmp, 'w') as outfile:
+            outfile.write(data)
+        _replace(tmp, path)
+
+    def _fetch(self, file):
+        """Return the path of the cached contents of the File, downloading
+        them if needed, and whether they were downloaded."""
+        key_path = self._key_path(file, self.validator(file))
+        path = self._lookup(key_path)
+        if path is not None:
+            self._touch(path)
+            return path, False
+        with self._lock('keys/' + os.path.basename(key_path)):
+            # Another process may have downloaded it meanwhile
+            path = self._lookup(key_path)
+            if path is not None:
+                self._touch(path)
+                return path, False
+            tmp = os.path.join(self.directory, 'tmp', uuid.uuid4().hex)
+            digest = hashlib.sha256()
+            try:
+                with open(tmp, 'wb') as outfile:
+                    for chunk in self.lims.iter_download(file.uri):
+                        outfile.write(chunk)
+                        digest.update(chunk)
+                path = self._object_path(digest.hexdigest())
+                with self._lock('cache', shared=True):
+                    _makedirs(os.path.dirname(path))
+                    _replace(tmp, path)
+                    self._write(key_path, digest.hexdigest())
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return path, True
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def fetch(self, file):
+        """Return the path of the cached contents of the File, downloading
+        them if needed. The file may be evicted by another process before it
+        is opened; use open for a safe access."""
+        path, downloaded = self._fetch(file)
+        if downloaded:
+            self.evict()
+        return path
+
+    def open(self, file):
+        "Return the cached contents of the File as an open binary file."
+        path, downloaded = self._fetch(file)
+        if downloaded:
+            self.evict()
+        with self._lock('cache', shared=True):
+            try:
+                return open(path, 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        # Evicted meanwhile
+        return open(self._fetch(file)[0], 'rb')
+
+    def read(self, file):
+        "Return the contents of the File."
+        with self.open(file) as infile:
+            return infile.read()
+
+    def size(self):
+        "Return the total size of the cached contents, in bytes."
+        return sum(os.path.getsize(path) for path, mtime in self._objects())
+
+    def _objects(self):
+        "Yield the path and modification time of the cached contents."
+        objects = os.path.join(self.directory, 'objects')
+        for prefix in os.listdir(objects):
+            for name in os.listdir(os.path.join(objects, prefix)):
+                path = os.path.join(objects, prefix, name)
+                try:
+                    yield path, os.path.getmtime(path)
+                except OSError:
+                    pass
+
+    def evict(self, max_size=None):
+        """Remove the least recently used contents until the cache holds at
+        most max_size bytes, by default the max_size of the cache."""
+        if max_size is None:
+            max_size = self.max_size
+        with self._lock('cache'):
+            objects = sorted(self._objects(), key=lambda item: item[1])
+            sizes = [os.path.getsize(path) for path, mtime in objects]
+            total = sum(sizes)
+            for (path, mtime), size in zip(objects, sizes):
+                if total <= max_size:
+                    break
+                os.remove(path)
+                total -= size
+                logger.debug("Evicted {0} from the file cache".format(path))
+            self._evict_keys()
+
+    def _evict_keys(self):
+        """Remove the keys of the contents no longer cached, and the lock
+        files of the keys. Removing the lock file of a download in progress
+        at most lets another process download the same file meanwhile."""
+        keys = os.path.join(self.directory, 'keys')
+        names = set(os.listdir(keys))
+        for name in names:
+            if name.endswith('.lock'):
+                if name[:-len('.lock')] not in names:
+                    self._remove(os.path.join(keys, name))
+            elif self._lookup(os.path.join(keys, name)) is None:
+                self._remove(os.path.join(keys, name))
+                self._remove(os.path.join(keys, name + '.lock'))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
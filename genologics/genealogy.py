@@ -0,0 +1,356 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Genealogy: indexed graph of artifacts and the processes connecting them.
+
+The graph is built by expanding it from a set of artifacts, a whole level
+at a time: the artifacts of a level are retrieved with one batch request,
+their processes with concurrent requests. Ancestor and descendant queries
+are then answered from the index, without further requests.
+"""
+
+from genologics.entities import Artifact, Process, Sample, SampleHistory
+from genologics.lims import MAX_WORKERS, chunks
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _limsid(node):
+    "LIMS id of the entity referenced by the node."
+    try:
+        return node.attrib['limsid']
+    except KeyError:
+        return urlsplit(node.attrib['uri']).path.split('/')[-1]
+
+
+class Genealogy(object):
+    """Directed graph artifact -> process -> artifact, indexed by LIMS id.
+
+    artifacts:  artifact id -> Artifact
+    processes:  process id -> Process
+    parent:     artifact id -> id of the process which produced it (None
+                for a root artifact); only for the retrieved artifacts.
+    io_map:     process id -> list of (input id, output id or None)
+    consumers:  artifact id -> list of ids of the processes using it as
+                input; complete for the artifacts given to expand_consumers.
+    sample_analytes: sample name -> set of ids of its analytes, for the
+                samples added with add_sample_analytes.
+    """
+
+    def __init__(self, lims, max_workers=MAX_WORKERS):
+        self.lims = lims
+        self.max_workers = max_workers
+        self.artifacts = dict()
+        self.processes = dict()
+        self.parent = dict()
+        self.io_map = dict()
+        self.consumers = dict()
+        self.sample_analytes = dict()
+        self._consumers_known = set()
+
+    def artifact(self, id):
+        "Return the Artifact of the LIMS id, adding it to the index."
+        try:
+            return self.artifacts[id]
+        except KeyError:
+            artifact = self.artifacts[id] = Artifact(self.lims, id=id)
+            return artifact
+
+    # Expansion of the graph (requests are made here)
+
+    def resolve_artifacts(self, ids):
+        """Retrieve the artifacts with one batch request, and index their
+        parent process. Return the set of parent process ids."""
+        artifacts = [self.artifact(id) for id in ids]
+        self.lims.get_batch([a for a in artifacts if a.root is None])
+        parents = set()
+        for artifact in artifacts:
+            node = artifact.root.find('parent-process')
+            if node is None:
+                self.parent[artifact.id] = None
+            else:
+                id = _limsid(node)
+                self.parent[artifact.id] = id
+                if id not in self.processes:
+                    self.processes[id] = Process(self.lims, uri=node.attrib['uri'])
+                parents.add(id)
+        return parents
+
+    def resolve_processes(self, ids):
+        """Retrieve the processes of the ids concurrently, and index their
+        input-output maps."""
+        processes = self.lims.resolve_many([self.processes[id] for id in ids],
+                                           max_workers=self.max_workers)
+        for process in processes:
+            if process.id not in self.io_map:
+                self.add_process(process)
+
+    def add_process(self, process):
+        "Index the input-output maps of a retrieved process."
+        pairs = []
+        for node in process.root.findall('input-output-map'):
+            input = node.find('input')
+            output = node.find('output')
+            input_id = _limsid(input)
+            output_id = _limsid(output) if output is not None else None
+            self.artifact(input_id)
+            consumers = self.consumers.setdefault(input_id, [])
+            if process.id not in consumers:
+                consumers.append(process.id)
+            if output_id is not None:
+                self.artifact(output_id)
+                self.parent[output_id] = process.id
+            pairs.append((input_id, output_id))
+        self.processes[process.id] = process
+        self.io_map[process.id] = pairs
+
+    def expand_ancestors(self, ids, follow=None):
+        """Expand the graph upstream of the artifacts, level by level, up to
+        the root artifacts. If follow is given, only the input artifacts for
+        which follow(id) is true are expanded further."""
+        frontier = set(ids)
+        done = set()
+        while frontier:
+            done.update(frontier)
+            parents = self.resolve_artifacts(sorted(frontier))
+            self.resolve_processes(sorted(parents))
+            frontier = set()
+            for process_id in parents:
+                for input_id in self.inputs(process_id):
+                    if input_id not in done and (follow is None or follow(input_id)):
+                        frontier.add(input_id)
+
+    def expand_consumers(self, ids):
+        """Find and retrieve the processes using each of the artifacts as
+        input. The inputartifactlimsid queries are chunked and sent
+        concurrently, then the processes are retrieved concurrently."""
+        todo = sorted(set(ids) - self._consumers_known)
+        if not todo:
+            return
+        params = [dict(inputartifactlimsid=chunk) for chunk in chunks(todo)]
+        listed = self.lims._map_concurrently(
+            lambda p: self.lims._get_instance_uris(Process, params=p), params,
+            max_workers=self.max_workers)
+        process_ids = set()
+        for uris in listed:
+            for uri in uris:
+                process = Process(self.lims, uri=uri)
+                self.processes.setdefault(process.id, process)
+                process_ids.add(process.id)
+        self.resolve_processes(sorted(process_ids))
+        for id in todo:
+            self.consumers.setdefault(id, [])
+        self._consumers_known.update(todo)
+
+    def expand_descendants(self, ids, stop_types=(), max_depth=None):
+        """Expand the graph downstream of the artifacts, breadth first. For
+        each level, the processes using the frontier artifacts are found with
+        concurrent chunked queries and their outputs are retrieved with one
+        batch request. The outputs of the processes whose type name is in
+        stop_types are indexed but not expanded further, and at most
+        max_depth levels are expanded. Return the set of ids of the
+        artifacts reached."""
+        stop_types = set(stop_types)
+        frontier = set(ids)
+        reached = set()
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            self.expand_consumers(frontier)
+            outputs = set()
+            followed = set()
+            for id in frontier:
+                for process_id in self.consumers.get(id, []):
+                    level = self.outputs(process_id, id)
+                    outputs.update(level)
+                    if self.processes[process_id].type_name not in stop_types:
+                        followed.update(level)
+            outputs -= reached
+            self.resolve_artifacts(sorted(outputs))
+            reached.update(outputs)
+            frontier = followed & outputs
+            depth += 1
+        return reached
+
+    def add_sample_analytes(self, samples, max_workers=None):
+        """List the analytes of the samples with chunked, concurrent
+        samplelimsid queries, retrieve them and their parent processes, and
+        index them per sample name. The samples are retrieved with a batch
+        request if needed, for their names."""
+        samples = list(samples)
+        self.lims.get_batch([s for s in samples if s.root is None])
+        names = dict((s.id, s.name) for s in samples)
+        params = [dict(samplelimsid=chunk, type='Analyte') for chunk in chunks(sorted(names))]
+        listed = self.lims._map_concurrently(
+            lambda p: self.lims._get_instance_uris(Artifact, params=p), params,
+            max_workers=max_workers or self.max_workers)
+        ids = set()
+        for uris in listed:
+            ids.update(Artifact(self.lims, uri=uri).id for uri in uris)
+        self.expand_ancestors(ids, follow=ids.__contains__)
+        for name in names.values():
+            self.sample_analytes.setdefault(name, set())
+        for id in ids:
+            for node in self.artifacts[id].root.findall('sample'):
+                name = names.get(_limsid(node))
+                if name is not None:
+                    self.sample_analytes[name].add(id)
+
+    # Queries on the index (no requests)
+
+    def inputs(self, process_id):
+        "Ids of the inputs of the process, unique, in input-output map order."
+        result = []
+        for input_id, output_id in self.io_map.get(process_id, []):
+            if input_id not in result:
+                result.append(input_id)
+        return result
+
+    def outputs(self, process_id, input_id=None):
+        """Ids of the outputs of the process, unique, in input-output map
+        order; optionally only those produced from the given input."""
+        result = []
+        for i, output_id in self.io_map.get(process_id, []):
+            if output_id is None or output_id in result:
+                continue
+            if input_id is None or i == input_id:
+                result.append(output_id)
+        return result
+
+    def parent_process(self, id):
+        "The Process which produced the artifact, or None."
+        process_id = self.parent.get(id)
+        return self.processes.get(process_id) if process_id else None
+
+    def processes_using(self, id):
+        "The Processes using the artifact as input, sorted by LIMS id."
+        return [self.processes[p] for p in sorted(self.consumers.get(id, []))]
+
+    def processes_per_artifact(self):
+        "Dictionary of artifact id -> list of Processes using it as input."
+        return dict((id, self.processes_using(id)) for id in self.consumers)
+
+    def ancestors(self, id):
+        "Set of ids of the indexed artifacts upstream of the artifact."
+        result = set()
+        stack = [id]
+        while stack:
+            process_id = self.parent.get(stack.pop())
+            for input_id in self.inputs(process_id):
+                if input_id not in result:
+                    result.add(input_id)
+                    stack.append(input_id)
+        return result
+
+    def descendants(self, id):
+        "Set of ids of the indexed artifacts downstream of the artifact."
+        result = set()
+        stack = [id]
+        while stack:
+            current = stack.pop()
+            for process_id in self.consumers.get(current, []):
+                for output_id in self.outputs(process_id, current):
+                    if output_id not in result:
+                        result.add(output_id)
+                        stack.append(output_id)
+        return result
+
+    def lineage(self, id, within):
+        """Walk upstream from the artifact, following at each process the
+        first input which is in the set within (e.g. the analytes of one
+        sample). Return the list of (artifact id, process id, input id)."""
+        result = []
+        seen = set([id])
+        while id in within:
+            process_id = self.parent.get(id)
+            if process_id is None:
+                break
+            for input_id in self.inputs(process_id):
+                if input_id in within:
+                    break
+            else:
+                break
+            result.append((id, process_id, input_id))
+            if input_id in seen:
+                break
+            seen.add(input_id)
+            id = input_id
+        return result
+
+    def latest_analyte(self, within):
+        """The most downstream of the analytes within, i.e. the one with the
+        longest lineage among those not used to produce another of them."""
+        consumed = set()
+        for id in within:
+            for input_id, output_id in self.io_map.get(self.parent.get(id), []):
+                if output_id in within:
+                    consumed.add(input_id)
+        leaves = sorted(set(within) - consumed)
+        if not leaves:
+            return None
+        return max(leaves, key=lambda id: len(self.lineage(id, within)))
+
+
+def trace_descendants(lims, start, stop_types=(), max_depth=None, max_workers=MAX_WORKERS):
+    """Index everything done downstream of the start entities, a Sample (from
+    its root artifact), an Artifact or a list of them, see
+    Genealogy.expand_descendants. Return the Genealogy; its descendants(id)
+    and processes_using(id) answer from the index.
+    """
+    if isinstance(start, (Sample, Artifact)):
+        start = [start]
+    samples = [e for e in start if isinstance(e, Sample)]
+    lims.get_batch([s for s in samples if s.root is None])
+    ids = [e.artifact.id if isinstance(e, Sample) else e.id for e in start]
+    genealogy = Genealogy(lims, max_workers=max_workers)
+    genealogy.resolve_artifacts(ids)
+    genealogy.expand_descendants(ids, stop_types=stop_types, max_depth=max_depth)
+    return genealogy
+
+
+def sample_histories(lims, samples=None, project=None, output_artifacts=dict(),
+                     input_artifacts=dict(), max_workers=MAX_WORKERS):
+    """Compute the SampleHistory of many samples in one pass.
+
+    samples: list of Samples, or the samples of the project if not given.
+    output_artifacts: dictionary of sample name -> id of the output artifact
+                      of the history; by default the latest analyte.
+    input_artifacts: dictionary of sample name -> id of the input artifact,
+                     see SampleHistory.
+
+    All the analytes are listed, retrieved and indexed in one Genealogy, and
+    one map of processes per artifact is shared by the histories, so each
+    process is retrieved exactly once even when pools are shared between
+    samples. Returns a dictionary of sample name -> SampleHistory.
+    """
+    if samples is None:
+        if project is None:
+            raise ValueError("samples or project required")
+        samples = lims.get_samples(projectlimsid=project.id)
+    genealogy = Genealogy(lims, max_workers=max_workers)
+    genealogy.add_sample_analytes(samples)
+
+    outputs = dict()
+    history_inputs = set()
+    for name, analytes in genealogy.sample_analytes.items():
+        outputs[name] = output_artifacts.get(name) or genealogy.latest_analyte(analytes)
+        start = input_artifacts.get(name) or outputs[name]
+        if input_artifacts.get(name):
+            history_inputs.add(start)
+        history_inputs.update(i for o, p, i in genealogy.lineage(start, analytes))
+    genealogy.expand_consumers(history_inputs)
+    pro_per_art = genealogy.processes_per_artifact()
+
+    histories = dict()
+    for name in sorted(genealogy.sample_analytes):
+        if outputs[name] is None:
+            continue
+        histories[name] = SampleHistory(sample_name=name, output_artifact=outputs[name],
+                                        input_artifact=input_artifacts.get(name), lims=lims,
+                                        pro_per_art=pro_per_art, genealogy=genealogy)
+    return histories
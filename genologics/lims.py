@@ -14,9 +14,16 @@ __all__ = ['Lab', 'Researcher', 'Project', 'Sample',
            'ReagentLot', 'ReagentKit', 'Workflow', 'ReagentType',
            'ProtocolStep']
 
+import hashlib
+import json
 import os
 import re
-from io import BytesIO
+import threading
+import uuid
+import warnings
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import requests
 
 # python 2.7, 3+ compatibility
@@ -31,6 +38,14 @@ else:
 
 
 from .entities import *
+from . import protocol
+from .protocol import TIMEOUT
+from .transport import Coalescer
+from .query import LocalQuery
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Python 2.6 support work-arounds
 # - Exception ElementTree.ParseError does not exist
@@ -45,7 +60,73 @@ if version_info[:2] < (2,7):
         p26_write(self, file, encoding=encoding)
     ElementTree.ElementTree.write = write_with_xml_declaration
 
-TIMEOUT = 16
+# Number of threads used for concurrent requests
+MAX_WORKERS = 8
+# Maximum number of LIMS ids given to a listing filter in one request,
+# keeping the query string well within the server URL length limit
+QUERY_CHUNK_SIZE = 100
+# Maximum number of process type names given along with them
+QUERY_TYPE_CHUNK_SIZE = 20
+# Size in bytes of the chunks in which the files are downloaded
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def chunks(items, size=QUERY_CHUNK_SIZE):
+    "Split the list of items in lists of at most size items."
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# Outcome of the upload of one file, see Lims.upload_files: the File, or
+# None if it was not created, and the exception raised, or None
+UploadResult = namedtuple('UploadResult', ['entity', 'path', 'file', 'error'])
+
+
+# The Lims of this process by token, to which the pickled Lims and entities
+# are restored, see Lims.__reduce__
+_registry = weakref.WeakValueDictionary()
+
+
+def _find_password(baseuri, username):
+    """Return the password of the user on the server, for a Lims unpickled
+    without one: the password of a live Lims of this process, or of its
+    parent before the fork, for the same server and user; else the one of
+    the GENOLOGICS_PASSWORD environment variable, if GENOLOGICS_BASEURI and
+    GENOLOGICS_USERNAME are the same server and user; else the one of the
+    config file, if it is for the same server and user; None if there is
+    none."""
+    for lims in list(_registry.values()):
+        if (lims.baseuri, lims.username) == (baseuri, username) and lims.password is not None:
+            return lims.password
+    environ = os.environ
+    if (environ.get('GENOLOGICS_PASSWORD') is not None and
+            (environ.get('GENOLOGICS_BASEURI', '').rstrip('/') + '/',
+             environ.get('GENOLOGICS_USERNAME')) == (baseuri, username)):
+        return environ['GENOLOGICS_PASSWORD']
+    from . import config
+    config_file = config.spec_config or config.find_config_file()
+    if config_file is not None:
+        try:
+            BASEURI, USERNAME, PASSWORD = config.get_config_info(config_file)[:3]
+        except Exception:
+            return None
+        if (BASEURI.rstrip('/') + '/', USERNAME) == (baseuri, username):
+            return PASSWORD
+    return None
+
+
+def _restore_lims(token, baseuri, username, version, cookie_file=None):
+    "Return the Lims of this process for the token, see Lims.__reduce__."
+    lims = _registry.get(token)
+    if lims is None:
+        password = _find_password(baseuri, username)
+        if password is None:
+            logger.warning("No password found for {0} on {1}".format(username, baseuri))
+        lims = Lims(baseuri, username, password, version=version, cookie_file=cookie_file)
+        del _registry[lims._token]
+        lims._token = token
+        _registry[token] = lims
+    return lims
 
 
 class Lims(object):
@@ -53,27 +134,119 @@ class Lims(object):
 
     VERSION = 'v2'
 
-    def __init__(self, baseuri, username, password, version=VERSION):
+    def __init__(self, baseuri, username, password, version=VERSION,
+                 session_cookie='JSESSIONID', cookie_file=None):
         """baseuri: Base URI for the GenoLogics server, excluding
                     the 'api' or version parts!
                     For example: https://genologics.scilifelab.se:8443/
         username: The account name of the user to login as.
         password: The password for the user account to login as.
         version: The optional LIMS API version, by default 'v2' 
+        session_cookie: Name of the session cookie of the server. Once the
+                        server has set it, the requests are authenticated
+                        by the cookie instead of Basic auth, until the
+                        session expires; None to always use Basic auth.
+        cookie_file: Optional file where the session cookie is kept between
+                     processes, readable by the user only, so that short
+                     lived scripts reuse the session.
         """
         self.baseuri = baseuri.rstrip('/') + '/'
         self.username = username
         self.password = password
+        self.session_cookie = session_cookie
+        self.cookie_file = cookie_file
+        self._saved_cookie = None
         self.VERSION = version
-        self.cache = dict()
-        self.cache_list = []
+        # Identity map uri -> instance, in insertion order for the eviction;
+        # guarded by cache_lock, see Entity.__new__
+        self.cache = OrderedDict()
+        # Function exchanging a protocol.Request for a response, see send
+        self.transport = self.http_transport
+        self._token = uuid.uuid4().hex
+        _registry[self._token] = self
+        # The connection pool and the locks belong to the process which
+        # created them; they are re-created after a fork, see _check_pid
+        self._pid = None
+        self._check_pid()
+        # Cache tube Container type, used in create_sample
+        self.tube = None
+        # Cache of the process type names, used in get_qc_results_re
+        self._process_type_names = None
+        # Secondary indexes over the cached instances, used by query
+        self.local_query = LocalQuery(self)
+        # Optional filecache.FileCache of the file contents, used by
+        # get_file_contents and File.download
+        self.file_cache = None
+        if cookie_file:
+            self._load_cookie()
+
+    def _check_pid(self):
+        """Create the connection pool and the cache lock, again if this is a
+        child process forked since they were created: a connection pool
+        duplicated by fork shares its sockets with the parent."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._cache_lock = threading.RLock()
+        self._coalescer = Coalescer()
         # For optimization purposes, enables requests to persist connections
-        self.request_session = requests.Session()
+        session = requests.Session()
+        if getattr(self, '_request_session', None) is not None:
+            # The session cookie remains valid in the child
+            session.cookies.update(self._request_session.cookies)
+        self._request_session = session
         # The connection pool has a default size of 10
         self.adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
-        self.request_session.mount('http://', self.adapter)
-        # Cache tube Container type, used in create_sample
-        self.tube = None
+        self._request_session.mount('http://', self.adapter)
+
+    @property
+    def request_session(self):
+        self._check_pid()
+        return self._request_session
+
+    @request_session.setter
+    def request_session(self, session):
+        self._check_pid()
+        self._request_session = session
+
+    @property
+    def cache_lock(self):
+        "Lock guarding the cache, see Entity.__new__."
+        self._check_pid()
+        return self._cache_lock
+
+    @property
+    def cache_list(self):
+        """Deprecated: the uris of the cached instances, oldest first. The
+        cache is now an OrderedDict, see cache; this is a copy of its keys,
+        modifying it does not modify the cache."""
+        warnings.warn("Lims.cache_list is deprecated, use the keys of Lims.cache",
+                      DeprecationWarning, stacklevel=2)
+        with self.cache_lock:
+            return list(self.cache)
+
+    def __reduce__(self):
+        """Pickle as a token and the connection parameters only. All the
+        pickles of a Lims are restored as the same Lims of the receiving
+        process, with its own cache and connection pool, to which the
+        entities sent along are bound: in a worker process, one created on
+        arrival (or inherited by fork); back in the parent, the original.
+        The password is left out of the pickle, see _find_password."""
+        return (_restore_lims, (self._token, self.baseuri, self.username, self.VERSION,
+                                self.cookie_file))
+
+    def map_processes(self, func, items, max_workers=None, chunksize=1):
+        """Return the list of func(item) for the items, calling func over a
+        pool of processes, for CPU-heavy work. func must be a module-level
+        function. Entities in the items and in the results are transferred
+        as their uri and XML, see Entity.__reduce__, and rebound to the Lims
+        of the receiving process; modifications made by func are thus
+        returned with the results."""
+        items = list(items)
+        if not items:
+            return []
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(func, items, chunksize=chunksize))
 
     def get_uri(self, *segments, **query):
         "Return the full URI given the path segments and optional query."
@@ -83,97 +256,335 @@ class Lims(object):
             url += '?' + urlencode(query)
         return url
 
+    @property
+    def coalescer(self):
+        "Coalescer of the identical GETs in flight, see send."
+        self._check_pid()
+        return self._coalescer
+
+    def send(self, request):
+        """Exchange the request with the LIMS through the transport, and return
+        the parsed response. See genologics.protocol.
+        The threads sending identical GETs at the same time share one
+        exchange, and get the same parsed XML."""
+        if request.method == 'GET':
+            return self.coalescer.call((request.key(), request.parser),
+                                       lambda: request.parse(self.transport(request)))
+        return request.parse(self.transport(request))
+
+    def http_transport(self, request):
+        """The default transport: exchange the request over HTTP, with requests.
+        The request is authenticated by the session cookie if one is held,
+        else with Basic auth; it is sent again with Basic auth if the
+        session has expired, a file-like body being rewound first. The 401
+        response is returned if the body cannot be rewound."""
+        cookie = self.get_session_cookie()
+        if cookie is None:
+            response = self._http_send(request, (self.username, self.password))
+        else:
+            response = self._http_send(request, None)
+            if response.status_code == 401:
+                logger.debug("LIMS session expired, authenticating again")
+                del self.request_session.cookies[self.session_cookie]
+                if hasattr(request.data, 'read'):
+                    if not hasattr(request.data, 'seek'):
+                        return response
+                    # The body, such as an upload, was read by the first send
+                    request.data.seek(0)
+                response.close()
+                response = self._http_send(request, (self.username, self.password))
+        if self.cookie_file:
+            cookie = self.get_session_cookie()
+            if cookie is not None and cookie != self._saved_cookie:
+                self._save_cookie(cookie)
+        return response
+
+    def _http_send(self, request, auth):
+        cookies = self.request_session.cookies
+        if request.method == 'GET':
+            kwargs = dict(stream=True) if request.stream else dict()
+            return self.request_session.get(request.uri, params=request.params,
+                                            auth=auth,
+                                            headers=request.headers,
+                                            timeout=request.timeout, **kwargs)
+        elif request.method == 'HEAD':
+            return self.request_session.head(request.uri, params=request.params, auth=auth,
+                                             headers=request.headers, timeout=request.timeout)
+        elif request.method == 'DELETE':
+            response = requests.delete(request.uri, auth=auth, cookies=cookies)
+        else:
+            method = getattr(requests, request.method.lower())
+            response = method(request.uri, data=request.data, params=request.params,
+                              auth=auth, cookies=cookies,
+                              headers=request.headers)
+        # The session keeps the cookies of its own responses only
+        if isinstance(getattr(response, 'cookies', None), requests.cookies.RequestsCookieJar):
+            cookies.update(response.cookies)
+        return response
+
+    def get_session_cookie(self):
+        "Return the value of the session cookie held, or None."
+        if self.session_cookie is None:
+            return None
+        for cookie in self.request_session.cookies:
+            if cookie.name == self.session_cookie:
+                return cookie.value
+        return None
+
+    def _load_cookie(self):
+        """Set the session cookie kept in the cookie file, if it is readable by
+        the user only and was saved for the same server and user."""
+        try:
+            if os.stat(self.cookie_file).st_mode & 0o077:
+                logger.warning("Ignoring {0}, readable by other users".format(self.cookie_file))
+                return
+            with open(self.cookie_file) as infile:
+                saved = json.load(infile)
+        except (IOError, OSError, ValueError):
+            return
+        if (saved.get('baseuri'), saved.get('username')) != (self.baseuri, self.username):
+            return
+        for cookie in saved.get('cookies', []):
+            self.request_session.cookies.set(cookie['name'], cookie['value'],
+                                             domain=cookie['domain'], path=cookie['path'])
+        self._saved_cookie = self.get_session_cookie()
+
+    def _save_cookie(self, value):
+        "Write the session cookie to the cookie file, readable by the user only."
+        cookies = [dict(name=c.name, value=c.value, domain=c.domain, path=c.path)
+                   for c in self.request_session.cookies if c.name == self.session_cookie]
+        tmp = '{0}.{1}.tmp'.format(self.cookie_file, uuid.uuid4().hex)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(dict(baseuri=self.baseuri, username=self.username, cookies=cookies), outfile)
+        getattr(os, 'replace', os.rename)(tmp, self.cookie_file)
+        self._saved_cookie = value
+
     def get(self, uri, params=dict()):
         "GET data from the URI. Return the response XML as an ElementTree."
         try:
-            r = self.request_session.get(uri, params=params,
-                                         auth=(self.username, self.password),
-                                         headers=dict(accept='application/xml'),
-                                         timeout=TIMEOUT)
+            return self.send(protocol.get(uri, params=params))
         except requests.exceptions.Timeout as e:
-            raise type(e)("{0}, Error trying to reach {1}".format(e.message, uri))
+            raise type(e)("{0}, Error trying to reach {1}".format(e, uri))
 
-        else:
-            return self.parse_response(r)
+    def get_if_modified(self, uri, validators=None, params=dict()):
+        """Conditional GET of the URI, using the ETag and Last-Modified
+        validators of a previous response.
+        Return a tuple (root, validators), where root is the response XML
+        as an ElementTree, or None if the server answered 304 Not Modified.
+        """
+        return self.send(protocol.get_if_modified(uri, validators=validators, params=params))
+
+    def _download(self, uri, offset=0, validator=None):
+        """Return the streamed response to the download of the file of the
+        URI from the byte offset, and the offset of its content: 0 if the
+        server ignored the range, or sent the whole file as it has changed
+        since the validator was given (see protocol.download)."""
+        request = protocol.download(uri, offset=offset, validator=validator)
+        response = self.transport(request)
+        try:
+            protocol.check_response(response, request.accept_status_codes)
+        except requests.exceptions.HTTPError:
+            response.close()
+            raise
+        return response, offset if response.status_code in (206, 416) else 0
+
+    def iter_download(self, uri, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Yield the contents of the file of the URI in chunks of bytes,
+        holding one chunk in memory at a time."""
+        response, offset = self._download(uri)
+        try:
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+        finally:
+            response.close()
+
+    def download_to(self, uri, path, checksum=None, algorithm='md5', retries=3,
+                    chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Download the file of the URI to the path, in chunks.
+        The file is written to path + '.part', and renamed to the path once
+        complete: an interrupted download, in this call or an earlier one,
+        is resumed from the end of the partial file with a range request.
+        The ETag or Last-Modified of the file is kept in path + '.part.validator'
+        and sent as If-Range, so that the download starts over if the file
+        has changed. A download ending short of the size announced by the
+        server counts as interrupted.
+        checksum: the expected hex digest of the file by the hashlib
+                  algorithm; an IOError is raised if it does not match.
+        retries: number of resumptions after a connection error; the
+                 ConnectionError is raised once they are used up.
+        Return the path.
+        """
+        part = path + '.part'
+        validator_path = part + '.validator'
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            validator = None
+            if offset and os.path.exists(validator_path):
+                with open(validator_path) as infile:
+                    validator = infile.read().strip()
+            response, offset = self._download(uri, offset=offset, validator=validator)
+            digest = hashlib.new(algorithm) if checksum else None
+            size = protocol.download_size(response, offset)
+            if response.status_code == 416:
+                response.close()
+                if size != offset:
+                    # The partial file is not the start of the current file
+                    os.remove(part)
+                    continue
+                # The partial file was complete
+                if digest is not None:
+                    with open(part, 'rb') as infile:
+                        for block in iter(lambda: infile.read(chunk_size), b''):
+                            digest.update(block)
+                break
+            if response.status_code == 200:
+                validator = protocol.range_validator(response)
+                if validator:
+                    with open(validator_path, 'w') as outfile:
+                        outfile.write(validator)
+                elif os.path.exists(validator_path):
+                    os.remove(validator_path)
+            try:
+                with open(part, 'r+b' if offset else 'wb') as outfile:
+                    if offset and digest is not None:
+                        for block in iter(lambda: outfile.read(chunk_size), b''):
+                            digest.update(block)
+                    outfile.seek(offset)
+                    outfile.truncate()
+                    for chunk in response.iter_content(chunk_size):
+                        outfile.write(chunk)
+                        offset += len(chunk)
+                        if digest is not None:
+                            digest.update(chunk)
+                if size is not None and offset < size:
+                    # The connection was closed without an error
+                    raise requests.exceptions.ConnectionError(
+                        "Connection closed after {0} of {1} bytes".format(offset, size))
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.info("Resuming the download of {0} after {1}".format(uri, e))
+            finally:
+                response.close()
+        if os.path.exists(validator_path):
+            os.remove(validator_path)
+        if digest is not None and digest.hexdigest().lower() != checksum.lower():
+            os.remove(part)
+            raise IOError("Checksum mismatch for {0}: expected {1}, got {2}".format(
+                uri, checksum, digest.hexdigest()))
+        getattr(os, 'replace', os.rename)(part, path)
+        return path
 
     def get_file_contents(self, id=None, uri=None):
-        """Returns the contents of the file of <ID> or <uri>"""
+        """Returns the contents of the file of <ID> or <uri>.
+        See download_to and iter_download for large files."""
         if id:
-            segments = ['api', self.VERSION, 'files', id, 'download']
+            segments = ['api', self.VERSION, 'files', id]
         elif uri:
-            segments = [uri, 'download']
+            segments = [uri]
         else:
             raise ValueError("id or uri required")
-        url = urljoin(self.baseuri, '/'.join(segments))
-        r = self.request_session.get(url, auth=(self.username, self.password), timeout=TIMEOUT)
-        self.validate_response(r)
-        return r.text
+        if self.file_cache is not None:
+            file = File(self, id=id) if id else File(self, uri=uri)
+            data = self.file_cache.read(file)
+            try:
+                return data.decode('utf-8')
+            except UnicodeDecodeError:
+                return data.decode('latin-1')
+        return self.send(protocol.file_contents(urljoin(self.baseuri, '/'.join(segments))))
 
     def upload_new_file(self, entity, file_to_upload):
         """Upload a file and attach it to the provided entity."""
-        file_to_upload = os.path.abspath(file_to_upload)
-        if not os.path.isfile(file_to_upload):
-            raise IOError("{} not found".format(file_to_upload))
-
-        # Request the storage space on glsstorage
-        # Create the xml to describe the file
-        root = ElementTree.Element(nsmap('file:file'))
-        s = ElementTree.SubElement(root, 'attached-to')
-        s.text = entity.uri
-        s = ElementTree.SubElement(root, 'original-location')
-        s.text = file_to_upload
-        root = self.post(
-                uri=self.get_uri('glsstorage'),
-                data=self.tostring(ElementTree.ElementTree(root))
-        )
-
-        # Create the file object
-        root = self.post(
-                uri=self.get_uri('files'),
-                data=self.tostring(ElementTree.ElementTree(root))
-        )
-        file = File(self, uri=root.attrib['uri'])
-
-        # Actually upload the file
-        uri = self.get_uri('files', file.id, 'upload')
-        r = requests.post(uri, files={'file': (file_to_upload, open(file_to_upload, 'rb'))},
-                          auth=(self.username, self.password))
-        self.validate_response(r)
-        return file
+        result = self.upload_files([(entity, file_to_upload)], max_workers=None)[0]
+        if result.error is not None:
+            raise result.error
+        return result.file
+
+    def upload_files(self, uploads, max_workers=MAX_WORKERS):
+        """Upload files and attach them to entities, given as the pairs
+        (entity, path) of uploads. Each file takes three requests: the
+        allocation of its storage, the creation of the File, and the upload
+        of the contents, streamed from disk. The files are uploaded over a
+        pool of at most max_workers threads, so that the requests of
+        different files overlap.
+        A failure does not stop the other uploads: return the list of the
+        UploadResult of each pair, in order.
+        """
+        uploads = [(entity, os.path.abspath(path)) for entity, path in uploads]
+        outcomes = self._map_concurrently(
+            self._upload_file, [(entity.uri, path) for entity, path in uploads], max_workers=max_workers)
+        results = []
+        for (entity, path), (root, error) in zip(uploads, outcomes):
+            file = None
+            if root is not None:
+                file = File(self, uri=root.attrib['uri'])
+                file.root = root
+            results.append(UploadResult(entity, path, file, error))
+        return results
+
+    def _upload_file(self, item):
+        """Upload the file to attach to the entity of the pair (entity uri,
+        path). Return the XML of the File, or None if it was not created,
+        and the exception raised, or None."""
+        entity_uri, path = item
+        root = None
+        try:
+            if not os.path.isfile(path):
+                raise IOError("{} not found".format(path))
+
+            # Request the storage space on glsstorage
+            # Create the xml to describe the file
+            storage = ElementTree.Element(nsmap('file:file'))
+            s = ElementTree.SubElement(storage, 'attached-to')
+            s.text = entity_uri
+            s = ElementTree.SubElement(storage, 'original-location')
+            s.text = path
+            storage = self.post(
+                    uri=self.get_uri('glsstorage'),
+                    data=self.tostring(ElementTree.ElementTree(storage))
+            )
+
+            # Create the file object
+            root = self.post(
+                    uri=self.get_uri('files'),
+                    data=self.tostring(ElementTree.ElementTree(storage))
+            )
+
+            # Actually upload the file
+            uri = self.get_uri('files', root.attrib['uri'].rstrip('/').split('/')[-1], 'upload')
+            with protocol.MultipartFile(path) as body:
+                self.send(protocol.upload(uri, body))
+        except (requests.exceptions.RequestException, EnvironmentError) as e:
+            return root, e
+        return root, None
 
     def put(self, uri, data, params=dict()):
         """PUT the serialized XML to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.put(uri, data=data, params=params,
-                         auth=(self.username, self.password),
-                         headers={'content-type': 'application/xml',
-                                  'accept': 'application/xml'})
-        self.validate_response(r)
+        self.send(protocol.put(uri, data, params=params))
 
     def post(self, uri, data, params=dict()):
         """POST the serialized XML to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.post(uri, data=data, params=params,
-                          auth=(self.username, self.password),
-                          headers={'content-type': 'application/xml',
-                                   'accept': 'application/xml'})
-        return self.parse_response(r, accept_status_codes=[200, 201, 202])
+        return self.send(protocol.post(uri, data, params=params))
 
     def delete(self, uri):
         """Issue a HTTP DELETE request."""
-        r = requests.delete(uri, auth=(self.username, self.password))
-        if not r.status_code == 204:
-            raise requests.exceptions.HTTPError(str(r.content))
+        self.send(protocol.delete(uri))
 
     def check_version(self):
         """Raise ValueError if the version for this interface
         does not match any of the versions given for the API.
         """
         uri = urljoin(self.baseuri, 'api')
-        r = requests.get(uri, auth=(self.username, self.password))
-        root = self.parse_response(r)
+        root = self.get(uri)
         tag = nsmap('ver:versions')
         assert tag == root.tag
         for node in root.findall('version'):
@@ -185,30 +596,14 @@ class Lims(object):
         Raise an HTTP error if the response status is not one of the
         specified accepted status codes.
         """
-        if response.status_code not in accept_status_codes:
-            try:
-                root = ElementTree.fromstring(response.content)
-                node = root.find('message')
-                if node is None:
-                    response.raise_for_status()
-                    message = "%s" % (response.status_code)
-                else:
-                    message = "%s: %s" % (response.status_code, node.text)
-                node = root.find('suggested-actions')
-                if node is not None:
-                    message += ' ' + node.text
-            except ElementTree.ParseError:  # some error messages might not follow the xml standard
-                message = response.content
-            raise requests.exceptions.HTTPError(message, response=response)
-        return True
+        return protocol.check_response(response, accept_status_codes)
 
     def parse_response(self, response, accept_status_codes=[200]):
         """Parse the XML returned in the response.
         Raise an HTTP error if the response status is not 200.
         """
         self.validate_response(response, accept_status_codes)
-        root = ElementTree.fromstring(response.content)
-        return root
+        return protocol.parse_xml(response)
 
     def get_udfs(self, name=None, attach_to_name=None, attach_to_category=None, start_index=None, add_info=False):
         """Get a list of udfs, filtered by keyword arguments.
@@ -235,7 +630,8 @@ class Lims(object):
         return self._get_instances(ReagentType, params=params)
 
     def get_labs(self, name=None, last_modified=None,
-                 udf=dict(), udtname=None, udt=dict(), start_index=None, add_info=False):
+                 udf=dict(), udtname=None, udt=dict(), start_index=None, add_info=False,
+                 resolve=False):
         """Get a list of labs, filtered by keyword arguments.
         name: Lab name, or list of names.
         last_modified: Since the given ISO format datetime.
@@ -244,17 +640,19 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        resolve: Retrieve the instances concurrently, see resolve_many.
         """
         params = self._get_params(name=name,
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Lab, add_info=add_info, params=params)
+        return self._get_instances(Lab, add_info=add_info, params=params,
+                                   resolve=resolve)
 
     def get_researchers(self, firstname=None, lastname=None, username=None,
                         last_modified=None,
                         udf=dict(), udtname=None, udt=dict(), start_index=None,
-                        add_info=False):
+                        add_info=False, resolve=False):
         """Get a list of researchers, filtered by keyword arguments.
         firstname: Researcher first name, or list of names.
         lastname: Researcher last name, or list of names.
@@ -265,6 +663,7 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        resolve: Retrieve the instances concurrently, see resolve_many.
         """
         params = self._get_params(firstname=firstname,
                                   lastname=lastname,
@@ -272,11 +671,12 @@ class Lims(object):
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Researcher, add_info=add_info, params=params)
+        return self._get_instances(Researcher, add_info=add_info, params=params,
+                                   resolve=resolve)
 
     def get_projects(self, name=None, open_date=None, last_modified=None,
                      udf=dict(), udtname=None, udt=dict(), start_index=None,
-                     add_info=False):
+                     add_info=False, resolve=False):
         """Get a list of projects, filtered by keyword arguments.
         name: Project name, or list of names.
         open_date: Since the given ISO format date.
@@ -286,13 +686,15 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        resolve: Retrieve the instances concurrently, see resolve_many.
         """
         params = self._get_params(name=name,
                                   open_date=open_date,
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Project, add_info=add_info, params=params)
+        return self._get_instances(Project, add_info=add_info, params=params,
+                                   resolve=resolve)
 
     def get_sample_number(self, name=None, projectname=None, projectlimsid=None,
                           udf=dict(), udtname=None, udt=dict(), start_index=None):
@@ -405,7 +807,8 @@ class Lims(object):
     def get_processes(self, last_modified=None, type=None,
                       inputartifactlimsid=None,
                       techfirstname=None, techlastname=None, projectname=None,
-                      udf=dict(), udtname=None, udt=dict(), start_index=None):
+                      udf=dict(), udtname=None, udt=dict(), start_index=None,
+                      resolve=False):
         """Get a list of processes, filtered by keyword arguments.
         last_modified: Since the given ISO format datetime.
         type: Process type, or list of types.
@@ -418,6 +821,7 @@ class Lims(object):
         techlastname: Last name of researcher, or list of.
         projectname: Name of project, or list of.
         start_index: Page to retrieve; all if None.
+        resolve: Retrieve the instances concurrently, see resolve_many.
         """
         params = self._get_params(last_modified=last_modified,
                                   type=type,
@@ -427,35 +831,42 @@ class Lims(object):
                                   projectname=projectname,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Process, params=params)
+        return self._get_instances(Process, params=params,
+                                   resolve=resolve)
 
-    def get_workflows(self, name=None, add_info=False):
+    def get_workflows(self, name=None, add_info=False, resolve=False):
         """Get the list of existing workflows on the system """
         params = self._get_params(name=name)
-        return self._get_instances(Workflow, add_info=add_info, params=params)
+        return self._get_instances(Workflow, add_info=add_info, params=params,
+                                   resolve=resolve)
 
-    def get_process_types(self, displayname=None, add_info=False):
+    def get_process_types(self, displayname=None, add_info=False, resolve=False):
         """Get a list of process types with the specified name."""
         params = self._get_params(displayname=displayname)
-        return self._get_instances(Processtype, add_info=add_info, params=params)
+        return self._get_instances(Processtype, add_info=add_info, params=params,
+                                   resolve=resolve)
 
     def get_reagent_types(self, name=None, add_info=False):
         params = self._get_params(name=name)
         return self._get_instances(ReagentType, add_info=add_info, params=params)
 
-    def get_protocols(self, name=None, add_info=False):
+    def get_protocols(self, name=None, add_info=False, resolve=False):
         """Get the list of existing protocols on the system """
         params = self._get_params(name=name)
-        return self._get_instances(Protocol, add_info=add_info, params=params)
+        return self._get_instances(Protocol, add_info=add_info, params=params,
+                                   resolve=resolve)
 
-    def get_reagent_kits(self, name=None, start_index=None, add_info=False):
+    def get_reagent_kits(self, name=None, start_index=None, add_info=False,
+                         resolve=False):
         """Get a list of reagent kits, filtered by keyword arguments.
         name: reagent kit  name, or list of names.
         start_index: Page to retrieve; all if None.
+        resolve: Retrieve the instances concurrently, see resolve_many.
         """
         params = self._get_params(name=name,
                                   start_index=start_index)
-        return self._get_instances(ReagentKit, add_info=add_info, params=params)
+        return self._get_instances(ReagentKit, add_info=add_info, params=params,
+                                   resolve=resolve)
 
     def get_reagent_lots(self, name=None, kitname=None, number=None,
                          start_index=None):
@@ -469,6 +880,23 @@ class Lims(object):
                                   start_index=start_index)
         return self._get_instances(ReagentLot, params=params)
 
+    def query(self, klass, udf=dict(), project=None, **kwargs):
+        """Get a list of the cached instances of klass, filtered by keyword
+        arguments, without any request to the server. Only instances whose
+        XML has already been retrieved are considered.
+        name, limsid, type, output_type, qc_flag, state, date_run,
+        working_flag: value, or list of values.
+        parent_process, container, sample, project, researcher, submitter,
+        technician, lab: entity instance, uri or LIMS id, or list of.
+        udf: dictionary of UDFs with 'UDFNAME', 'UDFNAME.min' or 'UDFNAME.max'
+             as keys, and the value or a predicate function as values.
+
+        Example: all failed libraries in a project with concentration < 2
+        lims.query(Artifact, type='Analyte', qc_flag='FAILED', project=project,
+                   udf={'Concentration': lambda c: c < 2})
+        """
+        return self.local_query.filter(klass, udf=udf, project=project, **kwargs)
+
     def _get_params(self, **kwargs):
         "Convert keyword arguments to a kwargs dictionary."
         result = dict()
@@ -488,7 +916,7 @@ class Lims(object):
             result["udt.%s" % key] = value
         return result
 
-    def _get_instances(self, klass, add_info=None, params=dict()):
+    def _get_instances(self, klass, add_info=None, params=dict(), resolve=False):
         results = []
         additionnal_info_dicts = []
         tag = klass._TAG
@@ -507,11 +935,63 @@ class Lims(object):
             node = root.find('next-page')
             if node is None: break
             root = self.get(node.attrib['uri'], params=params)
+        if resolve:
+            self.resolve_many(results)
         if add_info:
             return results, additionnal_info_dicts
         else:
             return results
 
+    def _get_instance_uris(self, klass, params=dict()):
+        """Return the uris of all the instances listed by the resource of
+        klass, over all pages. No instance is created, so this can be
+        called from worker threads."""
+        tag = klass._TAG
+        if tag is None:
+            tag = klass.__name__.lower()
+        uris = []
+        root = self.get(self.get_uri(klass._URI), params=params)
+        while True:
+            for node in root.findall(tag):
+                uris.append(node.attrib['uri'])
+            node = root.find('next-page')
+            if node is None: break
+            root = self.get(node.attrib['uri'])
+        return uris
+
+    def _map_concurrently(self, func, items, max_workers=MAX_WORKERS):
+        """Return the list of func(item) for the items, calling func over a
+        pool of threads. func should only do requests and parsing; the
+        instances are to be created and updated by the calling thread."""
+        items = list(items)
+        if max_workers is None or max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def resolve_many(self, instances, max_workers=MAX_WORKERS, force=False):
+        """Get the content of a set of instances with concurrent GETs, at most
+        max_workers at a time. For the entities which have no batch endpoint
+        (Processes, Projects, Steps, Researchers, Labs, configuration...);
+        use get_batch when there is one.
+
+        Only the instances not yet retrieved are requested, unless force is
+        true, and each of them once. The instances are updated, and so the
+        cache populated, by the calling thread only.
+        Returns the list of instances, in the given order.
+        """
+        instances = list(instances)
+        todo = []
+        seen = set()
+        for instance in instances:
+            if (force or instance.root is None) and instance.uri not in seen:
+                seen.add(instance.uri)
+                todo.append(instance)
+        roots = self._map_concurrently(lambda i: self.get(i.uri), todo, max_workers=max_workers)
+        for instance, root in zip(todo, roots):
+            instance.root = root
+        return instances
+
     def get_batch(self, instances, force=False):
         """Get the content of a set of instances using the efficient batch call.
 
@@ -528,75 +1008,32 @@ class Lims(object):
         state into a single result with state equal to the state of the Artifact
         occurring at the last position in the list.
         """
+        instances = list(instances)
         if not instances:
             return []
-        root = ElementTree.Element(nsmap('ri:links'))
-        needs_request = False
-        instance_map = {}
-        for instance in instances:
-            instance_map[instance.id] = instance
-            if force or instance.root is None:
-                ElementTree.SubElement(root, 'link', dict(uri=instance.uri,
-                                                          rel=instance.__class__._URI))
-                needs_request = True
-
-        if needs_request:
-            uri = self.get_uri(instance.__class__._URI, 'batch/retrieve')
-            data = self.tostring(ElementTree.ElementTree(root))
-            root = self.post(uri, data)
-            for node in root.getchildren():
-                instance = instance_map[node.attrib['limsid']]
-                instance.root = node
-        return instance_map.values()
+        request = protocol.batch_retrieve(self.get_uri(instances[0].__class__._URI, 'batch/retrieve'),
+                                          instances, force=force)
+        if request is None:
+            return list(OrderedDict((instance.id, instance) for instance in instances).values())
+        return self.send(request)
 
     def put_batch(self, instances):
         """Update multiple instances using a single batch request."""
 
+        instances = list(instances)
         if not instances:
             return
-
-        root = None  # XML root element for batch request
-
-        for instance in instances:
-            if root is None:
-                klass = instance.__class__
-                # Tag is art:details, con:details, etc.
-                example_root = instance.root
-                ns_uri = re.match("{(.*)}.*", example_root.tag).group(1)
-                root = ElementTree.Element("{%s}details" % (ns_uri))
-
-            root.append(instance.root)
-
-        uri = self.get_uri(klass._URI, 'batch/update')
-        data = self.tostring(ElementTree.ElementTree(root))
-        root = self.post(uri, data)
+        uri = self.get_uri(instances[0].__class__._URI, 'batch/update')
+        self.send(protocol.batch_update(uri, instances))
 
     def route_artifacts(self, artifact_list, workflow_uri=None, stage_uri=None, unassign=False):
-        root = ElementTree.Element(nsmap('rt:routing'))
-        if unassign:
-            s = ElementTree.SubElement(root, 'unassign')
-        else:
-            s = ElementTree.SubElement(root, 'assign')
-        if workflow_uri:
-            s.set('workflow-uri', workflow_uri)
-        if stage_uri:
-            s.set('stage-uri', stage_uri)
-        for artifact in artifact_list:
-            a = ElementTree.SubElement(s, 'artifact')
-            a.set('uri', artifact.uri)
-
-        uri = self.get_uri('route', 'artifacts')
-        r = requests.post(uri, data=self.tostring(ElementTree.ElementTree(root)),
-                          auth=(self.username, self.password),
-                          headers={'content-type': 'application/xml',
-                                   'accept': 'application/xml'})
-        self.validate_response(r)
+        self.send(protocol.route_artifacts(self.get_uri('route', 'artifacts'), artifact_list,
+                                           workflow_uri=workflow_uri, stage_uri=stage_uri,
+                                           unassign=unassign))
 
     def tostring(self, etree):
         "Return the ElementTree contents as a UTF-8 encoded XML string."
-        outfile = BytesIO()
-        self.write(outfile, etree)
-        return outfile.getvalue()
+        return protocol.tostring(etree)
 
     def write(self, outfile, etree):
         "Write the ElementTree contents as UTF-8 encoded XML to the open file."
@@ -606,18 +1043,9 @@ class Lims(object):
         """Creates a new protocol step instance. The inputs parameter is a list of 
 		artifact inputs. Returns the new step."""
 		
-        root = ElementTree.Element('stp:step-creation', {'xmlns:stp': 'http://genologics.com/ri/step'})
-        ElementTree.SubElement(root, "configuration", {'uri': step_configuration.uri})
-        inputs_element = ElementTree.SubElement(root, "inputs")
-        for i in inputs:
-            ElementTree.SubElement(inputs_element, "input", {'uri': i.uri})
-
-        if container_type:
-            ElementTree.SubElement(root, "container-type").text = container_type
-        if reagent_category:
-            ElementTree.SubElement(root, "reagent-category").text = reagent_cateogry
-
-        root = self.post(self.get_uri("steps"), self.tostring(ElementTree.ElementTree(root)))
+        root = self.send(protocol.step_creation(self.get_uri("steps"), step_configuration, inputs,
+                                                container_type=container_type,
+                                                reagent_category=reagent_category))
         limsid = root.attrib.get('limsid')
         step = Step(self, id = limsid)
         step.root = root
@@ -625,21 +1053,10 @@ class Lims(object):
 
     def create_lot(self, reagent_kit, name, lot_number=None, expiry_date=None,
             storage_location=None, notes=None, status=None):
-        root = ElementTree.Element("lot:reagent-lot", {"xmlns:lot": "http://genologics.com/ri/reagentlot"})
-        ElementTree.SubElement(root, 'reagent-kit', {'uri': reagent_kit.uri})
-        ElementTree.SubElement(root, 'name').text = name
-        if lot_number:
-            ElementTree.SubElement(root, 'lot-number').text = lot_number
-        if expiry_date:
-            ElementTree.SubElement(root, 'expiry-date').text = expiry_date
-        if storage_location:
-            ElementTree.SubElement(root, 'storage-location').text = storage_location
-        if notes:
-            ElementTree.SubElement(root, 'notes').text = notes
-        if status:
-            ElementTree.SubElement(root, 'status').text = status
-        xml_data = self.tostring(ElementTree.ElementTree(root))
-        response = self.post(self.get_uri("reagentlots"), xml_data)
+        response = self.send(protocol.lot_creation(self.get_uri("reagentlots"), reagent_kit, name,
+                                                   lot_number=lot_number, expiry_date=expiry_date,
+                                                   storage_location=storage_location, notes=notes,
+                                                   status=status))
         lot = ReagentLot(self, uri=response.attrib['uri'])
         lot.root = response
         return lot
@@ -761,6 +1178,43 @@ class Lims(object):
 
         step.actions.put()
 
+    def get_process_type_names(self, force=False):
+        """Return the sorted list of the names of all process types. It is
+        retrieved once and cached, unless force is true."""
+        if force or self._process_type_names is None:
+            instances, info = self.get_process_types(add_info=True)
+            self._process_type_names = sorted(set(i['name'] for i in info if 'name' in i))
+        return self._process_type_names
+
+    def _get_qc_results(self, analytes, types):
+        """Map of analyte id -> QC result (PerInput ResultFile) of the most
+        recent process of the types having the analyte as input.
+
+        The processes are listed with inputartifactlimsid queries filtered
+        by type, both chunked, sent concurrently; those not already retrieved
+        are then retrieved concurrently."""
+        qc_results = {}
+        if not types:
+            return qc_results
+        ids = sorted(set(a.id for a in analytes))
+        params = [self._get_params(inputartifactlimsid=id_chunk, type=type_chunk)
+                  for type_chunk in chunks(types, QUERY_TYPE_CHUNK_SIZE)
+                  for id_chunk in chunks(ids)]
+        listed = self._map_concurrently(lambda p: self._get_instance_uris(Process, params=p), params)
+        qc_processes = OrderedDict()
+        for uris in listed:
+            for uri in uris:
+                if uri not in qc_processes:
+                    qc_processes[uri] = Process(self, uri=uri)
+        qc_processes = self.resolve_many(qc_processes.values())
+
+        # Uses most recent QC result for each sample
+        for qc_process in sorted(qc_processes, key=lambda x: (x.date_run or '', x.id)):
+            for i, o in qc_process.input_output_maps:
+                if o and o['output-type'] == "ResultFile" and o['output-generation-type'] == 'PerInput':
+                    qc_results[i['uri'].id] = o['uri']
+        return qc_results
+
     def get_qc_results(self, analytes, qc_process_name):
         """Get QC results for a list of analytes, from a process which produces 
         ResultFiles, which had the specified analytes directly as inputs.
@@ -772,48 +1226,26 @@ class Lims(object):
 
         Raises a KeyError if any sample does not have a QC result file.
         """
-
-        qc_processes = self.get_processes(
-                inputartifactlimsid=[a.id for a in analytes],
-                type=qc_process_name
-                )
-
-        qc_results = {}
-        # Uses most recent QC result for each sample
-        for qc_process in sorted(qc_processes, key=lambda x: x.date_run):
-            for i, o in qc_process.input_output_maps:
-                if o and o['output-type'] == "ResultFile" and o['output-generation-type'] == 'PerInput':
-                    qc_results[i['uri'].id] = o['uri']
-
+        qc_results = self._get_qc_results(analytes, [qc_process_name])
         return [qc_results[a.id] for a in analytes]
 
-
     def get_qc_results_re(self, analytes, qc_process_re):
         """Get QC results for a list of analytes, from a process which produces 
         ResultFiles, which had the specified analytes directly as inputs.
 
         qc_process_re: A regular expression used to match the process name. The
                  re.match() function is used, so the regex has to match the beginning
-                 of the name.
+                 of the name. It is matched against the cached list of process
+                 type names (see get_process_type_names), and only the processes
+                 of the matching types are listed.
 
         Returns the QC results (ResultFile artifacts) in the same order as
         the input list of analytes.
 
         Raises a KeyError if any of the input samples does not have a QC result file.
         """
-
-        qc_processes = self.get_processes(
-                inputartifactlimsid=[a.id for a in analytes]
-                )
-
-        qc_results = {}
-        # Uses most recent QC result for each sample
-        for qc_process in sorted(qc_processes, key=lambda x: x.date_run):
-            if re.match(qc_process_re, qc_process.type_name):
-                for i, o in qc_process.input_output_maps:
-                    if o and o['output-type'] == "ResultFile" and o['output-generation-type'] == 'PerInput':
-                        qc_results[i['uri'].id] = o['uri']
-
+        types = [name for name in self.get_process_type_names() if re.match(qc_process_re, name)]
+        qc_results = self._get_qc_results(analytes, types)
         return [qc_results[a.id] for a in analytes]
 
 
@@ -7,7 +7,11 @@ import sys
 import os
 
 from genologics.lims import *
-from genologics.config import BASEURI, USERNAME, PASSWORD
+from genologics import config
+try:
+    from genologics.config import BASEURI, USERNAME, PASSWORD
+except config.ConfigError as e:
+    sys.exit(e)
 
 lims = Lims(BASEURI, USERNAME, PASSWORD)
 
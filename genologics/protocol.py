@@ -0,0 +1,538 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Sans-I/O core: the requests to the LIMS as Request descriptions, and the
+parsing of the response bytes, without any network access.
+
+The drivers exchange the requests with the LIMS: Lims.send (blocking, on
+requests), AsyncLims.send (asyncio, on aiohttp), or a Replay of recorded
+exchanges, which also lets benchmarks measure the parsing and serializing
+costs alone:
+
+recorder = Recorder(lims.transport)
+lims.transport = recorder           # record the exchanges of a run
+...
+lims.transport = recorder.replay    # replay them, without network
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+from xml.etree import ElementTree
+
+import requests
+
+from genologics.constants import nsmap
+
+TIMEOUT = 16
+
+XML_HEADERS = {'content-type': 'application/xml', 'accept': 'application/xml'}
+
+
+class Request(object):
+    """Description of a request to the LIMS, and of how to parse its response.
+
+    parser: function of the Response returning the result of the request,
+            called once the status is checked; None for no result.
+    timeout: in seconds, or None for no timeout.
+    stream: the response content is to be read in chunks with iter_content,
+            instead of being read at once.
+    """
+
+    def __init__(self, method, uri, params=None, data=None, headers=None,
+                 accept_status_codes=[200], parser=None, timeout=None, stream=False):
+        self.method = method
+        self.uri = uri
+        self.params = params if params is not None else dict()
+        self.data = data
+        self.headers = headers if headers is not None else dict(accept='application/xml')
+        self.accept_status_codes = accept_status_codes
+        self.parser = parser
+        self.timeout = timeout
+        self.stream = stream
+
+    def __repr__(self):
+        return "Request(%s %s)" % (self.method, self.uri)
+
+    def key(self):
+        "Hashable identity of the request, used to match recorded exchanges."
+        params = []
+        for key in sorted(self.params):
+            value = self.params[key]
+            if isinstance(value, (list, tuple, set)):
+                value = tuple(str(v) for v in value)
+            else:
+                value = str(value)
+            params.append((key, value))
+        data = self.data.key() if isinstance(self.data, MultipartFile) else self.data
+        return (self.method, self.uri, tuple(params), data)
+
+    def parse(self, response):
+        """Check the status of the response, and return its parsed result.
+        Raise an HTTPError if the status is not accepted."""
+        check_response(response, self.accept_status_codes)
+        if self.parser is None:
+            return None
+        return self.parser(response)
+
+
+class Response(object):
+    "The parts of an HTTP response used by the parsers."
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else dict()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("%s" % self.status_code, response=self)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def multipart_parts(field, filename):
+    """Return the content type of a multipart/form-data body holding one
+    file, and the bytes before and after the contents of the file."""
+    boundary = uuid.uuid4().hex
+    filename = filename.replace('"', '\\"')
+    head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (boundary, field, filename)).encode('utf-8')
+    tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+    return 'multipart/form-data; boundary=%s' % boundary, head, tail
+
+
+class MultipartFile(object):
+    """multipart/form-data body of the upload of a file, as a file-like
+    object reading the file as the body is sent. Its length is known, so
+    that requests sends it with a Content-Length. Close it after use."""
+
+    def __init__(self, path, field='file', filename=None):
+        self.path = path
+        self.filename = filename or path
+        self.content_type, self.head, self.tail = multipart_parts(field, self.filename)
+        self.size = os.path.getsize(path)
+        self.file = None
+        self.position = 0
+
+    def key(self):
+        """Identity of the upload, by the file name and the digest of the
+        contents: the boundary of the body differs at each upload."""
+        digest = hashlib.sha1()
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return ('MultipartFile', os.path.basename(self.filename), digest.hexdigest())
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        "Rewind the body, to send it again."
+        if (position, whence) != (0, 0):
+            raise ValueError("MultipartFile can only be rewound")
+        self.close()
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self.position
+        parts = []
+        head, body_end = len(self.head), len(self.head) + self.size
+        while size > 0 and self.position < len(self):
+            if self.position < head:
+                part = self.head[self.position:self.position + size]
+            elif self.position < body_end:
+                if self.file is None:
+                    self.file = open(self.path, 'rb')
+                    self.file.seek(self.position - head)
+                part = self.file.read(min(size, body_end - self.position))
+                if not part:
+                    raise IOError("%s was truncated while uploading" % self.path)
+            else:
+                part = self.tail[self.position - body_end:self.position - body_end + size]
+            parts.append(part)
+            self.position += len(part)
+            size -= len(part)
+        return b''.join(parts)
+
+
+def check_response(response, accept_status_codes=[200]):
+    """Raise an HTTP error with the message of the XML returned in the
+    response if its status is not one of the accepted status codes.
+    """
+    if response.status_code not in accept_status_codes:
+        try:
+            root = ElementTree.fromstring(response.content)
+            node = root.find('message')
+            if node is None:
+                response.raise_for_status()
+                message = "%s" % (response.status_code)
+            else:
+                message = "%s: %s" % (response.status_code, node.text)
+            node = root.find('suggested-actions')
+            if node is not None:
+                message += ' ' + node.text
+        except ElementTree.ParseError:  # some error messages might not follow the xml standard
+            message = response.content
+        raise requests.exceptions.HTTPError(message, response=response)
+    return True
+
+
+def download_size(response, offset=0):
+    """Return the size of the whole file of the response to a download from
+    the byte offset, from its Content-Range or Content-Length header, or
+    None if it is unknown."""
+    headers = response.headers
+    if response.status_code in (206, 416):
+        # 416: the range starts beyond the file, of size given as 'bytes */size'
+        total = (headers.get('content-range') or '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+        if response.status_code == 416:
+            return None
+    elif headers.get('content-encoding') not in (None, 'identity'):
+        # The length of the encoded content, not of the file
+        return None
+    length = headers.get('content-length')
+    if length is not None and length.isdigit():
+        return offset + int(length)
+    return None
+
+
+def parse_xml(response):
+    "Return the XML of the response as an ElementTree."
+    return ElementTree.fromstring(response.content)
+
+
+def tostring(etree):
+    "Return the ElementTree contents as a UTF-8 encoded XML string."
+    outfile = BytesIO()
+    etree.write(outfile, encoding='utf-8', xml_declaration=True)
+    return outfile.getvalue()
+
+
+# Request builders
+
+def get(uri, params=None):
+    "GET the XML of the URI."
+    return Request('GET', uri, params=params, parser=parse_xml, timeout=TIMEOUT)
+
+
+def get_if_modified(uri, validators=None, params=None):
+    """Conditional GET of the URI, using the ETag and Last-Modified
+    validators of a previous response. The result is a tuple (root,
+    validators), where root is None if the server answered 304.
+    """
+    headers = dict(accept='application/xml')
+    validators = validators or dict()
+    if validators.get('etag'):
+        headers['if-none-match'] = validators['etag']
+    if validators.get('last-modified'):
+        headers['if-modified-since'] = validators['last-modified']
+
+    def parser(response):
+        if response.status_code == 304:
+            return None, validators
+        return parse_xml(response), dict((key, response.headers.get(key))
+                                         for key in ('etag', 'last-modified')
+                                         if response.headers.get(key))
+    return Request('GET', uri, params=params, headers=headers, accept_status_codes=[200, 304],
+                   parser=parser, timeout=TIMEOUT)
+
+
+def download(uri, offset=0, validator=None):
+    """GET the contents of the file of the URI, as a stream, from the byte
+    offset on. The server answers 206 to a range request it supports, or
+    416 if the offset is at or beyond the end of the file.
+    validator: the ETag or Last-Modified of the download of the start of
+               the file; the server sends the whole file (200) instead of
+               the range if the file has changed since.
+    """
+    headers = dict()
+    accept_status_codes = [200, 206]
+    if offset:
+        headers['range'] = 'bytes=%d-' % offset
+        accept_status_codes.append(416)
+        if validator:
+            headers['if-range'] = validator
+    return Request('GET', uri + '/download', headers=headers, accept_status_codes=accept_status_codes,
+                   timeout=TIMEOUT, stream=True)
+
+
+def range_validator(response):
+    """Return the validator of the downloaded file to send as If-Range when
+    resuming the download: its strong ETag, else its Last-Modified, or None."""
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+
+def file_contents(uri):
+    "GET the contents of the file of the URI; the result is the decoded text."
+    def parser(response):
+        text = getattr(response, 'text', None)
+        if text is not None:
+            return text
+        try:
+            return response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            return response.content.decode('latin-1')
+    return Request('GET', uri + '/download', headers=dict(), parser=parser, timeout=TIMEOUT)
+
+
+def download_validators(uri):
+    """HEAD of the download of the file of the URI; the result is the
+    dictionary of its ETag, Last-Modified and Content-Length headers."""
+    def parser(response):
+        return dict((key, response.headers.get(key))
+                    for key in ('etag', 'last-modified', 'content-length')
+                    if response.headers.get(key))
+    return Request('HEAD', uri + '/download', headers=dict(), parser=parser, timeout=TIMEOUT)
+
+
+def put(uri, data, params=None):
+    "PUT the serialized XML to the URI."
+    return Request('PUT', uri, params=params, data=data, headers=dict(XML_HEADERS))
+
+
+def post(uri, data, params=None):
+    "POST the serialized XML to the URI; the result is the response XML."
+    return Request('POST', uri, params=params, data=data, headers=dict(XML_HEADERS),
+                   accept_status_codes=[200, 201, 202], parser=parse_xml)
+
+
+def delete(uri):
+    "DELETE the URI."
+    return Request('DELETE', uri, headers=dict(), accept_status_codes=[204])
+
+
+def upload(uri, body):
+    "POST the MultipartFile body to the upload URI of a file."
+    return Request('POST', uri, data=body, headers={'content-type': body.content_type})
+
+
+def upload_data(uri, data, filename='file'):
+    """POST the data, bytes, text or an open file, to the upload URI of a
+    file, as a multipart/form-data body held in memory."""
+    if hasattr(data, 'read'):
+        filename = os.path.basename(getattr(data, 'name', filename))
+        data = data.read()
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    content_type, head, tail = multipart_parts('file', filename)
+    return Request('POST', uri, data=head + data + tail, headers={'content-type': content_type})
+
+
+def batch_retrieve(uri, instances, force=False):
+    """POST to the batch/retrieve URI the links to the instances not yet
+    retrieved, or all if force is true; the parser sets the XML of the
+    instances and returns them, without duplicates.
+    Return None if no request is needed."""
+    root = ElementTree.Element(nsmap('ri:links'))
+    instance_map = OrderedDict()
+    linked = set()
+    for instance in instances:
+        instance_map[instance.id] = instance
+        if (force or instance.root is None) and instance.uri not in linked:
+            linked.add(instance.uri)
+            ElementTree.SubElement(root, 'link', dict(uri=instance.uri,
+                                                      rel=instance.__class__._URI))
+    if len(root) == 0:
+        return None
+
+    def parser(response):
+        for node in parse_xml(response):
+            instance_map[node.attrib['limsid']].root = node
+        return list(instance_map.values())
+    request = post(uri, tostring(ElementTree.ElementTree(root)))
+    request.parser = parser
+    return request
+
+
+def batch_update(uri, instances):
+    "POST the XML of the instances to the batch/update URI."
+    # Tag is art:details, con:details, etc.
+    ns_uri = re.match("{(.*)}.*", instances[0].root.tag).group(1)
+    root = ElementTree.Element("{%s}details" % (ns_uri))
+    for instance in instances:
+        root.append(instance.root)
+    return post(uri, tostring(ElementTree.ElementTree(root)))
+
+
+def route_artifacts(uri, artifacts, workflow_uri=None, stage_uri=None, unassign=False):
+    "POST the routing of the artifacts to, or from, a workflow or stage."
+    root = ElementTree.Element(nsmap('rt:routing'))
+    if unassign:
+        s = ElementTree.SubElement(root, 'unassign')
+    else:
+        s = ElementTree.SubElement(root, 'assign')
+    if workflow_uri:
+        s.set('workflow-uri', workflow_uri)
+    if stage_uri:
+        s.set('stage-uri', stage_uri)
+    for artifact in artifacts:
+        a = ElementTree.SubElement(s, 'artifact')
+        a.set('uri', artifact.uri)
+    request = post(uri, tostring(ElementTree.ElementTree(root)))
+    request.accept_status_codes = [200]
+    request.parser = None
+    return request
+
+
+def step_creation(uri, step_configuration, inputs, container_type=None, reagent_category=None):
+    "POST the creation of a step; the result is the XML of the step."
+    root = ElementTree.Element('stp:step-creation', {'xmlns:stp': 'http://genologics.com/ri/step'})
+    ElementTree.SubElement(root, "configuration", {'uri': step_configuration.uri})
+    inputs_element = ElementTree.SubElement(root, "inputs")
+    for i in inputs:
+        ElementTree.SubElement(inputs_element, "input", {'uri': i.uri})
+    if container_type:
+        ElementTree.SubElement(root, "container-type").text = container_type
+    if reagent_category:
+        ElementTree.SubElement(root, "reagent-category").text = reagent_category
+    return post(uri, tostring(ElementTree.ElementTree(root)))
+
+
+def lot_creation(uri, reagent_kit, name, lot_number=None, expiry_date=None,
+                 storage_location=None, notes=None, status=None):
+    "POST the creation of a reagent lot; the result is the XML of the lot."
+    root = ElementTree.Element("lot:reagent-lot", {"xmlns:lot": "http://genologics.com/ri/reagentlot"})
+    ElementTree.SubElement(root, 'reagent-kit', {'uri': reagent_kit.uri})
+    ElementTree.SubElement(root, 'name').text = name
+    if lot_number:
+        ElementTree.SubElement(root, 'lot-number').text = lot_number
+    if expiry_date:
+        ElementTree.SubElement(root, 'expiry-date').text = expiry_date
+    if storage_location:
+        ElementTree.SubElement(root, 'storage-location').text = storage_location
+    if notes:
+        ElementTree.SubElement(root, 'notes').text = notes
+    if status:
+        ElementTree.SubElement(root, 'status').text = status
+    return post(uri, tostring(ElementTree.ElementTree(root)))
+
+
+# Recording and replay
+
+def _dump_bytes(data):
+    "Return the bytes data as JSON text, and its encoding: None for UTF-8 text, or 'base64'."
+    if isinstance(data, bytes):
+        try:
+            return data.decode('utf-8'), None
+        except UnicodeDecodeError:
+            return base64.b64encode(data).decode('ascii'), 'base64'
+    return data, None
+
+
+def _load_bytes(text, encoding):
+    "Return the bytes written by _dump_bytes."
+    if encoding == 'base64':
+        return base64.b64decode(text.encode('ascii'))
+    return text.encode('utf-8')
+
+
+class Replay(object):
+    """Transport answering the requests from recorded responses, matched on
+    the method, uri, params and data of the request. Repeated requests get
+    the recorded responses in order, the last one being reused. Uploads of
+    files are matched on the file name and contents, see MultipartFile.key.
+    """
+
+    def __init__(self, exchanges=None):
+        self.responses = dict()
+        for request, response in exchanges or []:
+            self.record(request, response)
+
+    def record(self, request, response):
+        self._record(request.key(), response)
+
+    def _record(self, key, response):
+        self.responses.setdefault(key, []).append(
+            Response(response.status_code, response.content, dict(response.headers)))
+
+    def __call__(self, request):
+        try:
+            responses = self.responses[request.key()]
+        except KeyError:
+            raise KeyError("No recorded response for {0}".format(request.key()))
+        if len(responses) > 1:
+            return responses.pop(0)
+        return responses[0]
+
+    def dump(self, outfile):
+        """Write the recorded exchanges as JSON to the open text file,
+        for example io.open(path, 'w', encoding='utf-8'). The contents which
+        are not UTF-8 text, such as downloaded files, are base64 encoded."""
+        entries = []
+        for (method, uri, params, data), responses in self.responses.items():
+            if isinstance(data, tuple):
+                # Upload of a file, see MultipartFile.key
+                data, data_encoding = dict(filename=data[1], sha1=data[2]), 'file'
+            else:
+                data, data_encoding = _dump_bytes(data)
+            for response in responses:
+                content, content_encoding = _dump_bytes(response.content)
+                entries.append(dict(method=method, uri=uri, params=[list(p) for p in params],
+                                    data=data, data_encoding=data_encoding,
+                                    status_code=response.status_code, content=content,
+                                    content_encoding=content_encoding,
+                                    headers=dict(response.headers)))
+        text = json.dumps(entries)
+        # Python 2: dumps returns bytes, text files take unicode
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        outfile.write(text)
+
+    @classmethod
+    def load(cls, infile):
+        "Return the Replay of the exchanges written by dump."
+        replay = cls()
+        for entry in json.load(infile):
+            params = tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in entry['params'])
+            data, data_encoding = entry['data'], entry.get('data_encoding')
+            if data_encoding == 'file':
+                data = ('MultipartFile', data['filename'], data['sha1'])
+            elif data is not None:
+                data = _load_bytes(data, data_encoding)
+            content = _load_bytes(entry['content'], entry.get('content_encoding'))
+            replay._record((entry['method'], entry['uri'], params, data),
+                           Response(entry['status_code'], content, entry['headers']))
+        return replay
+
+
+class Recorder(object):
+    "Transport passing the requests to another one and recording the exchanges in a Replay."
+
+    def __init__(self, transport, replay=None):
+        self.transport = transport
+        self.replay = replay if replay is not None else Replay()
+
+    def __call__(self, request):
+        response = self.transport(request)
+        self.replay.record(request, response)
+        return response
@@ -0,0 +1,242 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Local queries over the entities held in the Lims cache.
+
+The indexes are built from the XML payloads of the cached instances, so
+a query never issues a request; instances which have not been retrieved
+(root is None) are simply not visible to it.
+"""
+
+from genologics.descriptors import UdfDictionary
+
+import threading
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Indexed field name -> path of the XML element(s) in the entity payload.
+# Fields referencing another entity are indexed on the text, the name
+# attribute and the uri attribute of the element, so that they can be
+# queried with a string as well as with an entity instance.
+INDEXED_FIELDS = (
+    ('name',           'name'),
+    ('type',           'type'),
+    ('output_type',    'output-type'),
+    ('qc_flag',        'qc-flag'),
+    ('state',          'state'),
+    ('date_run',       'date-run'),
+    ('working_flag',   'working-flag'),
+    ('parent_process', 'parent-process'),
+    ('container',      'location/container'),
+    ('sample',         'sample'),
+    ('project',        'project'),
+    ('researcher',     'researcher'),
+    ('submitter',      'submitter'),
+    ('technician',     'technician'),
+    ('lab',            'lab'),
+)
+
+
+def _limsid(uri):
+    return urlsplit(uri).path.split('/')[-1]
+
+
+def _key(value):
+    "Normalize a query value to the form stored in the indexes."
+    if hasattr(value, 'uri') and hasattr(value, 'lims'):
+        return value.uri
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    return value
+
+
+def _node_keys(node):
+    keys = set()
+    if node.text and node.text.strip():
+        keys.add(node.text.strip())
+    for attribute in ('name', 'limsid', 'uri'):
+        if attribute in node.attrib:
+            keys.add(node.attrib[attribute])
+    return keys
+
+
+def _udf_matches(value, operator, expected):
+    if value is None:
+        return False
+    try:
+        if operator == 'min':
+            return value >= expected
+        elif operator == 'max':
+            return value <= expected
+    except TypeError:
+        return False
+    return value == expected
+
+
+class EntityIndex(object):
+    """Secondary indexes over the cached instances of one entity class.
+
+    The index is refreshed incrementally: an instance is (re)indexed when
+    its root element differs from the one seen at the last refresh. Changes
+    made in place to an already indexed root are picked up by calling
+    reindex() for the instance.
+    """
+
+    def __init__(self, lims, klass):
+        self.lims = lims
+        self.klass = klass
+        self._roots = dict()    # uri -> root element the entry was built from
+        self._entries = dict()  # uri -> list of (field, key)
+        self._udfs = dict()     # uri -> dict of UDF name -> value
+        self._fields = dict()   # field -> key -> set of uris
+
+    def __len__(self):
+        return len(self._roots)
+
+    def refresh(self):
+        "Bring the indexes up to date with the instances in the cache."
+        seen = set()
+        with self.lims.cache_lock:
+            cached = list(self.lims.cache.items())
+        for uri, instance in cached:
+            if type(instance) is not self.klass or instance.root is None:
+                continue
+            seen.add(uri)
+            if self._roots.get(uri) is not instance.root:
+                self.reindex(instance)
+        for uri in set(self._roots) - seen:
+            self._drop(uri)
+
+    def reindex(self, instance):
+        "Index the current payload of the instance."
+        uri = instance.uri
+        self._drop(uri)
+        root = instance.root
+        if root is None:
+            return
+        entries = [('limsid', _limsid(uri))]
+        for field, path in INDEXED_FIELDS:
+            for node in root.findall(path):
+                for key in _node_keys(node):
+                    entries.append((field, key))
+        if 'name' in root.attrib:
+            entries.append(('name', root.attrib['name']))
+        for field, key in entries:
+            self._fields.setdefault(field, dict()).setdefault(key, set()).add(uri)
+        self._entries[uri] = entries
+        self._udfs[uri] = dict(UdfDictionary(instance).items())
+        self._roots[uri] = root
+
+    def _drop(self, uri):
+        for field, key in self._entries.pop(uri, []):
+            uris = self._fields[field][key]
+            uris.discard(uri)
+            if not uris:
+                del self._fields[field][key]
+        self._udfs.pop(uri, None)
+        self._roots.pop(uri, None)
+
+    def values(self, field):
+        "Return the set of indexed values for the field."
+        return set(self._fields.get(field, dict()))
+
+    def uris(self, field, value):
+        """Return the set of uris whose field matches the value, or any
+        of the values if a list, tuple or set is given."""
+        index = self._fields.get(field, dict())
+        if isinstance(value, (list, tuple, set, frozenset)):
+            result = set()
+            for v in value:
+                result.update(index.get(_key(v), ()))
+            return result
+        return set(index.get(_key(value), ()))
+
+    def filter(self, udf=dict(), **kwargs):
+        """Return the set of uris matching all the criteria.
+
+        kwargs: indexed field name -> value, list of values or entity.
+        udf: dictionary of UDF criteria. Keys are 'UDFNAME', 'UDFNAME.min'
+             or 'UDFNAME.max' as for the server-side UDF filters; values are
+             the expected value, or a callable predicate on the UDF value.
+        """
+        # Intersect starting from the most selective criterion
+        matches = sorted((self.uris(field, value) for field, value in kwargs.items()),
+                         key=len)
+        if matches:
+            candidates = matches[0]
+            for uris in matches[1:]:
+                candidates &= uris
+        else:
+            candidates = set(self._roots)
+        for key, expected in udf.items():
+            name, operator = key, None
+            for suffix in ('.min', '.max'):
+                if key.endswith(suffix):
+                    name, operator = key[:-len(suffix)], suffix[1:]
+            if callable(expected):
+                test = lambda v, f=expected: v is not None and f(v)
+            else:
+                test = lambda v, o=operator, e=expected: _udf_matches(v, o, e)
+            candidates = set(uri for uri in candidates
+                             if test(self._udfs[uri].get(name)))
+        return candidates
+
+
+class LocalQuery(object):
+    """Query interface over the Lims cache, holding one EntityIndex per
+    entity class. Results are the instances from the cache itself.
+
+    Usage:
+    failed = lims.query(Artifact, qc_flag='FAILED', type='Analyte',
+                        project=project, udf={'Concentration.max': 2})
+    """
+
+    def __init__(self, lims):
+        self.lims = lims
+        self.indexes = dict()
+        # The indexes are refreshed and read by one thread at a time
+        self.lock = threading.RLock()
+
+    def index(self, klass):
+        "Return the up to date EntityIndex for the entity class."
+        with self.lock:
+            try:
+                index = self.indexes[klass]
+            except KeyError:
+                index = self.indexes[klass] = EntityIndex(self.lims, klass)
+            index.refresh()
+            return index
+
+    def filter(self, klass, udf=dict(), project=None, **kwargs):
+        """Return the cached instances of klass matching the criteria,
+        sorted by LIMS id. See EntityIndex.filter for the criteria.
+
+        project: for Artifacts, which have no project element, the project
+                 is matched through the cached Samples of the artifact.
+        """
+        from genologics.entities import Artifact, Sample
+        if project is not None and klass is not Artifact:
+            kwargs['project'] = project
+        with self.lock:
+            index = self.index(klass)
+            uris = index.filter(udf=udf, **kwargs)
+            if project is not None and klass is Artifact:
+                samples = self.index(Sample).uris('project', project)
+                uris &= index.uris('sample', samples)
+        result = dict()
+        for uri in uris:
+            instance = self.lims.cache.get(uri)
+            if instance is None:
+                continue
+            # Artifacts may be cached both with and without a state;
+            # report each LIMS id once, preferring the stateless uri.
+            previous = result.get(instance.id)
+            if previous is None or '?' in previous.uri:
+                result[instance.id] = instance
+        return [result[id] for id in sorted(result)]
@@ -0,0 +1,346 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Transports: functions exchanging a protocol.Request for a response. The
+transport of a Lims is its http_transport by default; the classes here
+wrap another transport to add behaviour, and can be stacked:
+
+lims.transport = RetryingTransport(
+    RateLimitedTransport(lims.http_transport, max_in_flight=8,
+                         limits=dict(listing=Limit(rate=2, burst=4))),
+    retry=RetryPolicy(retries=5), breaker=CircuitBreaker())
+"""
+
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+
+# python 2.7, 3+ compatibility
+from sys import version_info
+
+if version_info[0] == 2:
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    "Raised instead of sending a request while the circuit breaker is open."
+
+
+class RetryPolicy(object):
+    """When and how long to wait before sending a request again.
+
+    retries: maximum number of retries of a request.
+    backoff: delay before the first retry, in seconds, doubled at each retry
+             up to max_backoff.
+    jitter: fraction of the delay which is random, so that clients do not
+            retry in lockstep.
+    statuses: response statuses considered transient.
+    retry_writes: also retry PUT, POST and DELETE requests. GETs, HEADs and
+                  the batch/retrieve POSTs, which are idempotent, are
+                  always retried.
+    """
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, jitter=0.5,
+                 statuses=(502, 503, 504), retry_writes=False):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.retry_writes = retry_writes
+
+    def retryable(self, request):
+        "Whether the request may be sent again."
+        if request.method in ('GET', 'HEAD') or self.retry_writes:
+            return True
+        return request.method == 'POST' and request.uri.rstrip('/').endswith('batch/retrieve')
+
+    def delay(self, attempt):
+        "Seconds to wait before the retry number attempt (from 0)."
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker(object):
+    """Fail fast while the server is failing.
+
+    After threshold consecutive failures the circuit opens: requests are
+    refused with a CircuitOpenError for reset_timeout seconds. Then one trial
+    request is let through; its success closes the circuit, its failure
+    opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before(self):
+        "Raise a CircuitOpenError if the request must not be sent."
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError("Circuit open after {0} failures".format(self.failures))
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        "Record a failure; return True if it opened the circuit."
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+                return True
+            return False
+
+
+class RetryingTransport(object):
+    """Transport retrying the transient failures of another one, with
+    exponential backoff, behind an optional circuit breaker.
+
+    counters: Counter of requests, retries, failures (transient statuses and
+              connection errors), opened (circuit openings) and rejected
+              (requests refused by the open circuit).
+    """
+
+    def __init__(self, transport, retry=None, breaker=None, sleep=time.sleep):
+        self.transport = transport
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.breaker = breaker
+        self.sleep = sleep
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def _give_up(self, request, attempt):
+        """Record a failure of the request; return True if it must not be
+        retried. The request opening the circuit is not retried."""
+        self._count('failures')
+        if self.breaker is not None and self.breaker.failure():
+            self._count('opened')
+            logger.warning("LIMS circuit breaker opened")
+            return True
+        return attempt >= self.retry.retries or not self.retry.retryable(request)
+
+    def __call__(self, request):
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                try:
+                    self.breaker.before()
+                except CircuitOpenError:
+                    self._count('rejected')
+                    raise
+            self._count('requests')
+            try:
+                response = self.transport(request)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if self._give_up(request, attempt):
+                    raise
+                logger.info("Retrying {0} after {1}".format(request, e))
+            except Exception:
+                # Not retried, but a failure for the circuit breaker, which
+                # would otherwise stay half-open after a failed trial request
+                self._count('failures')
+                if self.breaker is not None and self.breaker.failure():
+                    self._count('opened')
+                    logger.warning("LIMS circuit breaker opened")
+                raise
+            else:
+                if response.status_code not in self.retry.statuses:
+                    if self.breaker is not None:
+                        self.breaker.success()
+                    return response
+                if self._give_up(request, attempt):
+                    return response
+                logger.info("Retrying {0} after status {1}".format(request, response.status_code))
+            self._count('retries')
+            self.sleep(self.retry.delay(attempt))
+            if hasattr(request.data, 'seek'):
+                # A file-like body, such as an upload, is sent again from the start
+                request.data.seek(0)
+            attempt += 1
+
+
+def endpoint_class(request):
+    """Return the class of the endpoint of the request: 'batch' for the batch
+    requests, 'write' for the other PUT, POST and DELETE, 'listing' for a
+    GET of a list of instances, or 'get' for a GET of a single instance.
+    The class is given by the path alone: a single instance may also be
+    requested with a query, e.g. the state of an artifact."""
+    path = urlparse(request.uri).path
+    if '/batch/' in path:
+        return 'batch'
+    if request.method == 'HEAD':
+        return 'get'
+    if request.method != 'GET':
+        return 'write'
+    segments = path.strip('/').split('/')
+    if 'api' in segments:
+        # Skip the api and version segments
+        segments = segments[segments.index('api') + 2:]
+    if segments[:1] == ['configuration']:
+        segments = segments[1:]
+    return 'listing' if len(segments) <= 1 else 'get'
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: at most burst requests at once, refilled at
+    rate requests per second."""
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for it if the bucket is empty; return the
+        time waited. The tokens are reserved in the order of the calls."""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            self.sleep(delay)
+        return delay
+
+
+class Limit(object):
+    """Limits of a class of endpoints.
+
+    rate: maximum requests per second, None for no limit.
+    burst: number of requests which may be sent at once above the rate.
+    max_in_flight: maximum number of concurrent requests, None for no limit.
+    """
+
+    def __init__(self, rate=None, burst=1, max_in_flight=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+
+
+class RateLimitedTransport(object):
+    """Transport limiting the rate and the concurrency of the requests to
+    another one, for all the threads sharing it.
+
+    limits: dictionary of endpoint class (see endpoint_class) to Limit; the
+            classes not given are not limited.
+    max_in_flight: maximum number of concurrent requests over all classes,
+                   None for no limit.
+    counters: Counter of the requests by endpoint class, and of the requests
+              delayed by the rate limit (throttled).
+
+    To remove the limits, and their cost, set the Lims transport back to the
+    wrapped one.
+    """
+
+    def __init__(self, transport, limits=None, max_in_flight=None,
+                 clock=time.time, sleep=time.sleep):
+        self.transport = transport
+        self.buckets = dict()
+        self.semaphores = dict()
+        for name, limit in (limits or dict()).items():
+            if limit.rate is not None:
+                self.buckets[name] = TokenBucket(limit.rate, limit.burst, clock=clock, sleep=sleep)
+            if limit.max_in_flight is not None:
+                self.semaphores[name] = threading.BoundedSemaphore(limit.max_in_flight)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        name = endpoint_class(request)
+        bucket = self.buckets.get(name)
+        waited = bucket.acquire() if bucket is not None else 0
+        with self._lock:
+            self.counters[name] += 1
+            if waited:
+                self.counters['throttled'] += 1
+        semaphores = [s for s in (self.semaphores.get(name), self.in_flight) if s is not None]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            return self.transport(request)
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+
+class _Call(object):
+    "A call in progress, see Coalescer."
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer(object):
+    """Share the result of a call between the threads making identical calls
+    at the same time: the first one makes the call, the others wait for its
+    result, or its exception.
+
+    counters: Counter of the calls made (calls) and shared (coalesced).
+    """
+
+    def __init__(self):
+        self.calls = dict()
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def call(self, key, func):
+        "Return func(), or the result of the call of the same key in progress."
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                self.counters['calls'] += 1
+                leader = True
+            else:
+                self.counters['coalesced'] += 1
+                leader = False
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
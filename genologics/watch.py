@@ -0,0 +1,257 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Change feed: polls the LIMS for modified entities and emits events.
+
+Processes and containers are polled with the last_modified filter of the
+listing calls, starting from a watermark which moves forward at each poll.
+The digest of the retrieved XML is compared with the previous one, so an
+entity which is listed again without having changed does not give a new
+event; only the digests are kept between polls. Queues are polled with
+conditional requests, and their contents are diffed.
+
+Usage:
+watcher = Watcher(lims)
+watcher.watch_processes(type='Library Normalization')
+watcher.watch_queue(Queue(lims, id='1234'))
+for event in watcher.events(interval=30):
+    if isinstance(event, Created):
+        ...
+"""
+
+import datetime
+import hashlib
+import time
+from xml.etree import ElementTree
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+LAST_MODIFIED_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class ChangeEvent(object):
+    """Base class of the events emitted by a Watcher.
+
+    entity: the created, modified or removed entity instance.
+    source: the WatchSource which detected the change.
+    previous: the fingerprint of the XML of the entity at the previous poll,
+              if known.
+    """
+
+    kind = None
+
+    def __init__(self, entity, source, previous=None):
+        self.entity = entity
+        self.source = source
+        self.previous = previous
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.entity)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.entity == other.entity
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.kind, self.entity))
+
+
+class Created(ChangeEvent):
+    "The entity was seen for the first time by the watcher."
+    kind = 'created'
+
+
+class Modified(ChangeEvent):
+    "The entity has changed since the previous poll."
+    kind = 'modified'
+
+
+class Removed(ChangeEvent):
+    "The entity is no longer present (e.g. an artifact has left a queue)."
+    kind = 'removed'
+
+
+def fingerprint(lims, root):
+    "Return a digest of the XML content, used to detect changes."
+    return hashlib.sha1(lims.tostring(ElementTree.ElementTree(root))).hexdigest()
+
+
+class WatchSource(object):
+    "Abstract base class for the sources of change events."
+
+    def __init__(self, lims):
+        self.lims = lims
+        # uri -> fingerprint of the entities seen so far
+        self.state = dict()
+
+    def poll(self):
+        "Return the list of events since the previous poll."
+        raise NotImplementedError
+
+    def _diff(self, entity, root):
+        "Record the fingerprint of the new root of the entity and return the event, or None."
+        previous = self.state.get(entity.uri)
+        digest = fingerprint(self.lims, root)
+        self.state[entity.uri] = digest
+        if previous is None:
+            return Created(entity, self, None)
+        elif previous != digest:
+            return Modified(entity, self, previous)
+        return None
+
+
+class ModifiedSinceSource(WatchSource):
+    """Entities listed with the last_modified filter of a listing method,
+    e.g. Lims.get_processes or Lims.get_containers.
+
+    The watermark starts at the time the source is created, unless given
+    as an ISO format datetime string. Each poll lists the entities modified
+    since the previous poll, minus an overlap in seconds which covers clock
+    differences with the server. The entities listed are retrieved again
+    and compared with their previous XML, so that the overlap does not give
+    duplicate events: with one batch request for the entity types with a
+    batch retrieve endpoint (artifacts, containers, samples, files), for
+    which batch is to be True, else with concurrent GETs.
+    """
+
+    def __init__(self, lims, listing, since=None, overlap=60, batch=False, **filters):
+        super(ModifiedSinceSource, self).__init__(lims)
+        self.listing = listing
+        self.batch = batch
+        self.filters = filters
+        self.overlap = overlap
+        if since is None:
+            since = datetime.datetime.utcnow().strftime(LAST_MODIFIED_FORMAT)
+        self.watermark = since
+
+    def poll(self):
+        started = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.overlap)
+        entities = self.listing(last_modified=self.watermark, **self.filters)
+        self.refetch(entities)
+        self.watermark = started.strftime(LAST_MODIFIED_FORMAT)
+        events = []
+        for entity in entities:
+            event = self._diff(entity, entity.root)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def refetch(self, entities):
+        "Retrieve the current XML of the listed entities."
+        if self.batch:
+            self.lims.get_batch(entities, force=True)
+        else:
+            self.lims.resolve_many(entities, force=True)
+
+
+class QueueSource(WatchSource):
+    """Contents of a Queue. Artifacts entering the queue give Created events,
+    artifacts leaving it Removed events. The queue is polled with conditional
+    requests, so that an unchanged queue costs no transfer nor parsing when
+    the server supports it.
+    """
+
+    def __init__(self, lims, queue):
+        super(QueueSource, self).__init__(lims)
+        self.queue = queue
+        self.validators = None
+
+    def poll(self):
+        from genologics.entities import Artifact
+        root, self.validators = self.lims.get_if_modified(self.queue.uri, self.validators)
+        if root is None:
+            return []
+        self.queue.root = root
+        events = []
+        present = set()
+        artifacts = root.find('artifacts')
+        for node in (artifacts if artifacts is not None else []):
+            if node.tag != 'artifact':
+                continue
+            artifact = Artifact(self.lims, uri=node.attrib['uri'])
+            present.add(artifact.uri)
+            event = self._diff(artifact, node)
+            if event is not None:
+                events.append(event)
+        for uri in sorted(set(self.state) - present):
+            previous = self.state.pop(uri)
+            events.append(Removed(Artifact(self.lims, uri=uri), self, previous))
+        return events
+
+
+class Watcher(object):
+    """Polls a set of sources and delivers the change events to the
+    subscribed callbacks, or through the events() iterator."""
+
+    def __init__(self, lims, overlap=60):
+        self.lims = lims
+        self.overlap = overlap
+        self.sources = []
+        self.callbacks = []
+        self._stopped = False
+
+    def add_source(self, source):
+        self.sources.append(source)
+        return source
+
+    def watch_processes(self, since=None, **filters):
+        """Watch the processes, filtered by the keyword arguments of
+        Lims.get_processes."""
+        return self.add_source(ModifiedSinceSource(self.lims, self.lims.get_processes,
+                                                   since=since, overlap=self.overlap,
+                                                   **filters))
+
+    def watch_containers(self, since=None, **filters):
+        """Watch the containers, filtered by the keyword arguments of
+        Lims.get_containers."""
+        return self.add_source(ModifiedSinceSource(self.lims, self.lims.get_containers,
+                                                   since=since, overlap=self.overlap,
+                                                   batch=True, **filters))
+
+    def watch_queue(self, queue):
+        "Watch the artifacts entering and leaving the queue."
+        return self.add_source(QueueSource(self.lims, queue))
+
+    def subscribe(self, callback, kinds=None):
+        """Call callback(event) for each event, optionally only for the given
+        event classes (e.g. [Created, Removed])."""
+        self.callbacks.append((callback, tuple(kinds) if kinds else ChangeEvent))
+
+    def poll(self):
+        """Poll all the sources once, deliver the events to the callbacks and
+        return them."""
+        events = []
+        for source in self.sources:
+            events.extend(source.poll())
+        for event in events:
+            for callback, kinds in self.callbacks:
+                if isinstance(event, kinds):
+                    callback(event)
+        return events
+
+    def events(self, interval=60, max_polls=None):
+        """Iterate over the events, polling the sources every interval seconds
+        until stop() is called, or max_polls polls have been made."""
+        self._stopped = False
+        polls = 0
+        while not self._stopped:
+            started = time.time()
+            for event in self.poll():
+                yield event
+            polls += 1
+            if max_polls is not None and polls >= max_polls:
+                break
+            delay = interval - (time.time() - started)
+            if delay > 0 and not self._stopped:
+                time.sleep(delay)
+
+    def run(self, interval=60, max_polls=None):
+        "Poll the sources until stopped; events go to the callbacks only."
+        for event in self.events(interval=interval, max_polls=max_polls):
+            pass
+
+    def stop(self):
+        self._stopped = True
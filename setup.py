@@ -47,8 +47,12 @@ setup(name='genologics',
       include_package_data=True,
       zip_safe=False,
       install_requires=[
-          "requests"
+          "requests",
+          'futures; python_version < "3"'
       ],
+      extras_require={
+          'async': ['aiohttp; python_version >= "3.6"'],
+      },
       entry_points="""
       # -*- Entry points: -*-
       """,
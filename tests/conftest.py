@@ -0,0 +1,4 @@
+from sys import version_info
+
+# asyncio syntax does not compile on Python 2
+collect_ignore = ['test_async_lims.py'] if version_info[0] < 3 else []
@@ -0,0 +1,175 @@
+import threading
+from sys import version_info
+from unittest import TestCase, skipIf
+from xml.etree import ElementTree
+
+from genologics.lims import Lims
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if version_info[0] >= 3:
+    import asyncio
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from genologics.async_lims import AsyncLims
+    from genologics.entities import Process, Sample
+else:
+    BaseHTTPRequestHandler = object
+
+samples_xml = """<smp:samples xmlns:smp="http://genologics.com/ri/sample">{entries}{next}</smp:samples>"""
+sample_xml = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{url}/api/v2/samples/{id}" limsid="{id}">
+<name>name {id}</name></smp:sample>"""
+process_xml = """<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/{id}" limsid="{id}">
+<type>Library Prep</type></prc:process>"""
+
+
+class FakeLims(BaseHTTPRequestHandler):
+    "Stand-in for the LIMS REST API, recording the requests."
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, content=''):
+        self.send_response(status)
+        self.send_header('content-type', 'application/xml')
+        if self.headers.get('authorization') is not None:
+            self.server.session = 's{0}'.format(len(self.server.auth))
+            self.send_header('set-cookie', 'JSESSIONID={0}; Path=/'.format(self.server.session))
+        self.end_headers()
+        self.wfile.write(content.encode('utf-8'))
+
+    def _authenticated(self):
+        """Record how the request is authenticated; answer 401 to an expired
+        session cookie."""
+        basic = self.headers.get('authorization') is not None
+        self.server.auth.append('basic' if basic else 'cookie')
+        if basic or 'JSESSIONID={0}'.format(self.server.session) in self.headers.get('cookie', ''):
+            return True
+        self._reply(401)
+        return False
+
+    def do_GET(self):
+        url = self.server.url
+        self.server.requests.append(('GET', self.path))
+        if not self._authenticated():
+            return
+        path, _, query = self.path.partition('?')
+        if path == '/api/v2/samples':
+            if 'page=2' in query:
+                ids, next = ['S3'], ''
+            else:
+                assert 'projectlimsid=P1' in query
+                ids, next = ['S1', 'S2'], '<next-page uri="{0}/api/v2/samples?page=2"/>'.format(url)
+            entries = ''.join('<sample uri="{0}/api/v2/samples/{1}" limsid="{1}"/>'.format(url, i) for i in ids)
+            self._reply(200, samples_xml.format(entries=entries, next=next))
+        elif path.startswith('/api/v2/processes/'):
+            self._reply(200, process_xml.format(url=url, id=path.split('/')[-1]))
+        else:
+            self._reply(404, '<exc:exception xmlns:exc="http://genologics.com/ri/exception"><message>not found</message></exc:exception>')
+
+    def do_POST(self):
+        url = self.server.url
+        data = self.rfile.read(int(self.headers['content-length']))
+        self.server.requests.append(('POST', self.path))
+        if not self._authenticated():
+            return
+        if self.path == '/api/v2/samples/batch/retrieve':
+            ids = [link.attrib['uri'].split('/')[-1] for link in ElementTree.fromstring(data)]
+            entries = ''.join(sample_xml.format(url=url, id=i) for i in ids)
+            self._reply(200, '<smp:details xmlns:smp="http://genologics.com/ri/sample">{0}</smp:details>'.format(entries))
+        elif self.path == '/api/v2/samples/batch/update':
+            self.server.updated = ElementTree.fromstring(data)
+            self._reply(200, '<ri:links xmlns:ri="http://genologics.com/ri"/>')
+        else:
+            self._reply(404)
+
+
+@skipIf(version_info[0] < 3 or aiohttp is None, "requires Python 3 and aiohttp")
+class TestAsyncLims(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeLims)
+        self.server.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.server.requests = []
+        self.server.auth = []
+        self.server.session = None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.lims = Lims(self.server.url, username='test', password='password')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_get_samples(self):
+        async def run():
+            async with AsyncLims(self.lims) as alims:
+                return await alims.get_samples(projectlimsid='P1', resolve=True)
+        samples = self.run_async(run())
+        assert [s.id for s in samples] == ['S1', 'S2', 'S3']
+        assert samples[0] is Sample(self.lims, id='S1')
+        assert samples[2].name == 'name S3'
+        assert [r[0] for r in self.server.requests] == ['GET', 'GET', 'POST']
+
+    def test_iter_and_put_batch(self):
+        async def run():
+            async with AsyncLims(self.lims) as alims:
+                samples = [s async for s in alims.iter_samples(projectlimsid='P1')]
+                await alims.get_batch(samples)
+                samples[0].name = 'renamed'
+                await alims.put_batch(samples[:1])
+                return samples
+        samples = self.run_async(run())
+        assert len(samples) == 3
+        assert self.server.updated[0].find('name').text == 'renamed'
+
+    def test_resolve_many(self):
+        processes = [Process(self.lims, id='p{0}'.format(i)) for i in range(10)]
+
+        async def run():
+            async with AsyncLims(self.lims, limit=3) as alims:
+                await alims.resolve_many(processes + processes[:2])
+        self.run_async(run())
+        assert len(self.server.requests) == 10
+        assert all(p.type_name == 'Library Prep' for p in processes)
+
+    def test_error(self):
+        from requests.exceptions import HTTPError
+
+        async def run():
+            async with AsyncLims(self.lims) as alims:
+                await alims.get(self.lims.get_uri('missing'))
+        self.assertRaises(HTTPError, self.run_async, run())
+
+    def test_session_cookie(self):
+        processes = [Process(self.lims, id='p{0}'.format(i)) for i in range(3)]
+
+        async def run():
+            async with AsyncLims(self.lims) as alims:
+                await alims.get(processes[0].uri)
+                await alims.get(processes[1].uri)
+                # The session expires: authenticate again
+                self.server.session = 'other'
+                await alims.get(processes[2].uri)
+                return alims.get_session_cookie()
+        assert self.run_async(run()) == 's4'
+        assert self.server.auth == ['basic', 'cookie', 'cookie', 'basic']
+
+        # Starting with the session cookie of the Lims
+        self.lims.request_session.cookies.set('JSESSIONID', 's4')
+
+        async def run_again():
+            async with AsyncLims(self.lims) as alims:
+                await alims.get(processes[0].uri)
+        self.run_async(run_again())
+        assert self.server.auth[4:] == ['cookie']
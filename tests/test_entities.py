@@ -1,10 +1,11 @@
 import operator
+from concurrent.futures import ThreadPoolExecutor
 from sys import version_info
 from unittest import TestCase
 from xml.etree import ElementTree
 
 from genologics.entities import StepActions, Researcher, Artifact, \
-    Step, StepPlacements, Container, Stage, ReagentKit, ReagentLot, Sample, Project
+    Step, StepPlacements, Container, Stage, ReagentKit, ReagentLot, Sample, Project, Process
 from genologics.lims import Lims
 
 if version_info[0] == 2:
@@ -81,6 +82,19 @@ generic_reagentlot_xml = """<?xml version='1.0' encoding='utf-8'?>
 <usage-count>1</usage-count>
 </lot:reagent-lot>"""
 
+generic_process_xml = """<?xml version='1.0' encoding='utf-8'?>
+<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/p1" limsid="p1">
+<input-output-map><input uri="{url}/api/v2/artifacts/i3" limsid="i3"/><output uri="{url}/api/v2/artifacts/o3" limsid="o3" output-type="Analyte" output-generation-type="PerInput"/></input-output-map>
+<input-output-map><input uri="{url}/api/v2/artifacts/i1" limsid="i1"/><output uri="{url}/api/v2/artifacts/o1" limsid="o1" output-type="Analyte" output-generation-type="PerInput"/></input-output-map>
+<input-output-map><input uri="{url}/api/v2/artifacts/i3" limsid="i3"/><output uri="{url}/api/v2/artifacts/f1" limsid="f1" output-type="SharedResultFile" output-generation-type="PerAllInputs"/></input-output-map>
+<input-output-map><input uri="{url}/api/v2/artifacts/i1" limsid="i1"/><output uri="{url}/api/v2/artifacts/f1" limsid="f1" output-type="SharedResultFile" output-generation-type="PerAllInputs"/></input-output-map>
+</prc:process>"""
+
+generic_process_artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{url}/api/v2/artifacts/{id}" limsid="{id}">
+<type>{type}</type><output-type>{type}</output-type>
+<location><container uri="{url}/api/v2/containers/{container}" limsid="{container}"/><value>A:1</value></location>
+</art:artifact>"""
+
 generic_step_actions_xml = """<stp:actions xmlns:stp="http://genologics.com/ri/step" uri="...">
   <step rel="..." uri="{url}/steps/s1">
   </step>
@@ -177,6 +191,38 @@ class TestEntities(TestCase):
         return self.lims.tostring(ElementTree.ElementTree(entity.root)).decode("utf-8")
 
 
+class TestThreadSafety(TestEntities):
+    process_xml = generic_process_xml.format(url=url)
+
+    def test_identity_map(self):
+        def create(i):
+            return Artifact(self.lims, id='a{0}'.format(i % 50))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            artifacts = list(executor.map(create, range(5000)))
+        for i, artifact in enumerate(artifacts):
+            assert artifact is artifacts[i % 50]
+            assert artifact.id == 'a{0}'.format(i % 50)
+        assert len(self.lims.cache) == 50
+
+    def test_eviction(self):
+        with patch('genologics.entities.CACHE_N_ENTRIES', 100):
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                list(executor.map(lambda i: Artifact(self.lims, id='a{0}'.format(i)), range(1000)))
+        assert len(self.lims.cache) == 100
+
+    def test_descriptors(self):
+        processes = [Process(self.lims, id='p{0}'.format(i)) for i in range(20)]
+        for i, process in enumerate(processes):
+            process.root = ElementTree.fromstring(self.process_xml.replace('i3', 'i3-{0}'.format(i)))
+
+        def inputs(process):
+            return [process.input_output_maps[0][0]['limsid'] for j in range(50)]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(inputs, processes * 10))
+        for i, result in enumerate(results):
+            assert set(result) == set(['i3-{0}'.format(i % 20)])
+
+
 class TestStepActions(TestEntities):
     step_actions_xml = generic_step_actions_xml.format(url=url)
     step_actions_no_escalation_xml = generic_step_actions_no_escalation_xml.format(url=url)
@@ -267,6 +313,35 @@ class TestArtifacts(TestEntities):
             assert a.workflow_stages_and_statuses == expected_wf_stage
 
 
+class TestProcess(TestEntities):
+    process_xml = generic_process_xml.format(url=url)
+
+    def _batch(self, uri, data=None, **kwargs):
+        ids = [link.attrib['uri'].split('/')[-1] for link in ElementTree.fromstring(data)]
+        types = {'f1': 'SharedResultFile'}
+        entries = ''.join(generic_process_artifact_xml.format(
+            url=url, id=i, type=types.get(i, 'Analyte'), container='c' + i[1]) for i in ids)
+        return Mock(status_code=200, content='<art:details xmlns:art="http://genologics.com/ri/artifact">{0}</art:details>'.format(entries))
+
+    def test_all_inputs_outputs(self):
+        p = Process(self.lims, id='p1')
+        with patch('requests.Session.get', return_value=Mock(content=self.process_xml, status_code=200)):
+            assert [a.id for a in p.all_inputs()] == ['i3', 'i1']
+            assert [a.id for a in p.all_inputs(unique=False)] == ['i3', 'i1', 'i3', 'i1']
+            assert [a.id for a in p.all_outputs()] == ['o3', 'o1', 'f1']
+
+    def test_helpers_batch(self):
+        p = Process(self.lims, id='p1')
+        with patch('requests.Session.get', return_value=Mock(content=self.process_xml, status_code=200)) as get, \
+                patch('genologics.lims.requests.post', side_effect=self._batch) as post:
+            analytes, info = p.analytes()
+            assert ([a.id for a in analytes], info) == (['o3', 'o1'], 'Output')
+            assert [a.id for a in p.shared_result_files()] == ['f1']
+            assert [c.id for c in p.output_containers()] == ['c3', 'c1']
+            assert get.call_count == 1
+            assert post.call_count == 1
+
+
 class TestReagentKits(TestEntities):
     url = 'http://testgenologics.com:4040'
     reagentkit_xml = generic_reagentkit_xml.format(url=url)
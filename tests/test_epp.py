@@ -0,0 +1,465 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, skipIf
+from xml.etree import ElementTree
+
+from genologics import config, epp
+from genologics.entities import File, Process
+from genologics.lims import Lims
+from genologics.protocol import Response
+
+if sys.version_info[0] == 2:
+    from mock import patch, Mock
+else:
+    from unittest.mock import patch, Mock
+
+url = 'http://testgenologics.com:4040'
+
+process_xml = """<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/24-1" limsid="24-1">
+<type>Plate Reader</type>
+{maps}
+</prc:process>"""
+
+map_xml = """<input-output-map>
+<input uri="{url}/api/v2/artifacts/{input}" limsid="{input}"/>
+<output uri="{url}/api/v2/artifacts/{output}" limsid="{output}" output-type="{type}" output-generation-type="{generation}"/>
+</input-output-map>"""
+
+artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" xmlns:file="http://genologics.com/ri/file" uri="{url}/api/v2/artifacts/{id}" limsid="{id}">
+<name>{name}</name><output-type>{type}</output-type>{file}</art:artifact>"""
+
+file_xml = """<file:file xmlns:file="http://genologics.com/ri/file" uri="{url}/api/v2/files/{id}" limsid="{id}">
+<content-location>sftp://lims.scilifelab.se{path}</content-location></file:file>"""
+
+
+class FakeLims(object):
+    """Transport answering for a process, its artifacts and their files,
+    counting the requests."""
+
+    def __init__(self, maps, artifacts, files):
+        self.maps = maps
+        self.artifacts = artifacts
+        self.files = files
+        self.requests = []
+
+    def __call__(self, request):
+        path = request.uri.split('/api/v2/')[1]
+        self.requests.append((request.method, path))
+        if path.endswith('/download'):
+            with open(self.files[path.split('/')[1]], 'rb') as f:
+                return Response(200, f.read())
+        if path == 'processes/24-1':
+            maps = ''.join(map_xml.format(url=url, input=i, output=o, type=t, generation=g)
+                           for i, o, t, g in self.maps)
+            return Response(200, process_xml.format(url=url, maps=maps))
+        if path.endswith('batch/retrieve'):
+            ids = [link.attrib['uri'].split('/')[-1] for link in ElementTree.fromstring(request.data)]
+            if path.startswith('artifacts'):
+                nodes = []
+                for id in ids:
+                    name, type, file_id = self.artifacts[id]
+                    file = '<file:file uri="{0}/api/v2/files/{1}" limsid="{1}"/>'.format(url, file_id) if file_id else ''
+                    nodes.append(artifact_xml.format(url=url, id=id, name=name, type=type, file=file))
+                tag = 'art:details xmlns:art="http://genologics.com/ri/artifact"'
+            else:
+                nodes = [file_xml.format(url=url, id=id, path=self.files[id]) for id in ids]
+                tag = 'file:details xmlns:file="http://genologics.com/ri/file"'
+            return Response(200, '<{0}>{1}</{2}>'.format(tag, ''.join(nodes), tag.split()[0]))
+        return Response(404, '<exception><message>not found</message></exception>')
+
+
+class TestReadResultFiles(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.shared = os.path.join(self.tmpdir, 'plate.csv')
+        with open(self.shared, 'w') as f:
+            f.write('Plate reader export\nWell,Conc,Flag\nA1,1.5,\nB1,2.5,x\n')
+        self.perinput = os.path.join(self.tmpdir, 'a1.txt')
+        with open(self.perinput, 'w') as f:
+            f.write('Sample\tValue\ns1\t3\\\n')
+        self.fake = FakeLims(
+            maps=[('a1', 'o1', 'ResultFile', 'PerAllInputs'), ('a2', 'o1', 'ResultFile', 'PerAllInputs'),
+                  ('a1', 'o2', 'ResultFile', 'PerInput'), ('a2', 'o3', 'ResultFile', 'PerInput')],
+            artifacts={'o1': ('Plate', 'SharedResultFile', '40-1'), 'o2': ('a1 result', 'ResultFile', '40-2'),
+                       'o3': ('a2 result', 'ResultFile', None)},
+            files={'40-1': self.shared, '40-2': self.perinput})
+        self.lims = Lims(url, username='test', password='password')
+        self.lims.transport = self.fake
+        self.process = Process(self.lims, id='24-1')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lazy(self):
+        files = epp.ReadResultFiles(self.process, resolver=epp.PathResolver(mounts=[], lims=self.lims))
+        assert self.fake.requests == []
+        assert list(files.shared_files) == ['Plate']
+        assert list(files.perinput_files.keys()) == ['a1 result']
+        assert [m for m, p in self.fake.requests] == ['GET', 'POST', 'POST']
+        assert files.shared_files['Plate'][1] == ['Well', 'Conc', 'Flag']
+        assert files.perinput_files['a1 result'] == [['Sample', 'Value'], ['s1', '3']]
+        assert len(self.fake.requests) == 3
+
+    def test_rows_and_columns(self):
+        files = epp.ReadResultFiles(self.process, resolver=epp.PathResolver(mounts=[], lims=self.lims))
+        rows = files.iter_rows('Plate')
+        assert next(rows) == ['Plate reader export']
+        columns = files.columns('Plate', header_row=1, types={'Conc': float})
+        assert list(columns) == ['Well', 'Conc', 'Flag']
+        assert list(columns['Conc']) == [1.5, 2.5]
+        assert columns['Flag'] == ['', 'x']
+        self.assertRaises(KeyError, files.iter_rows, 'a2 result')
+
+    def test_get_file_path(self):
+        with epp.ReadResultFiles(self.process, resolver=epp.PathResolver(mounts=[], lims=self.lims)) as files:
+            plate = [a for a in files.outputs() if a.name == 'Plate'][0]
+            assert files.get_file_path(plate) == self.shared
+            file = plate.files[0]
+            file.root.find('content-location').text = 'sftp://lims.scilifelab.se/glsftp/Project/qc'
+            assert files.get_file_path(plate) is None
+            file.root.find('content-location').text = 'sftp://lims.scilifelab.se/glsftp/Project/qc.csv'
+            assert files.get_file_path(plate) == '/glsftp/Project/qc.csv'
+        assert not [r for r in self.fake.requests if r[1].endswith('download')]
+
+
+class TestReadColumns(TestCase):
+
+    def test_repeated_names(self):
+        columns = epp.read_columns([['Well', '', '', 'Conc', 'Conc'], ['A1', '1', 'ng', '2', '3']],
+                                   types={'Conc': float, 'Well.1': int})
+        assert list(columns) == ['Well', 'Well.1', 'Well.2', 'Conc', 'Conc.1']
+        assert list(columns['Well.1']) == [1]
+        assert columns['Well.2'] == ['ng']
+        assert list(columns['Conc.1']) == [3.0]
+
+    def test_empty_int(self):
+        rows = [['Well', 'Reads', 'Conc'], ['A1', '', '']]
+        self.assertRaises(ValueError, epp.read_columns, rows, types={'Reads': int})
+        columns = epp.read_columns(rows, types={'Reads': int, 'Conc': float}, int_fill=0)
+        assert list(columns['Reads']) == [0]
+        assert columns['Conc'][0] != columns['Conc'][0]
+
+
+class TestPathResolver(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mount = os.path.join(self.tmpdir, 'mnt')
+        os.makedirs(os.path.join(self.mount, 'Project', 'run'))
+        self.local = os.path.join(self.mount, 'Project', 'run', 'qc.csv')
+        with open(self.local, 'w') as f:
+            f.write('a,b\n')
+        self.remote = os.path.join(self.tmpdir, 'remote.csv')
+        with open(self.remote, 'w') as f:
+            f.write('c,d\n')
+        self.lims = Lims(url, username='test', password='password')
+        self.fake = FakeLims([], {}, {'40-1': self.remote})
+        self.lims.transport = self.fake
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def file(self, id, content_location):
+        file = File(self.lims, id=id)
+        file.root = ElementTree.fromstring(file_xml.format(url=url, id=id, path='/x'))
+        file.root.find('content-location').text = content_location
+        return file
+
+    def test_mounts(self):
+        resolver = epp.PathResolver(mounts=[('sftp://lims.example.com/glsftp/', self.mount),
+                                            ('sftp://lims.example.com/', '/nowhere')])
+        location = 'sftp://lims.example.com/glsftp/Project/run/qc.csv'
+        assert resolver.local_path(location) == self.local
+        assert resolver.local_path('sftp://lims.example.com/glsftp/Project/run/other.csv') is None
+        # Without a matching mount, the path of the location is tried
+        assert resolver.local_path('sftp://other.example.com' + self.local) == self.local
+        # Existence checks are cached
+        os.remove(self.local)
+        assert resolver.local_path(location) == self.local
+        self.assertRaises(IOError, resolver.path, self.file('40-2', 'sftp://lims.example.com/glsftp/x.csv'))
+
+    def test_no_config(self):
+        with patch.dict(vars(config)), patch('genologics.config.find_config_file', return_value=None), \
+                patch('genologics.config.load_config', side_effect=AssertionError("config read")):
+            vars(config).pop('MOUNTS', None)
+            config.spec_config = None
+            resolver = epp.PathResolver()
+        assert resolver.mounts == []
+        assert resolver.local_path('sftp://lims.example.com' + self.local) == self.local
+
+    def test_download(self):
+        resolver = epp.PathResolver(mounts=[], lims=self.lims)
+        file = self.file('40-1', 'sftp://lims.example.com/glsftp/Project/remote file.csv')
+        path = resolver.path(file)
+        assert os.path.basename(path) == '40-1_remote_file.csv'
+        with resolver.open(file) as f:
+            assert f.read() == 'c,d\n'
+        assert [r for r in self.fake.requests if r[1].endswith('download')] == [('GET', 'files/40-1/download')]
+        resolver.close()
+        assert not os.path.exists(os.path.dirname(path))
+        # Downloaded again once closed
+        with epp.PathResolver(mounts=[], lims=self.lims) as resolver:
+            path = resolver.path(file)
+            assert os.path.isfile(path)
+        assert not os.path.exists(path)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestFormatTable(TestCase):
+    rows = [['Plate reader export', '', ''],
+            ['Well', 'Conc', ''],
+            ['A1', '1.5', 'ng/ul'],
+            ['Sample', '0', ''],
+            ['B1', '2.5', 'ng/ul'],
+            ['short'],
+            ['', '', '']]
+
+    def test_format(self):
+        table = epp.format_table(self.rows, first_header='Well')
+        assert table == {'A1': {'Well': 'A1', 'Conc': ('1.5', 'ng/ul')},
+                         'B1': {'Well': 'B1', 'Conc': ('2.5', 'ng/ul')}}
+        table = epp.format_table(self.rows, header_row=1, find_keys=['B1'], types={'Conc': float})
+        assert table == {'B1': {'Well': 'B1', 'Conc': (2.5, 'ng/ul')}}
+        assert epp.format_table(iter(self.rows), first_header=['Other', 'Well']) == \
+            epp.format_table(self.rows, first_header='Well')
+
+    def test_errors(self):
+        with self.assertRaises(epp.FormatError) as context:
+            epp.format_table(self.rows + [['A1', '1', '']], name='plate.csv', first_header='Well')
+        assert context.exception.duplicates == ['A1']
+        assert not context.exception.empty
+        assert 'plate.csv' in str(context.exception)
+        with self.assertRaises(epp.FormatError) as context:
+            epp.format_table(self.rows, first_header='Missing')
+        assert context.exception.empty
+        self.assertRaises(epp.FormatError, epp.format_table, self.rows, first_header='Well', types={'Conc': int})
+
+    @skipIf(numpy is None, "requires numpy")
+    def test_array(self):
+        rows = [['Well', 'Conc', 'Flag'], ['A1', '1.5', ''], ['B1', '2.5', 'x']]
+        table = epp.format_table(rows, header_row=0, types={'Conc': float})
+        array = epp.table_to_array(table, columns=['Conc', 'Flag'])
+        assert list(array['key']) == ['A1', 'B1']
+        assert array['Conc'].dtype == numpy.float64
+        assert list(array['Flag']) == ['', 'x']
+
+
+@skipIf(config.find_config_file() is None, "requires a configuration file")
+class TestEppLogger(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmpdir, 'run.log')
+        self.main_log = os.path.join(self.tmpdir, 'main.log')
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        root = logging.getLogger()
+        self.root_handlers, self.root_level = root.handlers[:], root.level
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            if handler not in self.root_handlers:
+                root.removeHandler(handler)
+                handler.close()
+        root.setLevel(self.root_level)
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def run_script(self, asynchronous, fail=False):
+        stderr = Mock()
+        sys.stderr = stderr
+        with patch('genologics.config.MAIN_LOG', self.main_log):
+            with epp.EppLogger(self.log_file, asynchronous=asynchronous):
+                for i in range(3):
+                    sys.stdout.write('sample {0}'.format(i))
+                    sys.stdout.write(' done\n')
+                sys.stderr.write('no newline')
+                if fail:
+                    raise ValueError('failed')
+        return stderr
+
+    def test_sync(self):
+        stderr = self.run_script(asynchronous=False)
+        log = self.read(self.log_file)
+        assert 'STDOUT:sample 1 done\n' in log
+        assert 'STDERR:no newline\n' in log
+        assert log == self.read(self.main_log)
+        stderr.write.assert_called_with('no newline')
+        assert sys.stdout is self.stdout
+        assert sys.stderr is stderr
+
+    @skipIf(sys.version_info[0] == 2, "requires QueueHandler")
+    def test_async_exception(self):
+        with self.assertRaises(ValueError):
+            self.run_script(asynchronous=True, fail=True)
+        assert sys.stdout is self.stdout
+        log = self.read(self.log_file)
+        assert log.count('STDOUT:sample') == 3
+        assert 'STDERR:no newline' in log
+        # Logging is synchronous again after the CM
+        logging.getLogger('test').warning('after')
+        assert 'test:after' in self.read(self.main_log)
+        assert not any(isinstance(h, epp.QueueHandler) for h in logging.getLogger().handlers)
+
+
+class TestColdStart(TestCase):
+
+    script = """
+import json, sys
+import genologics.epp
+print(json.dumps(dict(pkg_resources='pkg_resources' in sys.modules,
+                      config_loaded=bool(sys.modules['genologics.config']._settings))))
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cold_start(self, script=None):
+        "Run the script, importing genologics.epp, in a new interpreter, without a config file."
+        env = dict(os.environ, HOME=self.tmpdir,
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(epp.__file__))))
+        output = subprocess.check_output([sys.executable, '-c', script or self.script], cwd=self.tmpdir, env=env)
+        return json.loads(output.decode('utf-8'))
+
+    def test_no_config(self):
+        script = """
+import json
+import genologics.epp
+from genologics import config
+try:
+    config.get('MAIN_LOG')
+except config.ConfigError as e:
+    print(json.dumps(isinstance(e, IOError)))
+"""
+        assert self.cold_start(script) is True
+
+    @skipIf(sys.version_info < (3, 7), "lazy configuration requires Python 3.7")
+    def test_import(self):
+        run = self.cold_start()
+        assert not run['pkg_resources']
+        assert not run['config_loaded']
+
+
+class FakeStore(object):
+    """Transport serving XML documents by path, with the batch endpoints,
+    recording the requests and the updates; 404 for the missing paths."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.requests = []
+        self.updates = []
+
+    def __call__(self, request):
+        path = request.uri.split('/api/v2/')[1]
+        self.requests.append((request.method, path))
+        if path.endswith('batch/retrieve'):
+            ids = [link.attrib['uri'].split('/')[-1] for link in ElementTree.fromstring(request.data)]
+            kind = path.split('/')[0]
+            nodes = ''.join(self.documents[kind + '/' + id] for id in ids)
+            return Response(200, '<ri:details xmlns:ri="http://genologics.com/ri">{0}</ri:details>'.format(nodes))
+        if request.method in ('POST', 'PUT'):
+            self.updates.append((request.method, path, request.data))
+            return Response(200, request.data)
+        if path not in self.documents:
+            return Response(404, '<exc:exception xmlns:exc="http://genologics.com/ri/exception">'
+                                 '<message>Not found</message></exc:exception>')
+        return Response(200, self.documents[path])
+
+
+class TestEppContext(TestCase):
+
+    def setUp(self):
+        maps = [('a1', 'o1', 'Analyte'), ('a2', 'o2', 'Analyte'), ('a1', 'r1', 'ResultFile')]
+        documents = {
+            'processes/24-1': process_xml.format(url=url, maps=''.join(
+                map_xml.format(url=url, input=i, output=o, type=t, generation='PerInput') for i, o, t in maps)),
+            'steps/24-1': '<stp:step xmlns:stp="http://genologics.com/ri/step" uri="{0}/api/v2/steps/24-1" '
+                          'limsid="24-1" current-state="Record Details"/>'.format(url),
+        }
+        artifacts = [('a1', 'S1', '27-1'), ('a2', 'S2', '27-1'), ('o1', 'S1', '27-2'), ('o2', 'S2', '27-2'),
+                     ('r1', 'S1', None)]
+        for id, sample, container in artifacts:
+            location = ('<location><container uri="{0}/api/v2/containers/{1}" limsid="{1}"/>'
+                        '<value>A:1</value></location>'.format(url, container) if container else '')
+            documents['artifacts/' + id] = (
+                '<art:artifact xmlns:art="http://genologics.com/ri/artifact" '
+                'xmlns:udf="http://genologics.com/ri/userdefined" uri="{0}/api/v2/artifacts/{1}" limsid="{1}">'
+                '<name>{1}</name><sample uri="{0}/api/v2/samples/{2}" limsid="{2}"/>{3}'
+                '<udf:field type="Numeric" name="Conc">1</udf:field></art:artifact>').format(url, id, sample, location)
+        for id, project in [('S1', 'P1'), ('S2', 'P1')]:
+            documents['samples/' + id] = (
+                '<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{0}/api/v2/samples/{1}" limsid="{1}">'
+                '<name>{1}</name><project uri="{0}/api/v2/projects/{2}" limsid="{2}"/></smp:sample>'
+            ).format(url, id, project)
+        for id in ('27-1', '27-2'):
+            documents['containers/' + id] = (
+                '<con:container xmlns:con="http://genologics.com/ri/container" uri="{0}/api/v2/containers/{1}" '
+                'limsid="{1}"><name>{1}</name></con:container>').format(url, id)
+        documents['projects/P1'] = ('<prj:project xmlns:prj="http://genologics.com/ri/project" '
+                                    'uri="{0}/api/v2/projects/P1" limsid="P1"><name>P1</name></prj:project>').format(url)
+        self.store = FakeStore(documents)
+        self.lims = Lims(url, username='test', password='password')
+        self.lims.transport = self.store
+
+    def test_load(self):
+        with epp.EppContext(self.lims, '24-1') as context:
+            assert [a.id for a in context.inputs] == ['a1', 'a2']
+            assert [a.id for a in context.outputs] == ['o1', 'o2', 'r1']
+            assert [s.name for s in context.samples] == ['S1', 'S2']
+            assert [c.name for c in context.containers] == ['27-1', '27-2']
+            assert [p.name for p in context.projects] == ['P1']
+            assert context.step.current_state == 'Record Details'
+            assert context.outputs[0].udf['Conc'] == 1
+            assert context.outputs[0].samples[0] is context.samples[0]
+            assert context.modified() == []
+        assert sorted(self.store.requests) == [
+            ('GET', 'processes/24-1'), ('GET', 'projects/P1'), ('GET', 'steps/24-1'),
+            ('POST', 'artifacts/batch/retrieve'), ('POST', 'containers/batch/retrieve'),
+            ('POST', 'samples/batch/retrieve')]
+        assert self.store.updates == []
+
+    def test_no_step(self):
+        del self.store.documents['steps/24-1']
+        with epp.EppContext(self.lims, '24-1') as context:
+            assert context.step is None
+            assert [a.id for a in context.outputs] == ['o1', 'o2', 'r1']
+            assert [p.name for p in context.projects] == ['P1']
+        assert self.store.updates == []
+
+    def test_save(self):
+        with epp.EppContext(self.lims, '24-1') as context:
+            for artifact in context.outputs:
+                artifact.udf['Conc'] = 2
+            context.samples[1].name = 'S2b'
+            context.projects[0].name = 'P1b'
+        updates = [(method, path) for method, path, data in self.store.updates]
+        assert updates == [('POST', 'artifacts/batch/update'), ('POST', 'samples/batch/update'),
+                           ('PUT', 'projects/P1')]
+        details = ElementTree.fromstring(self.store.updates[0][2])
+        assert [node.attrib['limsid'] for node in details] == ['o1', 'o2', 'r1']
+        assert context.modified() == []
+
+        self.store.updates = []
+        with self.assertRaises(ValueError):
+            with epp.EppContext(self.lims, '24-1') as context:
+                context.samples[0].name = 'S1b'
+                raise ValueError('failed')
+        assert self.store.updates == []
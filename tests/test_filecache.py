@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from genologics.entities import File
+from genologics.filecache import FileCache
+from genologics.lims import Lims
+from genologics.protocol import Response
+
+url = 'http://testgenologics.com:4040'
+
+
+class FakeFiles(object):
+    "Transport serving the downloads of files, by File id."
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.downloads = []
+        self.heads = []
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        file_id = request.uri.split('/')[-2]
+        content = self.contents[file_id]
+        if request.method == 'HEAD':
+            self.heads.append(file_id)
+            return Response(200, b'', {'etag': '"{0}"'.format(hash(content))})
+        with self.lock:
+            self.downloads.append(file_id)
+        time.sleep(0.01)
+        return Response(200, content)
+
+
+class TestFileCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lims = Lims(url, username='test', password='password')
+        self.files = FakeFiles({'40-1': b'a' * 100, '40-2': b'b' * 100, '40-3': b'a' * 100})
+        self.lims.transport = self.files
+        self.now = 1000.0
+        self.cache = FileCache(self.lims, self.tmpdir, max_size=250, clock=lambda: self.now)
+        self.lims.file_cache = self.cache
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fetch(self):
+        file = File(self.lims, id='40-1')
+        assert file.download() == b'a' * 100
+        assert file.download() == b'a' * 100
+        assert self.lims.get_file_contents(id='40-1') == 'a' * 100
+        assert self.files.downloads == ['40-1']
+        # The validator is reused for max_age seconds
+        assert self.files.heads == ['40-1']
+
+        # Modified in the LIMS
+        self.files.contents['40-1'] = b'c' * 100
+        assert file.download() == b'a' * 100
+        self.now += 60
+        assert file.download() == b'c' * 100
+        assert self.files.downloads == ['40-1', '40-1']
+        assert self.files.heads == ['40-1', '40-1']
+
+    def test_content_addressed(self):
+        path1 = self.cache.fetch(File(self.lims, id='40-1'))
+        path3 = self.cache.fetch(File(self.lims, id='40-3'))
+        assert path1 == path3
+        assert self.cache.size() == 100
+
+    def test_evict(self):
+        path1 = self.cache.fetch(File(self.lims, id='40-1'))
+        os.utime(path1, (time.time() - 60, time.time() - 60))
+        self.files.contents['40-4'] = b'd' * 100
+        self.cache.fetch(File(self.lims, id='40-2'))
+        assert self.cache.size() == 200
+        self.cache.fetch(File(self.lims, id='40-4'))
+        assert self.cache.size() == 200
+        assert not os.path.exists(path1)
+        assert File(self.lims, id='40-1').download() == b'a' * 100
+        assert self.files.downloads == ['40-1', '40-2', '40-4', '40-1']
+
+    def test_evict_keys(self):
+        for file_id in ('40-1', '40-2', '40-3'):
+            self.cache.fetch(File(self.lims, id=file_id))
+        keys = os.path.join(self.tmpdir, 'keys')
+        assert len([name for name in os.listdir(keys) if not name.endswith('.lock')]) == 3
+        self.cache.evict(max_size=0)
+        assert os.listdir(keys) == []
+        assert self.cache.size() == 0
+
+    def test_concurrent(self):
+        file = File(self.lims, id='40-2')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            contents = list(executor.map(lambda i: self.cache.read(file), range(8)))
+        assert contents == [b'b' * 100] * 8
+        assert self.files.downloads == ['40-2']
+        assert os.listdir(os.path.join(self.tmpdir, 'tmp')) == []
@@ -0,0 +1,235 @@
+from sys import version_info
+from unittest import TestCase
+from xml.etree import ElementTree
+
+from genologics.entities import SampleHistory
+from genologics.genealogy import Genealogy, sample_histories, trace_descendants
+from genologics.lims import Lims
+
+if version_info[0] == 2:
+    from mock import patch, Mock
+else:
+    from unittest.mock import patch, Mock
+
+url = 'http://testgenologics.com:4040'
+
+artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{url}/api/v2/artifacts/{id}?state=1" limsid="{id}">
+<name>{id}</name><type>{type}</type>{parent}
+<sample uri="{url}/api/v2/samples/{sample}" limsid="{sample}"/>
+</art:artifact>"""
+
+parent_xml = """<parent-process uri="{url}/api/v2/processes/{id}" limsid="{id}"/>"""
+
+process_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/{id}" limsid="{id}">
+<type uri="{url}/api/v2/processtypes/{type_id}">{type}</type>
+<date-run>{date}</date-run>
+{maps}
+</prc:process>"""
+
+io_map_xml = """<input-output-map><input uri="{url}/api/v2/artifacts/{input}?state=1" limsid="{input}"/>
+<output uri="{url}/api/v2/artifacts/{output}?state=1" limsid="{output}" output-type="{type}" output-generation-type="PerInput"/>
+</input-output-map>"""
+
+listing_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<ri:{tag}s xmlns:ri="http://genologics.com/ri">{entries}</ri:{tag}s>"""
+
+sample_xml = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{url}/api/v2/samples/{id}" limsid="{id}">
+<name>{id}</name></smp:sample>"""
+
+# S1: a1 -(p1)-> a2 -(p2, pooled with b2 of S2)-> a3
+#                a2 -(q1)-> r1
+#          b1 -(p1)-> b2
+ARTIFACTS = {
+    'a1': ('Analyte', None, 'S1'),
+    'a2': ('Analyte', 'p1', 'S1'),
+    'a3': ('Analyte', 'p2', 'S1'),
+    'b1': ('Analyte', None, 'S2'),
+    'b2': ('Analyte', 'p1', 'S2'),
+    'r1': ('ResultFile', 'q1', 'S1'),
+}
+PROCESSES = {
+    'p1': ('Library Prep', '2020-01-01', [('a1', 'a2', 'Analyte'), ('b1', 'b2', 'Analyte')]),
+    'p2': ('Pooling', '2020-01-02', [('a2', 'a3', 'Analyte'), ('b2', 'a3', 'Analyte')]),
+    'q1': ('Qubit QC', '2020-01-03', [('a2', 'r1', 'ResultFile')]),
+}
+
+
+def _artifact(id):
+    type, parent, sample = ARTIFACTS[id]
+    return artifact_xml.format(url=url, id=id, type=type, sample=sample,
+                               parent=parent_xml.format(url=url, id=parent) if parent else '')
+
+
+def _process(id):
+    type, date, maps = PROCESSES[id]
+    return process_xml.format(url=url, id=id, type=type, type_id=type[0], date=date, maps=''.join(
+        io_map_xml.format(url=url, input=i, output=o, type=t) for i, o, t in maps))
+
+
+def _listing(tag, uris):
+    return listing_xml.format(tag=tag, entries=''.join('<{0} uri="{1}"/>'.format(tag, u) for u in uris))
+
+
+def fake_get(uri, params=dict(), **kwargs):
+    path = uri.split('/api/v2/')[1]
+    if path == 'artifacts':
+        samples = params['samplelimsid'] if 'samplelimsid' in params else [params['sample-name']]
+        ids = sorted(i for i, a in ARTIFACTS.items() if a[2] in samples and params['type'] == a[0])
+        content = _listing('artifact', ['{0}/api/v2/artifacts/{1}?state=1'.format(url, i) for i in ids])
+    elif path == 'processes':
+        inputs = set(params['inputartifactlimsid'])
+        ids = sorted(p for p, v in PROCESSES.items() if inputs & set(m[0] for m in v[2]))
+        content = _listing('process', ['{0}/api/v2/processes/{1}'.format(url, p) for p in ids])
+    elif path == 'samples':
+        assert params['projectlimsid'] == 'P1'
+        content = _listing('sample', ['{0}/api/v2/samples/{1}'.format(url, s) for s in ['S1', 'S2']])
+    elif path.startswith('processes/'):
+        content = _process(path.split('/')[1])
+    else:
+        raise AssertionError('unexpected GET ' + uri)
+    return Mock(status_code=200, content=content)
+
+
+def fake_post(uri, data=None, **kwargs):
+    path = uri.split('/api/v2/')[1]
+    links = ElementTree.fromstring(data)
+    ids = [link.attrib['uri'].split('?')[0].split('/')[-1] for link in links]
+    if path == 'artifacts/batch/retrieve':
+        entries = ''.join(_artifact(i) for i in ids)
+        content = '<art:details xmlns:art="http://genologics.com/ri/artifact">{0}</art:details>'.format(entries)
+    elif path == 'samples/batch/retrieve':
+        entries = ''.join(sample_xml.format(url=url, id=i) for i in ids)
+        content = '<smp:details xmlns:smp="http://genologics.com/ri/sample">{0}</smp:details>'.format(entries)
+    else:
+        raise AssertionError('unexpected POST ' + uri)
+    return Mock(status_code=200, content=content)
+
+
+class TestGenealogy(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_expand(self):
+        with patch('requests.Session.get', side_effect=fake_get) as get, \
+                patch('genologics.lims.requests.post', side_effect=fake_post) as post:
+            genealogy = Genealogy(self.lims)
+            genealogy.expand_ancestors(['a3'])
+            assert post.call_count == 3  # one batch request per level
+            assert get.call_count == 2   # p2, then p1
+            assert genealogy.ancestors('a3') == set(['a1', 'a2', 'b1', 'b2'])
+            assert genealogy.parent_process('a2').id == 'p1'
+            assert genealogy.inputs('p2') == ['a2', 'b2']
+
+            genealogy.expand_consumers(['a1', 'a2'])
+            assert get.call_count == 4  # one listing, q1
+            assert [p.id for p in genealogy.processes_using('a2')] == ['p2', 'q1']
+            assert genealogy.descendants('a1') == set(['a2', 'a3', 'r1'])
+            assert genealogy.outputs('p1', 'b1') == ['b2']
+            genealogy.expand_consumers(['a2'])
+            assert get.call_count == 4
+
+    def test_expand_descendants(self):
+        with patch('requests.Session.get', side_effect=fake_get) as get, \
+                patch('genologics.lims.requests.post', side_effect=fake_post) as post:
+            genealogy = Genealogy(self.lims)
+            assert genealogy.expand_descendants(['a1', 'b1']) == set(['a2', 'b2', 'a3', 'r1'])
+            # one batch request per level: a2 b2, then a3 r1
+            assert post.call_count == 2
+            # one listing per level (the third finds nothing), p1, p2 and q1
+            assert get.call_count == 6
+            assert genealogy.artifacts['r1'].root is not None
+            assert genealogy.descendants('b1') == set(['b2', 'a3'])
+
+    def test_expand_descendants_stop(self):
+        with patch('requests.Session.get', side_effect=fake_get), \
+                patch('genologics.lims.requests.post', side_effect=fake_post):
+            genealogy = Genealogy(self.lims)
+            assert genealogy.expand_descendants(['a1'], stop_types=['Library Prep']) == set(['a2'])
+            genealogy = Genealogy(self.lims)
+            assert genealogy.expand_descendants(['a1'], max_depth=1) == set(['a2'])
+
+    def test_trace_descendants(self):
+        from genologics.entities import Artifact
+        with patch('requests.Session.get', side_effect=fake_get), \
+                patch('genologics.lims.requests.post', side_effect=fake_post):
+            genealogy = trace_descendants(self.lims, Artifact(self.lims, id='a2'), stop_types=['Pooling'])
+        assert genealogy.descendants('a2') == set(['a3', 'r1'])
+        assert [p.id for p in genealogy.processes_using('a2')] == ['p2', 'q1']
+
+    def test_lineage(self):
+        with patch('requests.Session.get', side_effect=fake_get), \
+                patch('genologics.lims.requests.post', side_effect=fake_post):
+            genealogy = Genealogy(self.lims)
+            genealogy.expand_ancestors(['a3'])
+            assert genealogy.lineage('a3', set(['a1', 'a2', 'a3'])) == [('a3', 'p2', 'a2'), ('a2', 'p1', 'a1')]
+            assert genealogy.lineage('b2', set(['a1', 'a2', 'a3'])) == []
+
+
+class TestSampleHistory(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_alternate_history(self):
+        with patch('requests.Session.get', side_effect=fake_get) as get, \
+                patch('genologics.lims.requests.post', side_effect=fake_post) as post:
+            history = SampleHistory(sample_name='S1', output_artifact='a3', lims=self.lims)
+            # artifact listing, p1 and p2, consumers listing, q1
+            assert get.call_count == 5
+            assert post.call_count == 1
+        assert history.history_list == ['a2', 'a1']
+        assert history.history['a2']['p2']['outart'] == 'a3'
+        assert history.history['a2']['q1']['outart'] is None
+        assert history.history['a2']['q1']['name'] == 'Qubit QC'
+        assert history.history['a2']['q1']['type'] == 'Q'
+        assert history.history['a1'] == {'p1': {'date': '2020-01-01', 'id': 'p1', 'outart': 'a2',
+                                                'inart': 'a1', 'type': 'L', 'name': 'Library Prep'}}
+
+    def test_input_artifact(self):
+        with patch('requests.Session.get', side_effect=fake_get), \
+                patch('genologics.lims.requests.post', side_effect=fake_post):
+            history = SampleHistory(sample_name='S1', output_artifact='r1', input_artifact='a2', lims=self.lims)
+        assert history.history_list == ['a2', 'a1']
+        assert history.history['a2']['q1']['outart'] == 'r1'
+        assert history.history['a2']['p2']['outart'] is None
+
+    def test_sample_artifact_map(self):
+        with patch('requests.Session.get', side_effect=fake_get), \
+                patch('genologics.lims.requests.post', side_effect=fake_post):
+            history = SampleHistory(sample_name='S1', lims=self.lims, pro_per_art={'a1': []}, test=True)
+        assert sorted((k, v[0].id, v[1]) for k, v in history.art_map.items()) == [
+            ('a2', 'p1', 'a1'), ('a3', 'p2', 'a2')]
+
+
+class TestSampleHistories(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_project(self):
+        from genologics.entities import Project
+        with patch('requests.Session.get', side_effect=fake_get) as get, \
+                patch('genologics.lims.requests.post', side_effect=fake_post) as post:
+            histories = sample_histories(self.lims, project=Project(self.lims, id='P1'))
+            # sample listing, analyte listing, p2, p1, consumers listing, q1
+            assert get.call_count == 6
+            assert [c[0][0].split('/api/v2/')[1] for c in get.call_args_list].count('processes/p2') == 1
+            # samples, then all the analytes at once
+            assert post.call_count == 2
+        assert sorted(histories) == ['S1', 'S2']
+        assert histories['S1'].history_list == ['a2', 'a1']
+        assert histories['S1'].history['a2']['q1']['outart'] is None
+        assert histories['S2'].history_list == ['b1']
+        assert histories['S2'].history['b1']['p1']['outart'] == 'b2'
+        assert histories['S1'].processes_per_artifact is histories['S2'].processes_per_artifact
+
+    def test_output_artifacts(self):
+        from genologics.entities import Sample
+        with patch('requests.Session.get', side_effect=fake_get), \
+                patch('genologics.lims.requests.post', side_effect=fake_post):
+            histories = sample_histories(self.lims, samples=[Sample(self.lims, id='S1')],
+                                         output_artifacts={'S1': 'a2'})
+        assert list(histories) == ['S1']
+        assert histories['S1'].history_list == ['a1']
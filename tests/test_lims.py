@@ -1,8 +1,15 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
 import xml
 from unittest import TestCase
 
-from requests.exceptions import HTTPError
+from requests.exceptions import ConnectionError, HTTPError
 
+from genologics import protocol
+from genologics.entities import Entity, File
 from genologics.lims import Lims
 try:
     callable(1)
@@ -19,6 +26,28 @@ else:
     from unittest.mock import patch, Mock
     import builtins
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+def _rename(artifact):
+    "Worker function for test_map_processes."
+    artifact.root.find('name').text += ' processed'
+    return artifact
+
+
+class _RootEntity(Entity):
+    "Entity created from its XML, for test_pickle_other_init."
+    _URI = 'notes'
+
+    def __new__(cls, lims, root):
+        return Entity.__new__(cls, lims, uri=root.attrib['uri'])
+
+    def __init__(self, lims, root):
+        self.root = root
+
+
 class TestLims(TestCase):
     url = 'http://testgenologics.com:4040'
     username = 'test'
@@ -90,10 +119,7 @@ class TestLims(TestCase):
             assert mocked_put.call_count == 1
 
 
-    @patch('os.path.isfile', return_value=True)
-    @patch.object(builtins, 'open')
-    def test_upload_new_file(self, mocked_open, mocked_isfile):
-        lims = Lims(self.url, username=self.username, password=self.password)
+    def _upload_xml(self):
         xml_intro = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>"""
         file_start = """<file:file xmlns:file="http://genologics.com/ri/file">"""
         file_start2 = """<file:file xmlns:file="http://genologics.com/ri/file" uri="{url}/api/v2/files/40-3501" limsid="40-3501">"""
@@ -103,12 +129,22 @@ class TestLims(TestCase):
         file_end = """</file:file>"""
         glsstorage_xml = '\n'.join([xml_intro,file_start, attached, upload, content_loc, file_end]).format(url=self.url)
         file_post_xml = '\n'.join([xml_intro, file_start2, attached, upload, content_loc, file_end]).format(url=self.url)
+        return glsstorage_xml, file_post_xml
+
+    def test_upload_new_file(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename_to_upload = os.path.join(tmpdir, 'filename_to_upload')
+        with open(filename_to_upload, 'w') as f:
+            f.write('contents')
+        glsstorage_xml, file_post_xml = self._upload_xml()
         with patch('requests.post', side_effect=[Mock(content=glsstorage_xml, status_code=200),
                                                  Mock(content=file_post_xml, status_code=200),
                                                  Mock(content="", status_code=200)]):
 
             file = lims.upload_new_file(Mock(uri=self.url+"/api/v2/samples/test_sample"),
-                                        'filename_to_upload')
+                                        filename_to_upload)
             assert file.id == "40-3501"
 
         with patch('requests.post', side_effect=[Mock(content=self.error_xml, status_code=400)]):
@@ -116,7 +152,49 @@ class TestLims(TestCase):
           self.assertRaises(HTTPError,
                             lims.upload_new_file,
                             Mock(uri=self.url+"/api/v2/samples/test_sample"),
-                            'filename_to_upload')
+                            filename_to_upload)
+        self.assertRaises(IOError, lims.upload_new_file, Mock(uri=self.url+"/api/v2/samples/test_sample"),
+                          os.path.join(tmpdir, 'missing'))
+
+    def test_upload_files(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        file_post_xml = self._upload_xml()[1]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = []
+        for i in range(6):
+            paths.append(os.path.join(tmpdir, 'report{0}.txt'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'report %d' % i * 1000)
+        uploaded = dict()
+        lock = threading.Lock()
+
+        def post(uri, data=None, **kwargs):
+            if uri.endswith('glsstorage'):
+                return Mock(content=data, status_code=200)
+            elif uri.endswith('files'):
+                location = xml.etree.ElementTree.fromstring(data).find('original-location').text
+                i = paths.index(location)
+                if i == 3:
+                    return Mock(content=self.error_xml, status_code=400)
+                content = file_post_xml.replace('40-3501', '40-{0}'.format(i))
+                return Mock(content=content, status_code=200)
+            body = data.read()
+            assert len(body) == len(data) == len(data.head) + 8000 + len(data.tail)
+            assert kwargs['headers']['content-type'] == data.content_type
+            with lock:
+                uploaded[uri.split('/')[-2]] = body
+            return Mock(content='', status_code=200)
+
+        samples = [Mock(uri=self.url + '/api/v2/samples/S{0}'.format(i)) for i in range(6)]
+        with patch('requests.post', side_effect=post):
+            results = lims.upload_files(zip(samples, paths), max_workers=3)
+        assert [r.path for r in results] == paths
+        assert [r.file.id if r.file else None for r in results] == ['40-0', '40-1', '40-2', None, '40-4', '40-5']
+        assert isinstance(results[3].error, HTTPError)
+        assert all(r.error is None for r in results if r.file)
+        assert sorted(uploaded) == ['40-0', '40-1', '40-2', '40-4', '40-5']
+        assert b'report 4' * 1000 in uploaded['40-4']
 
     @patch('requests.post', return_value=Mock(content = sample_xml, status_code=200))
     def test_route_artifact(self, mocked_post):
@@ -126,6 +204,156 @@ class TestLims(TestCase):
         assert mocked_post.call_count == 1
 
 
+    def _qc_get(self, uri, params=dict(), **kwargs):
+        path = uri.split('/api/v2/')[1]
+        if path == 'processtypes':
+            content = """<ptp:process-types xmlns:ptp="http://genologics.com/ri/processtype">
+<process-type uri="{url}/api/v2/processtypes/1" name="Qubit QC"/>
+<process-type uri="{url}/api/v2/processtypes/2" name="Library Prep"/>
+<process-type uri="{url}/api/v2/processtypes/3" name="Qubit QC v2"/>
+</ptp:process-types>""".format(url=self.url)
+        elif path == 'processes':
+            assert set(params['type']) <= set(['Qubit QC', 'Qubit QC v2'])
+            content = """<prc:processes xmlns:prc="http://genologics.com/ri/process">
+<process uri="{url}/api/v2/processes/q2"/><process uri="{url}/api/v2/processes/q1"/>
+</prc:processes>""".format(url=self.url)
+        else:
+            id = path.split('/')[1]
+            date, result = {'q1': ('2020-01-01', 'r1'), 'q2': ('2020-02-01', 'r2')}[id]
+            content = """<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/{id}" limsid="{id}">
+<date-run>{date}</date-run>
+<input-output-map><input uri="{url}/api/v2/artifacts/a1" limsid="a1"/>
+<output uri="{url}/api/v2/artifacts/{result}" limsid="{result}" output-type="ResultFile" output-generation-type="PerInput"/></input-output-map>
+</prc:process>""".format(url=self.url, id=id, date=date, result=result)
+        return Mock(content=content, status_code=200)
+
+    def test_get_qc_results_re(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        from genologics.entities import Artifact
+        analyte = Artifact(lims, id='a1')
+        with patch('requests.Session.get', side_effect=self._qc_get) as mocked_get:
+            assert [r.id for r in lims.get_qc_results_re([analyte], 'Qubit')] == ['r2']
+            # process types, processes, q1 and q2
+            assert mocked_get.call_count == 4
+            assert [r.id for r in lims.get_qc_results([analyte], 'Qubit QC')] == ['r2']
+            # the process types and the processes are cached
+            assert mocked_get.call_count == 5
+            self.assertRaises(KeyError, lims.get_qc_results_re, [analyte], 'Fragment')
+            assert mocked_get.call_count == 5
+
+    def test_get_qc_results_type_chunks(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        from genologics.entities import Artifact
+        analyte = Artifact(lims, id='a1')
+        with patch('requests.Session.get', side_effect=self._qc_get) as mocked_get, \
+                patch('genologics.lims.QUERY_TYPE_CHUNK_SIZE', 1):
+            assert [r.id for r in lims.get_qc_results_re([analyte], 'Qubit')] == ['r2']
+            # process types, processes for each type, and q1 and q2 once
+            assert mocked_get.call_count == 5
+            assert sorted(c[1]['params']['type'] for c in mocked_get.call_args_list[1:3]) == [
+                ['Qubit QC'], ['Qubit QC v2']]
+
+    def test_resolve_many(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        listing = """<prj:projects xmlns:prj="http://genologics.com/ri/project">{0}</prj:projects>""".format(
+            ''.join('<project uri="{0}/api/v2/projects/P{1}"/>'.format(self.url, i) for i in range(20)))
+
+        def get(uri, **kwargs):
+            id = uri.split('/')[-1]
+            if id == 'projects':
+                return Mock(content=listing, status_code=200)
+            return Mock(status_code=200, content="""<prj:project xmlns:prj="http://genologics.com/ri/project" uri="{0}" limsid="{1}">
+<name>name {1}</name></prj:project>""".format(uri, id))
+
+        with patch('requests.Session.get', side_effect=get) as mocked_get:
+            projects = lims.get_projects(resolve=True)
+            assert mocked_get.call_count == 21
+            assert [p.name for p in projects] == ['name P{0}'.format(i) for i in range(20)]
+            assert lims.resolve_many(projects + projects[:2], max_workers=4) == projects + projects[:2]
+            assert mocked_get.call_count == 21
+            lims.resolve_many(projects[:2] * 2, force=True)
+            assert mocked_get.call_count == 23
+
+    def _artifact(self, lims, id):
+        from genologics.entities import Artifact
+        artifact = Artifact(lims, id=id)
+        artifact.root = xml.etree.ElementTree.fromstring(
+            """<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{0}" limsid="{1}">
+<name>{1}</name></art:artifact>""".format(artifact.uri, id))
+        return artifact
+
+    def test_pickle(self):
+        import pickle
+        from genologics import lims as lims_module
+        lims = Lims(self.url, username=self.username, password=self.password)
+        a1, a2 = self._artifact(lims, 'a1'), self._artifact(lims, 'a2')
+        assert pickle.loads(pickle.dumps(a1)) is a1
+        environ = {'GENOLOGICS_BASEURI': self.url, 'GENOLOGICS_USERNAME': self.username,
+                   'GENOLOGICS_PASSWORD': self.password}
+        with patch.dict(lims_module._registry, clear=True), patch.dict('os.environ', environ):
+            r1, r2 = pickle.loads(pickle.dumps([a1, a2]))
+            r3 = pickle.loads(pickle.dumps(a1))
+            assert r1.lims is not lims
+            assert r1.lims is r2.lims is r3.lims
+            assert r1 is r3
+            assert (r1.uri, r1.name, r2.name) == (a1.uri, 'a1', 'a2')
+            assert r1.lims.password == 'password'
+
+    def test_pickle_without_password(self):
+        import pickle
+        from genologics import lims as lims_module
+        lims = Lims(self.url, username=self.username, password='secret')
+        data = pickle.dumps(self._artifact(lims, 'a1'))
+        assert b'secret' not in data
+        environ = {'GENOLOGICS_BASEURI': self.url, 'GENOLOGICS_USERNAME': 'other',
+                   'GENOLOGICS_PASSWORD': 'from env'}
+        with patch('genologics.config.find_config_file', return_value=None):
+            with patch.dict(lims_module._registry, clear=True), patch.dict('os.environ', environ):
+                # Not for another user
+                assert pickle.loads(data).lims.password is None
+            environ['GENOLOGICS_USERNAME'] = self.username
+            with patch.dict(lims_module._registry, clear=True), patch.dict('os.environ', environ):
+                assert pickle.loads(data).lims.password == 'from env'
+            with patch.dict(lims_module._registry, clear=True):
+                # From a live Lims of the process for the same server and user
+                other = Lims(self.url, username=self.username, password='secret')
+                assert pickle.loads(data).lims.password == 'secret'
+
+    def test_pickle_other_init(self):
+        import pickle
+        from genologics import lims as lims_module
+        lims = Lims(self.url, username=self.username, password=self.password)
+        root = xml.etree.ElementTree.fromstring('<note uri="{0}/api/v2/notes/n1"/>'.format(self.url))
+        note = _RootEntity(lims, root)
+        assert pickle.loads(pickle.dumps(note)) is note
+        with patch.dict(lims_module._registry, clear=True):
+            restored = pickle.loads(pickle.dumps(note))
+        assert restored is not note
+        assert (restored.uri, restored.root.attrib) == (note.uri, root.attrib)
+
+    def test_cache_list(self):
+        import warnings
+        lims = Lims(self.url, username=self.username, password=self.password)
+        a1, a2 = self._artifact(lims, 'a1'), self._artifact(lims, 'a2')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            assert lims.cache_list == [a1.uri, a2.uri]
+        assert caught[0].category is DeprecationWarning
+
+    def test_fork(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        session, lock = lims.request_session, lims.cache_lock
+        assert lims.request_session is session
+        with patch('os.getpid', return_value=-1):
+            assert lims.request_session is not session
+            assert lims.cache_lock is not lock
+
+    def test_map_processes(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        artifacts = [self._artifact(lims, 'a{0}'.format(i)) for i in range(4)]
+        results = lims.map_processes(_rename, artifacts, max_workers=2)
+        assert results == artifacts
+        assert [a.name for a in artifacts] == ['a{0} processed'.format(i) for i in range(4)]
 
     def test_tostring(self):
         lims = Lims(self.url, username=self.username, password=self.password)
@@ -142,3 +370,264 @@ class TestLims(TestCase):
 
 
 
+
+
+class SessionLims(BaseHTTPRequestHandler):
+    """Stand-in for a LIMS setting a session cookie on Basic auth, and
+    answering 401 to a request with an expired session cookie."""
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        cookie = self.headers.get('cookie', '')
+        basic = self.headers.get('authorization') is not None
+        server.requests.append(('basic' if basic else 'cookie', cookie))
+        length = int(self.headers.get('content-length') or 0)
+        server.bodies.append(self.rfile.read(length) if length else b'')
+        if 'JSESSIONID={0}'.format(server.session) in cookie:
+            self.send_response(200)
+        elif basic:
+            server.session = 's{0}'.format(len(server.requests))
+            self.send_response(200)
+            self.send_header('set-cookie', 'JSESSIONID={0}; Path=/'.format(server.session))
+        else:
+            self.send_response(401)
+        self.send_header('content-type', 'application/xml')
+        self.end_headers()
+        self.wfile.write(b'<ri:links xmlns:ri="http://genologics.com/ri"/>')
+
+    do_GET = do_PUT = do_POST = _handle
+
+
+class TestSessionCookie(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), SessionLims)
+        self.server.requests = []
+        self.server.bodies = []
+        self.server.session = None
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_reuse(self):
+        lims = Lims(self.url, username='test', password='password')
+        uri = lims.get_uri('samples')
+        lims.get(uri)
+        lims.get(uri)
+        lims.put(uri, b'<sample/>')
+        assert [r[0] for r in self.server.requests] == ['basic', 'cookie', 'cookie']
+        assert lims.get_session_cookie() == 's1'
+
+        # The session expires: authenticate again, and use the new session
+        self.server.session = 'other'
+        lims.post(uri, b'<sample/>')
+        lims.get(uri)
+        assert [r[0] for r in self.server.requests[3:]] == ['cookie', 'basic', 'cookie']
+        assert lims.get_session_cookie() == 's5'
+
+    def test_files(self):
+        lims = Lims(self.url, username='test', password='password')
+        lims.get(lims.get_uri('samples'))
+        assert 'ri:links' in lims.get_file_contents(id='40-1')
+        File(lims, id='40-1').upload(b'contents')
+        assert [r[0] for r in self.server.requests] == ['basic', 'cookie', 'cookie']
+
+    def test_upload_expired(self):
+        lims = Lims(self.url, username='test', password='password')
+        lims.get(lims.get_uri('samples'))
+        path = os.path.join(self.tmpdir, 'file.txt')
+        with open(path, 'wb') as outfile:
+            outfile.write(b'contents')
+        # The session expires during the upload: the body is sent again whole
+        self.server.session = 'other'
+        with protocol.MultipartFile(path) as body:
+            lims.send(protocol.upload(lims.get_uri('files', '40-1', 'upload'), body))
+        assert [r[0] for r in self.server.requests] == ['basic', 'cookie', 'basic']
+        assert self.server.bodies[1] == self.server.bodies[2]
+        assert b'\r\ncontents\r\n' in self.server.bodies[2]
+
+    def test_disabled(self):
+        lims = Lims(self.url, username='test', password='password', session_cookie=None)
+        lims.get(lims.get_uri('samples'))
+        lims.get(lims.get_uri('samples'))
+        assert [r[0] for r in self.server.requests] == ['basic', 'basic']
+
+    def test_cookie_file(self):
+        cookie_file = os.path.join(self.tmpdir, 'cookie')
+        lims = Lims(self.url, username='test', password='password', cookie_file=cookie_file)
+        lims.get(lims.get_uri('samples'))
+        assert stat.S_IMODE(os.stat(cookie_file).st_mode) == 0o600
+
+        other = Lims(self.url, username='test', password='password', cookie_file=cookie_file)
+        other.get(other.get_uri('samples'))
+        assert [r[0] for r in self.server.requests] == ['basic', 'cookie']
+
+        # Not for another user, nor if readable by others
+        Lims(self.url, username='other', password='password', cookie_file=cookie_file).get(lims.get_uri('samples'))
+        os.chmod(cookie_file, 0o644)
+        Lims(self.url, username='test', password='password', cookie_file=cookie_file).get(lims.get_uri('samples'))
+        assert [r[0] for r in self.server.requests[2:]] == ['basic', 'basic']
+
+
+class FileLims(BaseHTTPRequestHandler):
+    """Stand-in for the file download of a LIMS supporting range requests,
+    with If-Range on its ETag, dropping the connection in the middle of the
+    first drop downloads."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('range'))
+        server.if_ranges.append(self.headers.get('if-range'))
+        content = server.content
+        start = 0
+        if_range = self.headers.get('if-range')
+        if self.headers.get('range') and server.accept_ranges and if_range in (None, server.etag):
+            start = int(self.headers['range'].split('=')[1].rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('content-range', 'bytes */{0}'.format(len(content)))
+                self.send_header('content-length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('content-range', 'bytes {0}-{1}/{2}'.format(start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('etag', server.etag)
+        if not server.hide_length:
+            self.send_header('content-length', str(len(content) - start))
+        self.send_header('connection', 'close')
+        self.end_headers()
+        if server.drop:
+            server.drop -= 1
+            self.wfile.write(content[start:start + 1000])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+
+class TestDownload(TestCase):
+
+    def setUp(self):
+        import hashlib
+        self.server = HTTPServer(('127.0.0.1', 0), FileLims)
+        self.server.content = os.urandom(5000)
+        self.server.ranges = []
+        self.server.if_ranges = []
+        self.server.etag = '"v1"'
+        self.server.drop = 0
+        self.server.hide_length = False
+        self.server.accept_ranges = True
+        self.md5 = hashlib.md5(self.server.content).hexdigest()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.lims = Lims('http://127.0.0.1:{0}'.format(self.server.server_port), username='test', password='password')
+        self.file = File(self.lims, id='40-1')
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file.bin')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        with open(self.path, 'rb') as infile:
+            return infile.read()
+
+    def test_download(self):
+        assert self.file.download() == self.server.content
+        chunks = list(self.file.iter_download(chunk_size=1024))
+        assert [len(c) for c in chunks] == [1024] * 4 + [904]
+
+    def test_download_to(self):
+        assert self.file.download_to(self.path, checksum=self.md5, chunk_size=256) == self.path
+        assert self.read() == self.server.content
+        assert not os.path.exists(self.path + '.part')
+
+    def test_resume(self):
+        self.server.drop = 1
+        self.file.download_to(self.path, checksum=self.md5, chunk_size=256)
+        assert self.read() == self.server.content
+        # Resumed from the last complete chunk written
+        assert self.server.ranges == [None, 'bytes=768-']
+        assert self.server.if_ranges == [None, '"v1"']
+        assert not os.path.exists(self.path + '.part.validator')
+
+    def test_resume_changed(self):
+        # The file changed on the server since the partial download
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(b'x' * 1200)
+        with open(self.path + '.part.validator', 'w') as outfile:
+            outfile.write('"v0"')
+        self.file.download_to(self.path, checksum=self.md5)
+        assert self.read() == self.server.content
+        assert self.server.ranges == ['bytes=1200-']
+        assert self.server.if_ranges == ['"v0"']
+
+    def test_resume_complete(self):
+        # Interrupted after the last chunk was written
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(self.server.content)
+        self.file.download_to(self.path, checksum=self.md5)
+        assert self.read() == self.server.content
+        assert self.server.ranges == ['bytes=5000-']
+        # A partial file longer than the file on the server starts over
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(self.server.content + b'x')
+        self.file.download_to(self.path, checksum=self.md5)
+        assert self.read() == self.server.content
+        assert self.server.ranges[1:] == ['bytes=5001-', None]
+
+    def test_resume_short(self):
+        # Without a Content-Length, the dropped connection ends the content
+        # without an error: the Content-Range tells it is short
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(self.server.content[:1200])
+        self.server.drop = 1
+        self.server.hide_length = True
+        self.file.download_to(self.path)
+        assert self.read() == self.server.content
+        assert self.server.ranges == ['bytes=1200-', 'bytes=2200-']
+
+    def test_resume_give_up(self):
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(self.server.content[:1200])
+        self.server.drop = 2
+        self.server.hide_length = True
+        self.assertRaises(ConnectionError, self.file.download_to, self.path, retries=1)
+        assert not os.path.exists(self.path)
+
+    def test_resume_later(self):
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(self.server.content[:1200])
+        self.file.download_to(self.path, checksum=self.md5)
+        assert self.read() == self.server.content
+        # Without range support, the download starts over
+        with open(self.path + '.part', 'wb') as outfile:
+            outfile.write(b'x' * 1200)
+        self.server.accept_ranges = False
+        self.file.download_to(self.path, checksum=self.md5)
+        assert self.read() == self.server.content
+
+    def test_checksum(self):
+        self.assertRaises(IOError, self.file.download_to, self.path, checksum='0' * 32)
+        assert not os.path.exists(self.path)
+        assert not os.path.exists(self.path + '.part')
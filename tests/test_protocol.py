@@ -0,0 +1,156 @@
+import io
+import os
+import shutil
+import tempfile
+from sys import version_info
+from unittest import TestCase
+from xml.etree import ElementTree
+
+import requests
+from requests.exceptions import HTTPError
+
+from genologics import protocol
+from genologics.entities import Artifact, Sample, Step
+from genologics.lims import Lims
+from genologics.protocol import MultipartFile, Recorder, Replay, Request, Response
+
+if version_info[0] == 2:
+    from mock import patch, Mock
+else:
+    from unittest.mock import patch, Mock
+
+url = 'http://testgenologics.com:4040'
+
+sample_xml = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{url}/api/v2/samples/{id}" limsid="{id}">
+<name>{id}</name></smp:sample>"""
+
+details_xml = """<smp:details xmlns:smp="http://genologics.com/ri/sample">{0}</smp:details>"""
+
+
+class TestProtocol(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_get(self):
+        request = protocol.get(url + '/api/v2/samples', params={'name': 's1'})
+        assert (request.method, request.timeout, request.headers) == ('GET', 16, {'accept': 'application/xml'})
+        root = request.parse(Response(200, sample_xml.format(url=url, id='S1')))
+        assert root.find('name').text == 'S1'
+        self.assertRaises(HTTPError, request.parse, Response(404, '<exception><message>gone</message></exception>'))
+
+    def test_batch_retrieve(self):
+        s1, s2 = Sample(self.lims, id='S1'), Sample(self.lims, id='S2')
+        s1.root = ElementTree.fromstring(sample_xml.format(url=url, id='S1'))
+        request = protocol.batch_retrieve(url + '/api/v2/samples/batch/retrieve', [s1, s2, s2])
+        links = ElementTree.fromstring(request.data)
+        assert [link.attrib['uri'] for link in links] == [s2.uri]
+        result = request.parse(Response(200, details_xml.format(sample_xml.format(url=url, id='S2'))))
+        assert result == [s1, s2]
+        samples = [Sample(self.lims, id='S{0}'.format(i)) for i in range(9, 2, -1)]
+        request = protocol.batch_retrieve(url + '/api/v2/samples/batch/retrieve', samples)
+        result = request.parse(Response(200, details_xml.format(''.join(
+            sample_xml.format(url=url, id=sample.id) for sample in reversed(samples)))))
+        assert result == samples
+        assert s2.name == 'S2'
+        assert protocol.batch_retrieve(url + '/api/v2/samples/batch/retrieve', [s1, s2]) is None
+
+    def test_step_creation(self):
+        configuration = Mock(uri=url + '/api/v2/configuration/protocols/1/steps/2')
+        request = protocol.step_creation(url + '/api/v2/steps', configuration, [Artifact(self.lims, id='a1')],
+                                         container_type='Tube', reagent_category='Index')
+        root = ElementTree.fromstring(request.data)
+        assert root.find('inputs/input').attrib['uri'] == url + '/api/v2/artifacts/a1'
+        assert root.find('reagent-category').text == 'Index'
+        assert request.method == 'POST'
+
+    def test_create_step(self):
+        configuration = Mock(uri=url + '/api/v2/configuration/protocols/1/steps/2')
+        step_xml = """<stp:step xmlns:stp="http://genologics.com/ri/step" uri="{0}/api/v2/steps/24-1" limsid="24-1"/>""".format(url)
+        replay = Replay()
+        with patch('requests.post', return_value=Mock(status_code=201, content=step_xml, headers={})):
+            self.lims.transport = Recorder(self.lims.http_transport, replay)
+            step = self.lims.create_step(configuration, [Artifact(self.lims, id='a1')], reagent_category='Index')
+        assert step is Step(self.lims, id='24-1')
+        assert len(replay.responses) == 1
+
+    def test_replay(self):
+        sample = Sample(self.lims, id='S1')
+        with patch('requests.Session.get', return_value=Mock(
+                status_code=200, content=sample_xml.format(url=url, id='S1'), headers={})) as get:
+            self.lims.transport = Recorder(self.lims.transport)
+            assert sample.name == 'S1'
+            assert get.call_count == 1
+        replay = self.lims.transport.replay
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'replay.json')
+        with io.open(path, 'w', encoding='utf-8') as outfile:
+            replay.dump(outfile)
+        other = Lims(url, username='test', password='password')
+        with io.open(path, encoding='utf-8') as infile:
+            other.transport = Replay.load(infile)
+        assert Sample(other, id='S1').name == 'S1'
+        self.assertRaises(KeyError, other.get, other.get_uri('samples', 'S2'))
+
+    def test_replay_order(self):
+        request = Request('GET', url, params={'type': ['a', 'b']})
+        replay = Replay([(request, Response(200, b'1')), (request, Response(200, b'2'))])
+        assert [replay(Request('GET', url, params={'type': ['a', 'b']})).content for i in range(3)] == [b'1', b'2', b'2']
+
+    def test_replay_binary(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'plate.png')
+        with open(path, 'wb') as f:
+            f.write(b'\x89PNG\xff\x00')
+        files = url + '/api/v2/files/40-1'
+        with MultipartFile(path) as body:
+            upload = protocol.upload(files + '/upload', body)
+            replay = Replay([(upload, Response(200, b'')),
+                             (protocol.download(files), Response(200, b'\x89PNG\xff\x00'))])
+        with io.open(os.path.join(directory, 'replay.json'), 'w', encoding='utf-8') as outfile:
+            replay.dump(outfile)
+        with io.open(os.path.join(directory, 'replay.json'), encoding='utf-8') as infile:
+            replay = Replay.load(infile)
+        assert replay(protocol.download(files)).content == b'\x89PNG\xff\x00'
+        # Another body of the same file, with another boundary
+        with MultipartFile(path) as body:
+            assert replay(protocol.upload(files + '/upload', body)).status_code == 200
+        with open(path, 'wb') as f:
+            f.write(b'changed')
+        with MultipartFile(path) as body:
+            self.assertRaises(KeyError, replay, protocol.upload(files + '/upload', body))
+
+
+class TestMultipartFile(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'report.csv')
+        with open(self.path, 'wb') as f:
+            f.write(b'a,b\n' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        with MultipartFile(self.path) as body:
+            assert len(body) == len(body.head) + 4000 + len(body.tail)
+            content = body.read()
+            assert content == body.head + b'a,b\n' * 1000 + body.tail
+            assert body.read(10) == b''
+            body.seek(0)
+            chunks = list(iter(lambda: body.read(333), b''))
+            assert b''.join(chunks) == content
+            assert body.file is not None
+        assert body.file is None
+
+        # Sent with a Content-Length rather than chunked
+        body = MultipartFile(self.path)
+        prepared = requests.Request('POST', 'http://localhost/upload', data=body,
+                                    headers={'content-type': body.content_type}).prepare()
+        assert prepared.headers['content-length'] == str(len(body))
+        assert 'transfer-encoding' not in prepared.headers
+        assert b'name="file"; filename="' + self.path.encode('utf-8') + b'"' in content
@@ -0,0 +1,99 @@
+from sys import version_info
+from unittest import TestCase
+from xml.etree import ElementTree
+
+from genologics.entities import Artifact, Sample, Project, Container, Process
+from genologics.lims import Lims
+
+if version_info[0] == 2:
+    from mock import patch
+else:
+    from unittest.mock import patch
+
+url = 'http://testgenologics.com:4040'
+
+artifact_xml = """<?xml version='1.0' encoding='utf-8'?>
+<art:artifact xmlns:art="http://genologics.com/ri/artifact" xmlns:udf="http://genologics.com/ri/userdefined" uri="{url}/api/v2/artifacts/{id}" limsid="{id}">
+<name>{name}</name>
+<type>Analyte</type>
+<output-type>Analyte</output-type>
+<parent-process uri="{url}/api/v2/processes/p1" limsid="p1"/>
+<qc-flag>{qc}</qc-flag>
+<location>
+  <container uri="{url}/api/v2/containers/{container}" limsid="{container}"/>
+  <value>A:1</value>
+</location>
+<working-flag>true</working-flag>
+<sample uri="{url}/api/v2/samples/{sample}" limsid="{sample}"/>
+<udf:field type="Numeric" name="Concentration">{conc}</udf:field>
+</art:artifact>"""
+
+sample_xml = """<?xml version='1.0' encoding='utf-8'?>
+<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{url}/api/v2/samples/{id}" limsid="{id}">
+<name>{id}</name>
+<project limsid="{project}" uri="{url}/api/v2/projects/{project}"/>
+</smp:sample>"""
+
+
+class TestLocalQuery(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.artifacts = []
+        for id, qc, conc, container, sample in [('a1', 'FAILED', 1.5, 'c1', 's1'),
+                                                ('a2', 'FAILED', 3, 'c1', 's2'),
+                                                ('a3', 'PASSED', 1, 'c2', 's3'),
+                                                ('a4', 'FAILED', 0.5, 'c2', 's3')]:
+            a = Artifact(self.lims, id=id)
+            a.root = ElementTree.fromstring(artifact_xml.format(
+                url=url, id=id, name='lib_' + id, qc=qc, conc=conc, container=container, sample=sample))
+            self.artifacts.append(a)
+        for id, project in [('s1', 'P1'), ('s2', 'P1'), ('s3', 'P2')]:
+            s = Sample(self.lims, id=id)
+            s.root = ElementTree.fromstring(sample_xml.format(url=url, id=id, project=project))
+        # Not retrieved, hence not visible to the query
+        Artifact(self.lims, id='a5')
+
+    def test_no_request(self):
+        with patch('requests.Session.get', side_effect=AssertionError('unexpected request')):
+            a1, a2, a3, a4 = self.artifacts
+            assert self.lims.query(Artifact) == self.artifacts
+            assert self.lims.query(Artifact, qc_flag='FAILED') == [a1, a2, a4]
+            assert self.lims.query(Artifact, container='c2') == [a3, a4]
+            assert self.lims.query(Artifact, container=Container(self.lims, id='c1')) == [a1, a2]
+            assert self.lims.query(Artifact, sample=['s1', 's2']) == [a1, a2]
+            assert self.lims.query(Artifact, name='lib_a3') == [a3]
+            assert self.lims.query(Artifact, limsid='a4') == [a4]
+            assert self.lims.query(Artifact, parent_process=Process(self.lims, id='p1')) == self.artifacts
+            assert self.lims.query(Artifact, working_flag=True) == self.artifacts
+            assert self.lims.query(Artifact, qc_flag='UNKNOWN') == []
+
+    def test_udf_predicates(self):
+        a1, a2, a3, a4 = self.artifacts
+        assert self.lims.query(Artifact, udf={'Concentration': 3}) == [a2]
+        assert self.lims.query(Artifact, udf={'Concentration.max': 1.5}) == [a1, a3, a4]
+        assert self.lims.query(Artifact, udf={'Concentration.min': 1.5}) == [a1, a2]
+        assert self.lims.query(Artifact, udf={'Concentration': lambda c: c < 2},
+                               qc_flag='FAILED') == [a1, a4]
+        assert self.lims.query(Artifact, udf={'Missing': lambda c: True}) == []
+
+    def test_project(self):
+        a1, a2, a3, a4 = self.artifacts
+        project = Project(self.lims, id='P1')
+        assert self.lims.query(Artifact, project=project, qc_flag='FAILED',
+                               udf={'Concentration': lambda c: c < 2}) == [a1]
+        assert self.lims.query(Artifact, project='P2') == [a3, a4]
+        assert [s.id for s in self.lims.query(Sample, project=project)] == ['s1', 's2']
+
+    def test_refresh(self):
+        a1, a2, a3, a4 = self.artifacts
+        assert self.lims.query(Artifact, qc_flag='PASSED') == [a3]
+        a1.root = ElementTree.fromstring(artifact_xml.format(
+            url=url, id='a1', name='lib_a1', qc='PASSED', conc=1.5, container='c1', sample='s1'))
+        assert self.lims.query(Artifact, qc_flag='PASSED') == [a1, a3]
+        # In-place changes require an explicit reindex
+        a3.root.find('qc-flag').text = 'FAILED'
+        self.lims.local_query.index(Artifact).reindex(a3)
+        assert self.lims.query(Artifact, qc_flag='PASSED') == [a1]
+        del self.lims.cache[a1.uri]
+        assert self.lims.query(Artifact, qc_flag='PASSED') == []
@@ -0,0 +1,257 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sys import version_info
+from unittest import TestCase
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, Timeout
+
+from genologics import protocol
+from genologics.entities import Sample
+from genologics.lims import Lims
+from genologics.protocol import Response
+from genologics.transport import CircuitBreaker, CircuitOpenError, Coalescer, Limit, RateLimitedTransport, \
+    RetryingTransport, RetryPolicy, TokenBucket, endpoint_class
+
+if version_info[0] == 2:
+    from mock import patch, Mock
+else:
+    from unittest.mock import patch, Mock
+
+url = 'http://testgenologics.com:4040'
+
+sample_xml = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{url}/api/v2/samples/S1" limsid="S1">
+<name>S1</name></smp:sample>""".format(url=url)
+
+
+class Scripted(object):
+    "Transport returning, or raising, the given outcomes in order."
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class TestRetryingTransport(TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.request = protocol.get(url + '/api/v2/samples/S1')
+
+    def transport(self, *outcomes, **kwargs):
+        return RetryingTransport(Scripted(*outcomes), sleep=self.sleeps.append, **kwargs)
+
+    def test_retry_get(self):
+        transport = self.transport(Response(503, ''), Timeout('slow'), Response(200, sample_xml),
+                                   retry=RetryPolicy(retries=3, backoff=1, jitter=0))
+        assert transport(self.request).status_code == 200
+        assert self.sleeps == [1, 2]
+        assert transport.counters == dict(requests=3, retries=2, failures=2)
+
+    def test_give_up(self):
+        transport = self.transport(Response(502, ''), Response(502, ''), retry=RetryPolicy(retries=1))
+        assert transport(self.request).status_code == 502
+        self.assertRaises(HTTPError, self.request.parse, Response(502, ''))
+        transport = self.transport(ConnectionError(), ConnectionError(), retry=RetryPolicy(retries=1))
+        self.assertRaises(ConnectionError, transport, self.request)
+
+    def test_writes(self):
+        put = protocol.put(url + '/api/v2/samples/S1', b'<sample/>')
+        transport = self.transport(Response(503, ''), Response(200, ''))
+        assert transport(put).status_code == 503
+        assert transport.counters['retries'] == 0
+        transport = self.transport(Response(503, ''), Response(200, ''), retry=RetryPolicy(retry_writes=True))
+        assert transport(put).status_code == 200
+
+        lims = Lims(url, username='test', password='password')
+        batch = protocol.batch_retrieve(lims.get_uri('samples', 'batch/retrieve'), [Sample(lims, id='S1')])
+        transport = self.transport(Response(503, ''), Response(200, ''))
+        assert transport(batch).status_code == 200
+
+    def test_not_transient(self):
+        transport = self.transport(Response(404, ''))
+        assert transport(self.request).status_code == 404
+        assert transport.counters == dict(requests=1)
+
+    def test_circuit_breaker(self):
+        now = [0]
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=lambda: now[0])
+        transport = self.transport(Response(503, ''), Response(503, ''), Response(503, ''), Response(200, ''),
+                                   retry=RetryPolicy(retries=5), breaker=breaker)
+        assert transport(self.request).status_code == 503
+        assert breaker.state == CircuitBreaker.OPEN
+        self.assertRaises(CircuitOpenError, transport, self.request)
+        now[0] = 10
+        # The trial request fails and opens the circuit again
+        assert transport(self.request).status_code == 503
+        self.assertRaises(CircuitOpenError, transport, self.request)
+        now[0] = 20
+        assert transport(self.request).status_code == 200
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert transport.counters == dict(requests=4, retries=1, failures=3, opened=2, rejected=2)
+
+    def test_circuit_breaker_other_error(self):
+        now = [0]
+        breaker = CircuitBreaker(threshold=1, reset_timeout=10, clock=lambda: now[0])
+        transport = self.transport(Response(503, ''), ChunkedEncodingError('cut'), Response(200, ''),
+                                   breaker=breaker)
+        assert transport(self.request).status_code == 503
+        now[0] = 10
+        # The trial request fails with an error which is not retried
+        self.assertRaises(ChunkedEncodingError, transport, self.request)
+        assert breaker.state == CircuitBreaker.OPEN
+        self.assertRaises(CircuitOpenError, transport, self.request)
+        now[0] = 20
+        assert transport(self.request).status_code == 200
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_lims(self):
+        lims = Lims(url, username='test', password='password')
+        lims.transport = RetryingTransport(lims.http_transport, sleep=self.sleeps.append)
+        with patch('requests.Session.get', side_effect=[Mock(status_code=503, content=''),
+                                                         Mock(status_code=200, content=sample_xml)]) as get:
+            assert Sample(lims, id='S1').name == 'S1'
+        assert get.call_count == 2
+
+    def test_timeout_message(self):
+        lims = Lims(url, username='test', password='password')
+        with patch('requests.Session.get', side_effect=Timeout('read timed out')):
+            with self.assertRaises(Timeout) as context:
+                lims.get(lims.get_uri('samples', 'S1'))
+        assert 'read timed out' in str(context.exception)
+        assert lims.get_uri('samples', 'S1') in str(context.exception)
+
+
+class TestRateLimitedTransport(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_endpoint_class(self):
+        lims = self.lims
+        assert endpoint_class(protocol.get(lims.get_uri('samples'), params={'name': 'S1'})) == 'listing'
+        assert endpoint_class(protocol.get(lims.get_uri('samples') + '?start-index=500')) == 'listing'
+        assert endpoint_class(protocol.get(lims.get_uri('configuration', 'protocols'))) == 'listing'
+        assert endpoint_class(protocol.get(lims.get_uri('samples', 'S1'))) == 'get'
+        assert endpoint_class(protocol.get(lims.get_uri('artifacts', 'a1') + '?state=1234')) == 'get'
+        assert endpoint_class(protocol.get(lims.get_uri('artifacts', 'a1'), params={'state': '1234'})) == 'get'
+        assert endpoint_class(protocol.get(lims.get_uri('configuration', 'protocols', '1'))) == 'get'
+        assert endpoint_class(protocol.post(lims.get_uri('samples', 'batch/retrieve'), b'')) == 'batch'
+        assert endpoint_class(protocol.put(lims.get_uri('samples', 'S1'), b'')) == 'write'
+        assert endpoint_class(protocol.delete(lims.get_uri('artifacts', 'a1'))) == 'write'
+
+    def test_token_bucket(self):
+        now = [0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+        bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0], sleep=sleep)
+        assert [bucket.acquire() for i in range(4)] == [0, 0, 0.5, 0.5]
+        now[0] += 10
+        assert bucket.acquire() == 0
+        assert bucket.tokens == 1
+
+    def test_rate(self):
+        now = [0]
+
+        def sleep(delay):
+            now[0] += delay
+        transport = RateLimitedTransport(Mock(return_value=Response(200, '')), clock=lambda: now[0], sleep=sleep,
+                                         limits=dict(listing=Limit(rate=10)))
+        for i in range(5):
+            transport(protocol.get(self.lims.get_uri('samples'), params={'name': i}))
+            transport(protocol.get(self.lims.get_uri('samples', 'S1')))
+        assert abs(now[0] - 0.4) < 1e-9
+        assert transport.counters == dict(listing=5, get=5, throttled=4)
+
+    def test_in_flight(self):
+        active = [0]
+        peak = [0]
+        lock = threading.Lock()
+
+        def slow(request):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return Response(200, '')
+        transport = RateLimitedTransport(slow, max_in_flight=3, limits=dict(get=Limit(max_in_flight=2)))
+        uris = [self.lims.get_uri('samples', 'S{0}'.format(i)) for i in range(12)]
+        uris += [self.lims.get_uri('samples', 'batch/retrieve')] * 6
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda uri: transport(protocol.get(uri)), uris))
+        assert peak[0] == 3
+        assert transport.counters == dict(get=12, batch=6)
+        assert transport.in_flight.acquire(False)
+
+
+class TestCoalescer(TestCase):
+
+    def run_threads(self, coalescer, func, n=5):
+        "Call func through the coalescer in n threads, releasing it once all wait."
+        release = threading.Event()
+
+        def blocked():
+            release.wait()
+            return func()
+
+        def call():
+            try:
+                return coalescer.call('key', blocked)
+            except ValueError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(call) for i in range(n)]
+            while coalescer.counters['coalesced'] < n - 1:
+                time.sleep(0.001)
+            release.set()
+            return [f.result() for f in futures]
+
+    def test_call(self):
+        coalescer = Coalescer()
+        func = Mock(return_value=object())
+        results = self.run_threads(coalescer, func)
+        assert func.call_count == 1
+        assert all(r is func.return_value for r in results)
+        assert coalescer.calls == dict()
+        assert coalescer.call('key', lambda: 1) == 1
+
+    def test_error(self):
+        coalescer = Coalescer()
+        results = self.run_threads(coalescer, Mock(side_effect=ValueError('bad')))
+        assert all(isinstance(r, ValueError) for r in results)
+        assert coalescer.call('key', lambda: 1) == 1
+
+    def test_lims(self):
+        lims = Lims(url, username='test', password='password')
+        release = threading.Event()
+        calls = []
+
+        def transport(request):
+            calls.append(request)
+            release.wait()
+            return Response(200, sample_xml)
+        lims.transport = transport
+        samples = [Sample(lims, id='S1') for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(lims.get, sample.uri) for sample in samples]
+            while lims.coalescer.counters['coalesced'] < 3:
+                time.sleep(0.001)
+            release.set()
+            roots = [f.result() for f in futures]
+        assert len(calls) == 1
+        assert all(root is roots[0] for root in roots)
+        # Requests differing in params are not coalesced
+        lims.get(samples[0].uri, params={'a': 1})
+        assert len(calls) == 2
@@ -0,0 +1,107 @@
+from sys import version_info
+from unittest import TestCase
+
+from genologics.entities import Container, Queue
+from genologics.lims import Lims
+from genologics.watch import Watcher, Created, Modified, Removed, fingerprint
+
+if version_info[0] == 2:
+    from mock import patch, Mock
+else:
+    from unittest.mock import patch, Mock
+
+url = 'http://testgenologics.com:4040'
+
+containers_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<con:containers xmlns:con="http://genologics.com/ri/container">
+{entries}
+</con:containers>"""
+
+container_entry = """<container uri="{url}/api/v2/containers/{id}" limsid="{id}"/>"""
+
+batch_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<con:details xmlns:con="http://genologics.com/ri/container">
+{entries}
+</con:details>"""
+
+container_details = """<con:container xmlns:con="http://genologics.com/ri/container" uri="{url}/api/v2/containers/{id}" limsid="{id}">
+<name>{id}</name><state>{state}</state></con:container>"""
+
+queue_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<que:queue xmlns:que="http://genologics.com/ri/queue" uri="{url}/api/v2/queues/q1">
+<artifacts>
+{entries}
+</artifacts>
+</que:queue>"""
+
+queue_entry = """<artifact uri="{url}/api/v2/artifacts/{id}" limsid="{id}"><queue-time>t</queue-time></artifact>"""
+
+
+def _listing(ids):
+    return Mock(status_code=200, content=containers_xml.format(
+        entries='\n'.join(container_entry.format(url=url, id=i) for i in ids)))
+
+
+def _details(states):
+    return Mock(status_code=200, content=batch_xml.format(
+        entries='\n'.join(container_details.format(url=url, id=i, state=s) for i, s in states)))
+
+
+def _queue(ids, etag):
+    return Mock(status_code=200, headers={'etag': etag}, content=queue_xml.format(
+        url=url, entries='\n'.join(queue_entry.format(url=url, id=i) for i in ids)))
+
+
+class TestWatcher(TestCase):
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_containers(self):
+        watcher = Watcher(self.lims)
+        source = watcher.watch_containers(since='2020-01-01T00:00:00Z', type='96 well plate')
+        received = []
+        watcher.subscribe(received.append, kinds=[Modified])
+        with patch('requests.Session.get', side_effect=[_listing(['c1', 'c2']), _listing(['c1', 'c2'])]) as get, \
+                patch('genologics.lims.requests.post', side_effect=[
+                    _details([('c1', 'Empty'), ('c2', 'Empty')]),
+                    _details([('c1', 'Populated'), ('c2', 'Empty')])]):
+            c1, c2 = Container(self.lims, id='c1'), Container(self.lims, id='c2')
+            assert watcher.poll() == [Created(c1, source), Created(c2, source)]
+            empty = fingerprint(self.lims, c1.root)
+            assert get.call_args[1]['params'] == {'last-modified': '2020-01-01T00:00:00Z',
+                                                  'type': '96 well plate'}
+            # c2 is listed again in the overlap window, but has not changed
+            assert watcher.poll() == [Modified(c1, source)]
+            assert get.call_args[1]['params']['last-modified'] != '2020-01-01T00:00:00Z'
+        assert received == [Modified(c1, source)]
+        assert received[0].previous == empty
+        assert source.state[c1.uri] == fingerprint(self.lims, c1.root)
+        assert c1.state == 'Populated'
+
+    def test_queue(self):
+        watcher = Watcher(self.lims)
+        queue = Queue(self.lims, id='q1')
+        source = watcher.watch_queue(queue)
+        responses = [_queue(['a1', 'a2'], 'v1'),
+                     Mock(status_code=304, content=''),
+                     _queue(['a2', 'a3'], 'v2')]
+        with patch('requests.Session.get', side_effect=responses) as get:
+            events = list(watcher.events(interval=0, max_polls=3))
+            assert get.call_args_list[0][1]['headers'] == {'accept': 'application/xml'}
+            assert get.call_args_list[1][1]['headers']['if-none-match'] == 'v1'
+            assert get.call_args_list[2][1]['headers']['if-none-match'] == 'v1'
+        assert [(e.kind, e.entity.id) for e in events] == [
+            ('created', 'a1'), ('created', 'a2'), ('created', 'a3'), ('removed', 'a1')]
+        assert isinstance(events[-1], Removed)
+        assert source.validators == {'etag': 'v2'}
+
+    def test_processes(self):
+        watcher = Watcher(self.lims)
+        processes = [Mock(uri='p1'), Mock(uri='p2')]
+        with patch.object(self.lims, 'get_processes', return_value=processes), \
+                patch.object(self.lims, 'resolve_many') as resolve_many:
+            source = watcher.watch_processes(since='2020-01-01T00:00:00Z')
+            with patch.object(source, '_diff', return_value=None):
+                assert watcher.poll() == []
+        resolve_many.assert_called_once_with(processes, force=True)